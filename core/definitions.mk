@@ -190,9 +190,13 @@ endef
 
 # $(1): directory to search under
 # Ignores $(1)/Android.mk
+# The directory listings are cached under $(OUT_DIR)/.findleaves, so that a
+# later call only lists the directories modified since.
 define first-makefiles-under
 $(shell build/make/tools/findleaves.py $(FIND_LEAVES_EXCLUDES) \
-        --mindepth=2 $(addprefix --dir=,$(1)) Android.mk)
+        --mindepth=2 $(addprefix --dir=,$(1)) \
+        --cache=$(OUT_DIR)/.findleaves/$(subst /,_,$(subst $(space),+,$(strip $(1)))).cache \
+        Android.mk)
 endef
 
 ###########################################################
@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 #
 # Copyright (C) 2009 The Android Open Source Project
 #
@@ -21,50 +21,257 @@
 #
 
 import os
+import pickle
+import re
+import stat
 import sys
+import time
+from multiprocessing import Pool
 
-def perform_find(mindepth, prune, dirlist, filenames):
-  result = []
-  pruneleaves = set(map(lambda x: os.path.split(x)[1], prune))
-  seen = set()
-  for rootdir in dirlist:
-    rootdepth = rootdir.count("/")
-    for root, dirs, files in os.walk(rootdir, followlinks=True):
+CACHE_VERSION = 3
+
+# Directories modified this recently are not cached, since a later change
+# within the same mtime tick would not be noticed.
+CACHE_MIN_AGE_NS = 2 * 1000 * 1000 * 1000
+
+MOUNTINFO = "/proc/self/mountinfo"
+
+def load_mount_points():
+  """Returns the mount points as {(dev, inode) of their parent: {name}}.
+
+  The inode number of a directory entry is that of the directory, unless
+  another file system is mounted on it, so resolve_dir stats the mount points.
+  Returns None if the mount points are unknown, in which case every
+  subdirectory is stat'ed.
+  """
+  try:
+    with open(MOUNTINFO, "rb") as f:
+      lines = f.readlines()
+  except OSError:
+    return None
+  mount_points = {}
+  for line in lines:
+    fields = line.split()
+    if len(fields) < 5:
+      continue
+    # Spaces and the like are escaped as octal in the mount point.
+    path = os.fsdecode(re.sub(rb"\\([0-7]{3})",
+                              lambda m: bytes([int(m.group(1), 8)]),
+                              fields[4]))
+    parent, name = os.path.split(path)
+    if not name:
+      continue
+    try:
+      st = os.stat(parent)
+    except OSError:
+      continue
+    mount_points.setdefault((st.st_dev, st.st_ino), set()).add(name)
+  return mount_points
+
+def scan_dir(path, filenames):
+  """Lists a directory using only the file types of its entries.
+
+  Returns (entries, files): the (name, inode) of the subdirectories and
+  symlinks in scandir order, with inode None for symlinks, and the names in
+  filenames of the other entries. Symlinks are resolved by resolve_dir.
+  """
+  entries = []
+  files = []
+  with os.scandir(path) as it:
+    for entry in it:
+      if entry.is_symlink():
+        entries.append((entry.name, None))
+      elif entry.is_dir():
+        entries.append((entry.name, entry.inode()))
+      elif entry.name in filenames:
+        files.append(entry.name)
+  return entries, files
+
+def resolve_dir(path, key, scan, filenames, mount_points):
+  """Returns the subdirectories [(name, (dev, inode))] and files of a scan.
+
+  key is the (dev, inode) of path. Only symlinks and mount points are stat'ed,
+  or every subdirectory if mount_points is None. Like os.walk, a symlink to a
+  directory is a directory and any other symlink, including a broken one, is a
+  file.
+  """
+  entries, files = scan
+  dev = key[0]
+  stat_all = mount_points is None
+  mounted = () if stat_all else mount_points.get(key, ())
+  dirs = []
+  if (not stat_all and not mounted and
+      all(inode is not None for _, inode in entries)):
+    return [(name, (dev, inode)) for name, inode in entries], files
+  for name, inode in entries:
+    if inode is not None and not stat_all and name not in mounted:
+      dirs.append((name, (dev, inode)))
+      continue
+    try:
+      st = os.stat(os.path.join(path, name))
+    except OSError:
+      st = None
+    if st is not None and stat.S_ISDIR(st.st_mode):
+      dirs.append((name, (st.st_dev, st.st_ino)))
+    elif name in filenames:
+      files = files + [name]
+  return dirs, files
+
+class LeafFinder(object):
+  """Walks directories like os.walk(followlinks=True) for perform_find.
+
+  Directory scans are reused from known, a {path: (stamp, scan)} dictionary of
+  a cache or of prefetching processes. With use_stamps, every directory is
+  stat'ed and its known scan is reused only if the stamp (mtime, inode,
+  device) is unchanged. With record, the scans of the walk are saved in scans,
+  and changed is set if any directory was scanned again.
+  """
+
+  def __init__(self, mindepth, prune, filenames, use_stamps, record,
+               known=None):
+    self.mindepth = mindepth
+    self.prune = set(prune)
+    self.filenames = filenames
+    self.filename_set = set(filenames)
+    self.use_stamps = use_stamps
+    self.record = record
+    self.known = known if known is not None else {}
+    self.scans = {}
+    self.changed = False
+    self.mount_points = load_mount_points()
+
+  def list_dir(self, path, key):
+    """Returns the resolved scan of the directory path, or None."""
+    known = self.known.get(path)
+    stamp = None
+    try:
+      if self.use_stamps:
+        st = os.stat(path)
+        stamp = (st.st_mtime_ns, st.st_ino, st.st_dev)
+        key = (st.st_dev, st.st_ino)
+        if known is not None and known[0] != stamp:
+          known = None
+      if known is not None:
+        scan = known[1]
+      else:
+        scan = scan_dir(path, self.filename_set)
+        self.changed = True
+    except OSError:
+      return None
+    if self.record:
+      self.scans[path] = (stamp, scan)
+    return resolve_dir(path, key, scan, self.filename_set, self.mount_points)
+
+  def subdirs(self, rootdir):
+    """Returns the (path, key) of the subdirectories of rootdir."""
+    try:
+      st = os.stat(rootdir)
+    except OSError:
+      return []
+    listing = self.list_dir(rootdir, (st.st_dev, st.st_ino))
+    if listing is None:
+      return []
+    return [(os.path.join(rootdir, name), key) for name, key in listing[0]
+            if name not in self.prune]
+
+  def walk(self, top, key, rootdepth, seen, result):
+    """Appends the leaves found under top to result."""
+    stack = [(top, key)]
+    while stack:
+      root, key = stack.pop()
+      listing = self.list_dir(root, key)
+      if listing is None:
+        continue
+      dirs, files = listing
       # prune
-      check_prune = False
-      for d in dirs:
-        if d in pruneleaves:
-          check_prune = True
-          break
-      if check_prune:
-        i = 0
-        while i < len(dirs):
-          if dirs[i] in prune:
-            del dirs[i]
-          else:
-            i += 1
+      if self.prune:
+        dirs = [d for d in dirs if d[0] not in self.prune]
       # mindepth
-      if mindepth > 0:
-        depth = 1 + root.count("/") - rootdepth
-        if depth < mindepth:
-          continue
-      # match
-      for filename in filenames:
-        if filename in files:
-          result.append(os.path.join(root, filename))
-          del dirs[:]
-
-      # filter out inodes that have already been seen due to symlink loops
-      i = 0
-      while i < len(dirs):
-        st = os.stat(os.path.join(root, dirs[i]))
-        key = (st.st_dev, st.st_ino)
-        if key in seen:
-          del dirs[i]
-        else:
-          i += 1
-          seen.add(key)
+      if self.mindepth <= 0 or 1 + root.count("/") - rootdepth >= self.mindepth:
+        # match
+        for filename in self.filenames:
+          if filename in files:
+            result.append(os.path.join(root, filename))
+            dirs = []
+        # filter out inodes that have already been seen due to symlink loops
+        unseen = []
+        for d in dirs:
+          if d[1] not in seen:
+            seen.add(d[1])
+            unseen.append(d)
+        dirs = unseen
+      prefix = root if root.endswith("/") else root + "/"
+      stack.extend([(prefix + name, key) for name, key in reversed(dirs)])
+
+  def find(self, rootdir, seen, result):
+    """Appends the leaves found under rootdir to result."""
+    try:
+      st = os.stat(rootdir)
+    except OSError:
+      return
+    self.walk(rootdir, (st.st_dev, st.st_ino), rootdir.count("/"), seen,
+              result)
+
+def prefetch(args):
+  """Returns the scans of a walk of a subdirectory, in a worker process."""
+  top, key, rootdepth, mindepth, prune, filenames, use_stamps = args
+  finder = LeafFinder(mindepth, prune, filenames, use_stamps, True)
+  finder.walk(top, key, rootdepth, set(), [])
+  return finder.scans
+
+def load_cache(cache_path, filenames):
+  """Returns the {path: (stamp, scan)} cached for filenames."""
+  try:
+    with open(cache_path, "rb") as f:
+      cache = pickle.load(f)
+  except (OSError, EOFError, pickle.UnpicklingError):
+    return {}
+  if (not isinstance(cache, dict) or cache.get("version") != CACHE_VERSION or
+      cache.get("filenames") != sorted(filenames)):
+    return {}
+  return cache["dirs"]
+
+def save_cache(cache_path, filenames, scans, start_ns):
+  """Saves the scans of directories not modified since shortly before start."""
+  dirs = {path: entry for path, entry in scans.items()
+          if entry[0] is not None and entry[0][0] < start_ns - CACHE_MIN_AGE_NS}
+  os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+  tmp_path = "%s.%d.tmp" % (cache_path, os.getpid())
+  with open(tmp_path, "wb") as f:
+    pickle.dump({"version": CACHE_VERSION, "filenames": sorted(filenames),
+                 "dirs": dirs}, f, pickle.HIGHEST_PROTOCOL)
+  os.replace(tmp_path, cache_path)
+
+def perform_find(mindepth, prune, dirlist, filenames, jobs=1, cache_path=None):
+  """Returns the leaves under dirlist, the same as a walk with os.walk.
 
+  With jobs > 1, the top-level subdirectories of dirlist are scanned in
+  parallel first. The walk then runs in order over these scans, so that the
+  result does not depend on jobs. With cache_path, the scans are saved and
+  a directory is scanned again only if it has changed since the last run.
+  """
+  start_ns = time.time_ns()
+  use_stamps = cache_path is not None
+  known = load_cache(cache_path, filenames) if use_stamps else {}
+  finder = LeafFinder(mindepth, prune, filenames, use_stamps,
+                      use_stamps or jobs > 1, known)
+  if jobs > 1 and not known:
+    tasks = []
+    for rootdir in dirlist:
+      for path, key in finder.subdirs(rootdir):
+        tasks.append((path, key, rootdir.count("/"), mindepth, prune,
+                      filenames, use_stamps))
+    with Pool(jobs) as pool:
+      for scans in pool.imap_unordered(prefetch, tasks):
+        known.update(scans)
+    known.update(finder.scans)
+    finder.changed = True
+  result = []
+  seen = set()
+  for rootdir in dirlist:
+    finder.find(rootdir, seen, result)
+  if use_stamps and (finder.changed or len(finder.scans) != len(known)):
+    save_cache(cache_path, filenames, finder.scans, start_ns)
   return result
 
 def usage():
@@ -79,6 +286,11 @@ Options:
        Add a directory to search.  May be repeated multiple times.  For backwards
        compatibility, if no --dir argument is provided then all but the last entry
        in <filenames> are treated as directories.
+   --jobs=<jobs>
+       Scan the top-level subdirectories with <jobs> parallel processes.
+   --cache=<file>
+       Save the directory listings in <file>, and only list again the
+       directories modified since the last run.
 """ % {
       "progName": os.path.split(sys.argv[0])[1],
     })
@@ -88,6 +300,8 @@ def main(argv):
   mindepth = -1
   prune = []
   dirlist = []
+  jobs = 1
+  cache_path = None
   i=1
   while i<len(argv) and len(argv[i])>2 and argv[i][0:2] == "--":
     arg = argv[i]
@@ -106,6 +320,15 @@ def main(argv):
       if len(d) == 0:
         usage()
       dirlist.append(d)
+    elif arg.startswith("--jobs="):
+      try:
+        jobs = int(arg[len("--jobs="):])
+      except ValueError:
+        usage()
+    elif arg.startswith("--cache="):
+      cache_path = arg[len("--cache="):]
+      if len(cache_path) == 0:
+        usage()
     else:
       usage()
     i += 1
@@ -118,10 +341,11 @@ def main(argv):
     if len(argv)-i < 1: # need <filename>
       usage()
     filenames = argv[i:]
-  results = list(set(perform_find(mindepth, prune, dirlist, filenames)))
+  results = list(set(perform_find(mindepth, prune, dirlist, filenames, jobs,
+                                  cache_path)))
   results.sort()
   for r in results:
-    print r
+    print(r)
 
 if __name__ == "__main__":
   main(sys.argv)
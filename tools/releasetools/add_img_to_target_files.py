@@ -24,7 +24,11 @@ Usage:  add_img_to_target_files [flag] target_files
   -a  (--add_missing)
       Build and add missing images to "IMAGES/". If this option is
       not specified, this script will simply exit when "IMAGES/"
-      directory exists in the target file.
+      directory exists in the target file. The inputs of the images built by
+      this option are recorded in META/image_build_manifest.json. An image
+      listed there is rebuilt, and overwritten, if its inputs have changed
+      since; any other existing image is kept as is. Remove the entry of an
+      image from the manifest before replacing the image by hand.
 
   -r  (--rebuild_recovery)
       Rebuild the recovery patch and write it to the system image. Only
@@ -42,12 +46,23 @@ Usage:  add_img_to_target_files [flag] target_files
   --is_signing
       Skip building & adding the images for "userdata" and "cache" if we
       are signing the target files.
+
+  -t  (--worker_threads) <int>
+      Specify the number of images to build in parallel. Default to half of
+      the number of CPUs. The partition images are also bounded by the size of
+      their staged trees: the ones running at a time don't take more than the
+      largest tree, so that the large mkfs and avbtool jobs run one at a time.
 """
 
 from __future__ import print_function
 
+import copy
 import datetime
+import functools
+import hashlib
+import json
 import logging
+import multiprocessing
 import os
 import shlex
 import shutil
@@ -64,7 +79,7 @@ import verity_utils
 import ota_metadata_pb2
 
 from apex_utils import GetApexInfoFromTargetFiles
-from common import AddCareMapForAbOta, ZipDelete
+from common import AddCareMapForAbOta
 
 if sys.hexversion < 0x02070000:
   print("Python 2.7 or newer is required.", file=sys.stderr)
@@ -79,6 +94,7 @@ OPTIONS.replace_updated_files_list = []
 OPTIONS.replace_verity_public_key = False
 OPTIONS.replace_verity_private_key = False
 OPTIONS.is_signing = False
+OPTIONS.image_build_manifest = {}
 
 # Use a fixed timestamp (01/01/2009 00:00:00 UTC) for files when packaging
 # images. (b/24377993, b/80600931)
@@ -86,6 +102,13 @@ FIXED_FILE_TIMESTAMP = int((
     datetime.datetime(2009, 1, 1, 0, 0, 0, 0, None) -
     datetime.datetime.utcfromtimestamp(0)).total_seconds())
 
+# Records the input fingerprint of each image built by CreateImage(), so that
+# a later run can tell whether an existing image is up to date.
+IMAGE_BUILD_MANIFEST = "META/image_build_manifest.json"
+
+# The image props that name the outputs of the build, rather than its inputs.
+IMAGE_FINGERPRINT_EXCLUDED_PROPS = ("block_list",)
+
 
 class OutputFile(object):
   """A helper class to write a generated file to the given dir or zip.
@@ -107,17 +130,71 @@ class OutputFile(object):
 
   def Write(self, compress_type=None):
     if self._output_zip:
+      # An out-of-date image from the input gets replaced once the zip is
+      # closed.
+      if self._zip_name in self._output_zip.namelist():
+        OPTIONS.replace_updated_files_list.append(self._zip_name)
+        return
       common.ZipWrite(self._output_zip, self.name,
                       self._zip_name, compress_type=compress_type)
 
 
+class DeferredOutputZip(object):
+  """Records the writes to an output zip, so that they can be replayed later.
+
+  Images are built in parallel, but the writes to the output zip need to be
+  serialized, and made in a fixed order so that the output is repeatable. Each
+  image task writes into its own DeferredOutputZip instead, which are replayed
+  in turn once all the tasks finish. It provides the part of the ZipFile
+  interface that common.ZipWrite() and common.ZipWriteStr() use.
+  """
+
+  def __init__(self, output_zip):
+    self._output_zip = output_zip
+    self._writes = []
+    self.compression = output_zip.compression
+
+  def namelist(self):
+    return self._output_zip.namelist() + [
+        arcname for arcname, _ in self._writes]
+
+  def write(self, filename, arcname=None, compress_type=None):
+    # common.ZipWrite() has set the permissions to be recorded in the zip.
+    perms = stat.S_IMODE(os.stat(filename).st_mode)
+    self._writes.append((arcname, functools.partial(
+        common.ZipWrite, filename=filename, arcname=arcname, perms=perms,
+        compress_type=compress_type)))
+
+  def writestr(self, zinfo, data):
+    self._writes.append((zinfo.filename, functools.partial(
+        common.ZipWriteStr, zinfo_or_arcname=copy.copy(zinfo), data=data)))
+
+  def Replay(self):
+    """Applies the recorded writes to the output zip, in order."""
+    for _, write in self._writes:
+      write(self._output_zip)
+    self._writes = []
+
+
+def _IsPrebuiltImage(img, what):
+  """Returns whether the existing IMAGES/<what>.img should be used as is.
+
+  Images without an entry in the image build manifest are prebuilts, and are
+  always used as is. The others were built by a previous --add_missing run,
+  and CreateImage() only reuses them if their inputs haven't changed.
+  """
+  if not os.path.exists(img.name) or what in OPTIONS.image_build_manifest:
+    return False
+  logger.info("%s.img already exists; no need to rebuild...", what)
+  return True
+
+
 def AddSystem(output_zip, recovery_img=None, boot_img=None):
   """Turn the contents of SYSTEM into a system image and store it in
   output_zip. Returns the name of the system image file."""
 
   img = OutputFile(output_zip, OPTIONS.input_tmp, "IMAGES", "system.img")
-  if os.path.exists(img.name):
-    logger.info("system.img already exists; no need to rebuild...")
+  if _IsPrebuiltImage(img, "system"):
     return img.name
 
   def output_sink(fn, data):
@@ -153,8 +230,7 @@ def AddSystemOther(output_zip):
   and store it in output_zip."""
 
   img = OutputFile(output_zip, OPTIONS.input_tmp, "IMAGES", "system_other.img")
-  if os.path.exists(img.name):
-    logger.info("system_other.img already exists; no need to rebuild...")
+  if _IsPrebuiltImage(img, "system_other"):
     return
 
   CreateImage(OPTIONS.input_tmp, OPTIONS.info_dict, "system_other", img)
@@ -165,8 +241,7 @@ def AddVendor(output_zip, recovery_img=None, boot_img=None):
   output_zip."""
 
   img = OutputFile(output_zip, OPTIONS.input_tmp, "IMAGES", "vendor.img")
-  if os.path.exists(img.name):
-    logger.info("vendor.img already exists; no need to rebuild...")
+  if _IsPrebuiltImage(img, "vendor"):
     return img.name
 
   def output_sink(fn, data):
@@ -202,8 +277,7 @@ def AddProduct(output_zip):
   output_zip."""
 
   img = OutputFile(output_zip, OPTIONS.input_tmp, "IMAGES", "product.img")
-  if os.path.exists(img.name):
-    logger.info("product.img already exists; no need to rebuild...")
+  if _IsPrebuiltImage(img, "product"):
     return img.name
 
   block_list = OutputFile(
@@ -220,8 +294,7 @@ def AddSystemExt(output_zip):
 
   img = OutputFile(output_zip, OPTIONS.input_tmp, "IMAGES",
                    "system_ext.img")
-  if os.path.exists(img.name):
-    logger.info("system_ext.img already exists; no need to rebuild...")
+  if _IsPrebuiltImage(img, "system_ext"):
     return img.name
 
   block_list = OutputFile(
@@ -236,8 +309,7 @@ def AddOdm(output_zip):
   """Turn the contents of ODM into an odm image and store it in output_zip."""
 
   img = OutputFile(output_zip, OPTIONS.input_tmp, "IMAGES", "odm.img")
-  if os.path.exists(img.name):
-    logger.info("odm.img already exists; no need to rebuild...")
+  if _IsPrebuiltImage(img, "odm"):
     return img.name
 
   block_list = OutputFile(
@@ -252,8 +324,7 @@ def AddVendorDlkm(output_zip):
   """Turn the contents of VENDOR_DLKM into an vendor_dlkm image and store it in output_zip."""
 
   img = OutputFile(output_zip, OPTIONS.input_tmp, "IMAGES", "vendor_dlkm.img")
-  if os.path.exists(img.name):
-    logger.info("vendor_dlkm.img already exists; no need to rebuild...")
+  if _IsPrebuiltImage(img, "vendor_dlkm"):
     return img.name
 
   block_list = OutputFile(
@@ -268,8 +339,7 @@ def AddOdmDlkm(output_zip):
   """Turn the contents of OdmDlkm into an odm_dlkm image and store it in output_zip."""
 
   img = OutputFile(output_zip, OPTIONS.input_tmp, "IMAGES", "odm_dlkm.img")
-  if os.path.exists(img.name):
-    logger.info("odm_dlkm.img already exists; no need to rebuild...")
+  if _IsPrebuiltImage(img, "odm_dlkm"):
     return img.name
 
   block_list = OutputFile(
@@ -283,8 +353,7 @@ def AddSystemDlkm(output_zip):
   """Turn the contents of SystemDlkm into an system_dlkm image and store it in output_zip."""
 
   img = OutputFile(output_zip, OPTIONS.input_tmp, "IMAGES", "system_dlkm.img")
-  if os.path.exists(img.name):
-    logger.info("system_dlkm.img already exists; no need to rebuild...")
+  if _IsPrebuiltImage(img, "system_dlkm"):
     return img.name
 
   block_list = OutputFile(
@@ -417,6 +486,95 @@ def AddCustomImages(output_zip, partition_name):
   return default
 
 
+def _HashFile(path):
+  h = hashlib.sha256()
+  with open(path, "rb") as f:
+    for data in iter(lambda: f.read(1024 * 1024), b""):
+      h.update(data)
+  return h.hexdigest()
+
+
+def _HashTree(path):
+  """Returns a Merkle hash over the names, modes and contents under path."""
+  h = hashlib.sha256()
+  with os.scandir(path) as it:
+    entries = sorted(it, key=lambda entry: entry.name)
+  for entry in entries:
+    if entry.is_symlink():
+      digest = os.readlink(entry.path)
+    elif entry.is_dir(follow_symlinks=False):
+      digest = _HashTree(entry.path)
+    elif entry.is_file(follow_symlinks=False):
+      digest = _HashFile(entry.path)
+    else:
+      digest = ""
+    mode = entry.stat(follow_symlinks=False).st_mode
+    h.update(b"\0".join([os.fsencode(entry.name), b"%o" % mode,
+                         os.fsencode(digest)]) + b"\n")
+  return h.hexdigest()
+
+
+def _GetTreeSize(path):
+  """Returns the total size of the files under path, or 0 if it's missing."""
+  size = 0
+  try:
+    with os.scandir(path) as it:
+      for entry in it:
+        if entry.is_dir(follow_symlinks=False):
+          size += _GetTreeSize(entry.path)
+        elif entry.is_file(follow_symlinks=False):
+          size += entry.stat(follow_symlinks=False).st_size
+  except FileNotFoundError:
+    pass
+  return size
+
+
+def ComputeImageFingerprint(input_dir, what, image_props):
+  """Returns the fingerprint of the inputs to the image of a partition.
+
+  It covers the staged tree of the partition, and the image props along with
+  the contents of the files that they name (e.g. fs_config, file_contexts and
+  the signing keys).
+
+  input_dir is a new temp dir on each run, so the paths under it are hashed
+  relative to it. Otherwise no image would ever be reused.
+  """
+  h = hashlib.sha256()
+  input_prefix = os.path.join(input_dir, "")
+  staged_dir = os.path.join(input_dir, what.upper())
+  if os.path.isdir(staged_dir):
+    h.update(b"tree " + _HashTree(staged_dir).encode() + b"\n")
+  for key in sorted(image_props):
+    if key in IMAGE_FINGERPRINT_EXCLUDED_PROPS:
+      continue
+    value = str(image_props[key])
+    h.update("{}={}\n".format(key, value.replace(input_prefix, "")).encode())
+    if os.path.isfile(value):
+      h.update(b"file " + _HashFile(value).encode() + b"\n")
+  return h.hexdigest()
+
+
+def LoadImageBuildManifest(input_dir):
+  """Loads the image build manifest from a previous run, if any."""
+  manifest_path = os.path.join(input_dir, IMAGE_BUILD_MANIFEST)
+  if not os.path.exists(manifest_path):
+    return {}
+  with open(manifest_path) as f:
+    return json.load(f)
+
+
+def AddImageBuildManifest(output_zip):
+  """Writes the image build manifest to the output dir and zipfile."""
+  output_file = os.path.join(OPTIONS.input_tmp, IMAGE_BUILD_MANIFEST)
+  with open(output_file, "w") as f:
+    json.dump(OPTIONS.image_build_manifest, f, indent=2, sort_keys=True)
+  if output_zip:
+    if IMAGE_BUILD_MANIFEST in output_zip.namelist():
+      OPTIONS.replace_updated_files_list.append(IMAGE_BUILD_MANIFEST)
+    else:
+      common.ZipWrite(output_zip, output_file, IMAGE_BUILD_MANIFEST)
+
+
 def CreateImage(input_dir, info_dict, what, output_file, block_list=None):
   logger.info("creating %s.img...", what)
 
@@ -448,6 +606,21 @@ def CreateImage(input_dir, info_dict, what, output_file, block_list=None):
   hash_seed = "hash_seed-" + uuid_seed
   image_props["hash_seed"] = str(uuid.uuid5(uuid.NAMESPACE_URL, hash_seed))
 
+  # With --add_missing, reuses the image from a previous run, along with the
+  # info it set, if none of its inputs have changed. This skips both mkfs and
+  # the AVB signing. Hashing the inputs costs a full read of the staged tree, so
+  # it is skipped on the other runs, which always build all the images.
+  fingerprint = None
+  if OPTIONS.add_missing:
+    fingerprint = ComputeImageFingerprint(input_dir, what, image_props)
+    manifest_entry = OPTIONS.image_build_manifest.get(what)
+    if (manifest_entry and manifest_entry["fingerprint"] == fingerprint and
+        os.path.exists(output_file.name) and
+        (not block_list or os.path.exists(block_list.name))):
+      logger.info("%s.img is up to date; no need to rebuild...", what)
+      info_dict.update(manifest_entry["info"])
+      return
+
   build_image.BuildImage(
       os.path.join(input_dir, what.upper()), image_props, output_file.name)
 
@@ -456,6 +629,7 @@ def CreateImage(input_dir, info_dict, what, output_file, block_list=None):
     block_list.Write()
 
   # Set the '_image_size' for given image size.
+  image_info = {}
   is_verity_partition = "verity_block_device" in image_props
   verity_supported = (image_props.get("verity") == "true" or
                       image_props.get("avb_enable") == "true")
@@ -464,13 +638,20 @@ def CreateImage(input_dir, info_dict, what, output_file, block_list=None):
     image_size = image_props.get("image_size")
     if image_size:
       image_size_key = what + "_image_size"
-      info_dict[image_size_key] = int(image_size)
+      image_info[image_size_key] = int(image_size)
 
   use_dynamic_size = (
       info_dict.get("use_dynamic_partition_size") == "true" and
       what in shlex.split(info_dict.get("dynamic_partition_list", "").strip()))
   if use_dynamic_size:
-    info_dict.update(build_image.GlobalDictFromImageProp(image_props, what))
+    image_info.update(build_image.GlobalDictFromImageProp(image_props, what))
+
+  info_dict.update(image_info)
+  if fingerprint:
+    OPTIONS.image_build_manifest[what] = {
+        "fingerprint": fingerprint,
+        "info": image_info,
+    }
 
 
 def AddUserdata(output_zip):
@@ -628,6 +809,7 @@ def CheckAbOtaImages(output_zip, ab_partitions):
     assert available, "Failed to find " + img_name
 
 
+@common.Traced
 def AddPackRadioImages(output_zip, images):
   """Copies images listed in META/pack_radioimages.txt from RADIO/ to IMAGES/.
 
@@ -660,6 +842,7 @@ def AddPackRadioImages(output_zip, images):
       shutil.copy(img_radio_path, prebuilt_path)
 
 
+@common.Traced
 def AddSuperEmpty(output_zip):
   """Create a super_empty.img and store it in output_zip."""
 
@@ -668,6 +851,7 @@ def AddSuperEmpty(output_zip):
   img.Write()
 
 
+@common.Traced
 def AddSuperSplit(output_zip):
   """Create split super_*.img and store it in output_zip."""
 
@@ -681,23 +865,6 @@ def AddSuperSplit(output_zip):
       img.Write()
 
 
-def ReplaceUpdatedFiles(zip_filename, files_list):
-  """Updates all the ZIP entries listed in files_list.
-
-  For now the list includes META/care_map.pb, and the related files under
-  SYSTEM/ after rebuilding recovery.
-  """
-  common.ZipDelete(zip_filename, files_list)
-  output_zip = zipfile.ZipFile(zip_filename, "a",
-                               compression=zipfile.ZIP_DEFLATED,
-                               allowZip64=True)
-  for item in files_list:
-    file_path = os.path.join(OPTIONS.input_tmp, item)
-    assert os.path.exists(file_path)
-    common.ZipWrite(output_zip, file_path, arcname=item)
-  common.ZipClose(output_zip)
-
-
 def HasPartition(partition_name):
   """Determines if the target files archive should build a given partition."""
 
@@ -728,6 +895,7 @@ def AddApexInfo(output_zip):
       common.ZipWrite(output_zip, output_file, arc_name)
 
 
+@common.Traced
 def AddVbmetaDigest(output_zip):
   """Write the vbmeta digest to the output dir and zipfile."""
 
@@ -755,6 +923,7 @@ def AddVbmetaDigest(output_zip):
         common.ZipWriteStr(output_zip, arc_name, digest)
 
 
+@common.Traced
 def AddImagesToTargetFiles(filename):
   """Creates and adds images (boot/recovery/system/...) to a target_files.zip.
 
@@ -762,7 +931,8 @@ def AddImagesToTargetFiles(filename):
   files to be packed into a target_files.zip (dir mode). The latter is used when
   being called from build/make/core/Makefile.
 
-  The images will be created under IMAGES/ in the input target_files.zip.
+  The images will be created under IMAGES/ in the input target_files.zip. They
+  are built by OPTIONS.worker_threads threads, or one at a time if it isn't set.
 
   Args:
     filename: the target_files.zip, or the zip root directory.
@@ -778,6 +948,7 @@ def AddImagesToTargetFiles(filename):
       sys.exit(1)
 
   OPTIONS.info_dict = common.LoadInfoDict(OPTIONS.input_tmp, repacking=True)
+  OPTIONS.image_build_manifest = LoadImageBuildManifest(OPTIONS.input_tmp)
 
   has_recovery = OPTIONS.info_dict.get("no_recovery") != "true"
   has_boot = OPTIONS.info_dict.get("no_boot") != "true"
@@ -822,9 +993,31 @@ def AddImagesToTargetFiles(filename):
   def banner(s):
     logger.info("\n\n++++ %s  ++++\n\n", s)
 
-  boot_image = None
-  if has_boot:
-    banner("boot")
+  # The images are built in parallel, as a graph of tasks where each task
+  # depends on the images it needs. Each task gets its own DeferredOutputZip,
+  # which are replayed into output_zip in the order the tasks are added.
+  # The partition images cost the size of their staged trees, which is what
+  # mkfs and avbtool read and write. The budget is set to the largest cost
+  # once all the tasks are added.
+  tasks = common.TaskGraph(num_workers=OPTIONS.worker_threads)
+  task_names = []
+  task_zips = []
+  task_costs = []
+
+  def add_task(name, func, deps=(), cost=0):
+    task_zip = DeferredOutputZip(output_zip) if output_zip else None
+    task_names.append(name)
+    task_zips.append(task_zip)
+    task_costs.append(cost)
+
+    def run():
+      banner(name)
+      with common.TracePhase(name):
+        return func(task_zip)
+    tasks.AddTask(name, run, deps, cost)
+
+  def add_boot(output_zip):
+    boot_image = None
     boot_images = OPTIONS.info_dict.get("boot_images")
     if boot_images is None:
       boot_images = "boot.img"
@@ -843,9 +1036,9 @@ def AddImagesToTargetFiles(filename):
           boot_image.WriteToDir(OPTIONS.input_tmp)
           if output_zip:
             boot_image.AddToZip(output_zip)
+    return boot_image
 
-  if has_init_boot:
-    banner("init_boot")
+  def add_init_boot(output_zip):
     init_boot_image = common.GetBootableImage(
         "IMAGES/init_boot.img", "init_boot.img", OPTIONS.input_tmp, "INIT_BOOT")
     if init_boot_image:
@@ -856,8 +1049,7 @@ def AddImagesToTargetFiles(filename):
         if output_zip:
           init_boot_image.AddToZip(output_zip)
 
-  if has_vendor_boot:
-    banner("vendor_boot")
+  def add_vendor_boot(output_zip):
     vendor_boot_image = common.GetVendorBootImage(
         "IMAGES/vendor_boot.img", "vendor_boot.img", OPTIONS.input_tmp,
         "VENDOR_BOOT")
@@ -869,8 +1061,7 @@ def AddImagesToTargetFiles(filename):
         if output_zip:
           vendor_boot_image.AddToZip(output_zip)
 
-  if has_vendor_kernel_boot:
-    banner("vendor_kernel_boot")
+  def add_vendor_kernel_boot(output_zip):
     vendor_kernel_boot_image = common.GetVendorKernelBootImage(
         "IMAGES/vendor_kernel_boot.img", "vendor_kernel_boot.img", OPTIONS.input_tmp,
         "VENDOR_KERNEL_BOOT")
@@ -882,9 +1073,7 @@ def AddImagesToTargetFiles(filename):
         if output_zip:
           vendor_kernel_boot_image.AddToZip(output_zip)
 
-  recovery_image = None
-  if has_recovery:
-    banner("recovery")
+  def add_recovery(output_zip):
     recovery_image = common.GetBootableImage(
         "IMAGES/recovery.img", "recovery.img", OPTIONS.input_tmp, "RECOVERY")
     assert recovery_image, "Failed to create recovery.img."
@@ -907,50 +1096,74 @@ def AddImagesToTargetFiles(filename):
         recovery_two_step_image.WriteToDir(OPTIONS.input_tmp)
         if output_zip:
           recovery_two_step_image.AddToZip(output_zip)
+    return recovery_image
+
+  if has_boot:
+    add_task("boot", add_boot)
+  if has_init_boot:
+    add_task("init_boot", add_init_boot)
+  if has_vendor_boot:
+    add_task("vendor_boot", add_vendor_boot)
+  if has_vendor_kernel_boot:
+    add_task("vendor_kernel_boot", add_vendor_kernel_boot)
+  if has_recovery:
+    add_task("recovery", add_recovery)
 
-  def add_partition(partition, has_partition, add_func, add_args):
-    if has_partition:
-      banner(partition)
+  def add_partition(partition, has_partition, add_func, deps=()):
+    if not has_partition:
+      return
+
+    def run(output_zip):
+      # The images built by the dependencies are passed in as arguments.
+      add_args = [tasks.results[dep] for dep in deps]
       partitions[partition] = add_func(output_zip, *add_args)
+    add_task(partition, run, deps,
+             _GetTreeSize(os.path.join(OPTIONS.input_tmp, partition.upper())))
+
+  # The recovery patch on system (or vendor) needs both recovery and boot.
+  recovery_patch_deps = [
+      name for name, has_image in (("recovery", has_recovery),
+                                   ("boot", has_boot))
+      if has_image]
+  if len(recovery_patch_deps) != 2:
+    recovery_patch_deps = []
 
   add_partition_calls = (
-      ("system", has_system, AddSystem, [recovery_image, boot_image]),
-      ("vendor", has_vendor, AddVendor, [recovery_image, boot_image]),
-      ("product", has_product, AddProduct, []),
-      ("system_ext", has_system_ext, AddSystemExt, []),
-      ("odm", has_odm, AddOdm, []),
-      ("vendor_dlkm", has_vendor_dlkm, AddVendorDlkm, []),
-      ("odm_dlkm", has_odm_dlkm, AddOdmDlkm, []),
-      ("system_dlkm", has_system_dlkm, AddSystemDlkm, []),
-      ("system_other", has_system_other, AddSystemOther, []),
+      ("system", has_system, AddSystem, recovery_patch_deps),
+      ("vendor", has_vendor, AddVendor, recovery_patch_deps),
+      ("product", has_product, AddProduct),
+      ("system_ext", has_system_ext, AddSystemExt),
+      ("odm", has_odm, AddOdm),
+      ("vendor_dlkm", has_vendor_dlkm, AddVendorDlkm),
+      ("odm_dlkm", has_odm_dlkm, AddOdmDlkm),
+      ("system_dlkm", has_system_dlkm, AddSystemDlkm),
+      ("system_other", has_system_other, AddSystemOther),
   )
   for call in add_partition_calls:
     add_partition(*call)
 
-  AddApexInfo(output_zip)
+  add_task("apex_info", AddApexInfo)
 
   if not OPTIONS.is_signing:
-    banner("userdata")
-    AddUserdata(output_zip)
-    banner("cache")
-    AddCache(output_zip)
+    add_task("userdata", AddUserdata)
+    add_task("cache", AddCache)
 
   if OPTIONS.info_dict.get("board_bpt_enable") == "true":
-    banner("partition-table")
-    AddPartitionTable(output_zip)
+    add_task("partition-table", AddPartitionTable)
 
   add_partition("dtbo",
-                OPTIONS.info_dict.get("has_dtbo") == "true", AddDtbo, [])
+                OPTIONS.info_dict.get("has_dtbo") == "true", AddDtbo)
   add_partition("pvmfw",
-                OPTIONS.info_dict.get("has_pvmfw") == "true", AddPvmfw, [])
+                OPTIONS.info_dict.get("has_pvmfw") == "true", AddPvmfw)
 
   # Custom images.
   custom_partitions = OPTIONS.info_dict.get(
       "avb_custom_images_partition_list", "").strip().split()
   for partition_name in custom_partitions:
     partition_name = partition_name.strip()
-    banner("custom images for " + partition_name)
-    partitions[partition_name] = AddCustomImages(output_zip, partition_name)
+    add_partition(partition_name, True,
+                  functools.partial(AddCustomImages,
+                                    partition_name=partition_name))
 
   if OPTIONS.info_dict.get("avb_enable") == "true":
     # vbmeta_partitions includes the partitions that should be included into
@@ -959,11 +1172,17 @@ def AddImagesToTargetFiles(filename):
     # Currently custom_partitions are all chained to VBMeta image.
     vbmeta_partitions = common.AVB_PARTITIONS[:] + tuple(custom_partitions)
 
+    def add_vbmeta(name, needed_partitions):
+      def run(output_zip):
+        partitions[name] = AddVBMeta(
+            output_zip, partitions, name, needed_partitions)
+      # A VBMeta image can only be built once the images it chains are ready.
+      add_task(name, run,
+               [task for task in task_names if task in needed_partitions])
+
     vbmeta_system = OPTIONS.info_dict.get("avb_vbmeta_system", "").strip()
     if vbmeta_system:
-      banner("vbmeta_system")
-      partitions["vbmeta_system"] = AddVBMeta(
-          output_zip, partitions, "vbmeta_system", vbmeta_system.split())
+      add_vbmeta("vbmeta_system", vbmeta_system.split())
       vbmeta_partitions = [
           item for item in vbmeta_partitions
           if item not in vbmeta_system.split()]
@@ -971,17 +1190,24 @@ def AddImagesToTargetFiles(filename):
 
     vbmeta_vendor = OPTIONS.info_dict.get("avb_vbmeta_vendor", "").strip()
     if vbmeta_vendor:
-      banner("vbmeta_vendor")
-      partitions["vbmeta_vendor"] = AddVBMeta(
-          output_zip, partitions, "vbmeta_vendor", vbmeta_vendor.split())
+      add_vbmeta("vbmeta_vendor", vbmeta_vendor.split())
       vbmeta_partitions = [
           item for item in vbmeta_partitions
           if item not in vbmeta_vendor.split()]
       vbmeta_partitions.append("vbmeta_vendor")
 
     if OPTIONS.info_dict.get("avb_building_vbmeta_image") == "true":
-      banner("vbmeta")
-      AddVBMeta(output_zip, partitions, "vbmeta", vbmeta_partitions)
+      add_vbmeta("vbmeta", vbmeta_partitions)
+
+  tasks.budget = max(task_costs) if task_costs else None
+  try:
+    tasks.Run()
+  finally:
+    for name, duration in tasks.durations.items():
+      logger.info("Built %s in %.2fs", name, duration)
+  for task_zip in task_zips:
+    if task_zip:
+      task_zip.Replay()
 
   if OPTIONS.info_dict.get("use_dynamic_partitions") == "true":
     if OPTIONS.info_dict.get("build_super_empty_partition") == "true":
@@ -1020,41 +1246,96 @@ def AddImagesToTargetFiles(filename):
 
   AddVbmetaDigest(output_zip)
 
+  if OPTIONS.image_build_manifest:
+    AddImageBuildManifest(output_zip)
+
   if output_zip:
     common.ZipClose(output_zip)
-    if OPTIONS.replace_updated_files_list:
-      ReplaceUpdatedFiles(output_zip.filename,
-                          OPTIONS.replace_updated_files_list)
+    # Replace the updated files and uncompress the entries that don't compress
+    # well, in a single pass over the archive.
+    OptimizeCompressedEntries(output_zip.filename,
+                              OPTIONS.replace_updated_files_list)
+
+
+def _ShouldStoreUncompressed(zinfo):
+  """Returns whether a ZIP entry doesn't compress well enough to keep it so."""
+  if not zinfo.filename.startswith("IMAGES/") and not zinfo.filename.startswith("META"):
+    return False
+  # Don't try to store userdata.img uncompressed, it's usually huge.
+  if zinfo.filename.endswith("userdata.img"):
+    return False
+  return (zinfo.compress_size > zinfo.file_size * 0.80 and
+          zinfo.compress_type != zipfile.ZIP_STORED)
 
 
-def OptimizeCompressedEntries(zipfile_path):
+@common.Traced
+def OptimizeCompressedEntries(zipfile_path, files_to_replace=None):
   """Convert files that do not compress well to uncompressed storage
 
   EROFS images tend to be compressed already, so compressing them again
   yields little space savings. Leaving them uncompressed will make
   downstream tooling's job easier, and save compute time.
+
+  The decision is made per entry from the sizes in the central directory. The
+  archive is then rewritten in a single streaming pass: the entries to store
+  are inflated straight into their new slots, and all the others are copied
+  over without recompression. Only the new archive takes temp space.
+
+  Args:
+    zipfile_path: The target-files zip; a no-op for directories.
+    files_to_replace: An optional list of entries to be replaced with the files
+        of the same names under OPTIONS.input_tmp, e.g. META/care_map.pb and
+        the related files under SYSTEM/ after rebuilding recovery.
   """
   if not zipfile.is_zipfile(zipfile_path):
     return
-  entries_to_store = []
-  with tempfile.TemporaryDirectory() as tmpdir:
-    with zipfile.ZipFile(zipfile_path, "r", allowZip64=True) as zfp:
-      for zinfo in zfp.filelist:
-        if not zinfo.filename.startswith("IMAGES/") and not zinfo.filename.startswith("META"):
-          continue
-        # Don't try to store userdata.img uncompressed, it's usually huge.
-        if zinfo.filename.endswith("userdata.img"):
-          continue
-        if zinfo.compress_size > zinfo.file_size * 0.80 and zinfo.compress_type != zipfile.ZIP_STORED:
-          entries_to_store.append(zinfo)
-          zfp.extract(zinfo, tmpdir)
-    if len(entries_to_store) == 0:
-      return
-    # Remove these entries, then re-add them as ZIP_STORED
-    ZipDelete(zipfile_path, [entry.filename for entry in entries_to_store])
-    with zipfile.ZipFile(zipfile_path, "a", allowZip64=True) as zfp:
-      for entry in entries_to_store:
-        zfp.write(os.path.join(tmpdir, entry.filename), entry.filename, compress_type=zipfile.ZIP_STORED)
+  # The list may be appended to by images built in parallel, so sort it to
+  # keep the output repeatable.
+  files_to_replace = sorted(set(files_to_replace or []))
+  with zipfile.ZipFile(zipfile_path, "r", allowZip64=True) as zfp:
+    entries_to_store = {zinfo.filename for zinfo in zfp.infolist()
+                        if _ShouldStoreUncompressed(zinfo)}
+  replaced_entries = set(files_to_replace)
+  if not entries_to_store and not files_to_replace:
+    return
+  logger.info("Storing %d entries uncompressed, replacing %d entries",
+              len(entries_to_store), len(files_to_replace))
+
+  # Write the new archive next to the input, so that it can be renamed over.
+  fd, output_path = tempfile.mkstemp(
+      dir=os.path.dirname(os.path.abspath(zipfile_path)), suffix=".zip")
+  os.close(fd)
+  try:
+    input_zip = zipfile.ZipFile(zipfile_path, "r", allowZip64=True)
+    output_zip = zipfile.ZipFile(output_path, "w",
+                                 compression=zipfile.ZIP_DEFLATED,
+                                 allowZip64=True)
+    for zinfo in input_zip.infolist():
+      if zinfo.filename in replaced_entries:
+        continue
+      if zinfo.filename in entries_to_store:
+        out_info = copy.copy(zinfo)
+        out_info.compress_type = zipfile.ZIP_STORED
+        out_info.date_time = (2009, 1, 1, 0, 0, 0)
+        force_zip64 = zinfo.file_size >= (1 << 31) - 1
+        with input_zip.open(zinfo) as src, \
+            output_zip.open(out_info, "w", force_zip64=force_zip64) as dst:
+          shutil.copyfileobj(src, dst, 4 * 1024 * 1024)
+      else:
+        common.ZipCopyRaw(input_zip, output_zip, zinfo)
+
+    for item in files_to_replace:
+      file_path = os.path.join(OPTIONS.input_tmp, item)
+      assert os.path.exists(file_path)
+      common.ZipWrite(output_zip, file_path, arcname=item)
+    common.ZipClose(output_zip)
+    input_zip.close()
+    # mkstemp() creates the file as 0600; keep the mode of the input.
+    shutil.copymode(zipfile_path, output_path)
+    os.replace(output_path, zipfile_path)
+  finally:
+    if os.path.exists(output_path):
+      os.remove(output_path)
 
 
 def main(argv):
@@ -1069,16 +1350,22 @@ def main(argv):
       OPTIONS.replace_verity_public_key = (True, a)
     elif o == "--is_signing":
       OPTIONS.is_signing = True
+    elif o in ("-t", "--worker_threads"):
+      OPTIONS.worker_threads = int(a)
     else:
       return False
     return True
 
+  # Library callers (e.g. sign_target_files_apks) keep building the images one
+  # at a time, unless they set OPTIONS.worker_threads.
+  OPTIONS.worker_threads = max(multiprocessing.cpu_count() // 2, 1)
+
   args = common.ParseOptions(
-      argv, __doc__, extra_opts="ar",
+      argv, __doc__, extra_opts="art:",
       extra_long_opts=["add_missing", "rebuild_recovery",
                        "replace_verity_public_key=",
                        "replace_verity_private_key=",
-                       "is_signing"],
+                       "is_signing", "worker_threads="],
       extra_option_handler=option_handler)
 
   if len(args) != 1:
@@ -1088,7 +1375,6 @@ def main(argv):
   common.InitLogging()
 
   AddImagesToTargetFiles(args[0])
-  OptimizeCompressedEntries(args[0])
   logger.info("done.")
 
 
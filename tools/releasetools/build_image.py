@@ -31,6 +31,7 @@ import os.path
 import re
 import shutil
 import sys
+import time
 
 import common
 import verity_utils
@@ -40,6 +41,9 @@ logger = logging.getLogger(__name__)
 OPTIONS = common.OPTIONS
 BLOCK_SIZE = common.BLOCK_SIZE
 BYTES_IN_MB = 1024 * 1024
+# The number of blocks by which a single-pass ext4 image may have more free
+# space than estimated, before it gets shrunk like a first pass instead.
+EXT4_ESTIMATE_SLACK_BLOCKS = 8
 
 
 class BuildImageError(Exception):
@@ -58,9 +62,7 @@ def GetDiskUsage(path):
   Returns:
     The number of bytes based on a 1K block_size.
   """
-  cmd = ["du", "-b", "-k", "-s", path]
-  output = common.RunAndCheckOutput(cmd, verbose=False)
-  return int(output.split()[0]) * 1024
+  return common.ScanDiskUsage(path).size
 
 
 def GetInodeUsage(path):
@@ -72,10 +74,8 @@ def GetInodeUsage(path):
   Returns:
     The number of inodes used.
   """
-  cmd = ["find", path, "-print"]
-  output = common.RunAndCheckOutput(cmd, verbose=False)
   # increase by > 6% as number of files and directories is not whole picture.
-  inodes = output.count('\n')
+  inodes = common.ScanDiskUsage(path).inodes
   spare_inodes = inodes * 6 // 100
   min_spare_inodes = 12
   if spare_inodes < min_spare_inodes:
@@ -476,6 +476,346 @@ def RunErofsFsck(out_file):
     raise
 
 
+class Ext4Estimate(object):
+  """The predicted size of an ext4 image, as given by EstimateExt4Image().
+
+  Attributes:
+    used_blocks: The number of blocks that the files and the filesystem
+        metadata are expected to take.
+    block_size: The filesystem block size.
+    size: The partition size in bytes, with the reserved space added as the
+        second pass of BuildImage() would.
+    inodes: The inode count to build the image with, with the same margin as
+        the second pass of BuildImage().
+    reserved_size: The free space in bytes that the image needs to keep at
+        least, i.e. the reserved size or the .3% margin.
+  """
+
+  def __init__(self, used_blocks, block_size, size, inodes, reserved_size):
+    self.used_blocks = used_blocks
+    self.block_size = block_size
+    self.size = size
+    self.inodes = inodes
+    self.reserved_size = reserved_size
+
+
+def _ScanExt4Tree(path, block_size):
+  """Returns the (blocks, inodes) that the entries under path take in ext4."""
+  blocks = 0
+  inodes = 0
+  # '.' and '..' take 12 bytes each.
+  dir_bytes = 24
+  with os.scandir(path) as entries:
+    for entry in entries:
+      inodes += 1
+      # Each directory entry has an 8-byte header, and the name padded to 4.
+      dir_bytes += 8 + (len(entry.name.encode()) + 3) // 4 * 4
+      st = entry.stat(follow_symlinks=False)
+      if entry.is_dir(follow_symlinks=False):
+        subdir_blocks, subdir_inodes = _ScanExt4Tree(entry.path, block_size)
+        blocks += subdir_blocks
+        inodes += subdir_inodes
+      elif entry.is_symlink():
+        # Targets shorter than 60 bytes are stored in the inode itself.
+        if st.st_size >= 60:
+          blocks += 1
+      else:
+        file_blocks = (st.st_size + block_size - 1) // block_size
+        # An inode holds up to 4 extents of up to 32768 blocks each. Larger
+        # files need extent tree blocks, each holding 340 extents.
+        extents = (file_blocks + 32767) // 32768
+        if extents > 4:
+          file_blocks += (extents + 339) // 340
+        blocks += file_blocks
+  # Entries don't span blocks. Directories with more than one block get an
+  # htree index block on top.
+  dir_blocks = (dir_bytes + block_size - 1) // block_size
+  if dir_blocks > 1:
+    dir_blocks += 1 + dir_blocks // 8
+  return blocks + dir_blocks, inodes
+
+
+def _GetExt4MetadataBlocks(total_blocks, inodes, inode_size, block_size):
+  """Returns the blocks taken by the superblocks, bitmaps and inode tables."""
+  blocks_per_group = block_size * 8
+  groups = (total_blocks + blocks_per_group - 1) // blocks_per_group
+  inodes_per_block = block_size // inode_size
+  inodes_per_group = (inodes + groups - 1) // groups
+  # mke2fs rounds it up to fill up the inode table blocks and the bitmap bytes.
+  align = max(inodes_per_block, 8)
+  inodes_per_group = (inodes_per_group + align - 1) // align * align
+  inode_table_blocks = inodes_per_group // inodes_per_block
+
+  # With sparse_super, groups 0, 1 and the powers of 3, 5 and 7 carry a copy
+  # of the superblock and the group descriptors (64 bytes each at most).
+  backups = set([0, 1])
+  for base in (3, 5, 7):
+    power = base
+    while power < groups:
+      backups.add(power)
+      power *= base
+  backups = [group for group in backups if group < groups]
+  gdt_blocks = (groups * 64 + block_size - 1) // block_size
+
+  return (groups * (2 + inode_table_blocks) +
+          len(backups) * (1 + gdt_blocks))
+
+
+def EstimateExt4Image(in_dir, prop_dict):
+  """Predicts the size of the ext4 image to be built from in_dir.
+
+  It counts the blocks for the file contents, the directories, the journal
+  and the per-group metadata, so that the image can be built at its final
+  size right away, skipping the first pass in BuildImage(). The estimate isn't
+  exact, and BuildImage() checks the built image against it.
+
+  Args:
+    in_dir: Path to input directory.
+    prop_dict: A property dict that contains info like the journal size.
+
+  Returns:
+    An Ext4Estimate instance, or None if the estimation doesn't apply to the
+    given properties.
+  """
+  # The base fs and deduplication change the block allocation in ways that
+  # can't be predicted from the tree.
+  if ("base_fs_file" in prop_dict or
+          prop_dict.get("ext4_share_dup_blocks") == "true"):
+    return None
+
+  block_size = BLOCK_SIZE
+  inode_size = 512 if prop_dict.get("needs_projid") else 256
+  data_blocks, entries = _ScanExt4Tree(in_dir, block_size)
+  # Inodes 1-10 are reserved (with the root directory as inode 2), followed by
+  # lost+found, which mke2fs creates with 4 blocks.
+  used_inodes = entries + 11
+  data_blocks += 4
+  journal_blocks = (int(prop_dict.get("journal_size", 0)) * BYTES_IN_MB //
+                    block_size)
+
+  if "extfs_inode_count" in prop_dict:
+    inodes = int(prop_dict["extfs_inode_count"])
+  else:
+    # Same margin as the second pass: .2% or 1 inode, whichever is greater.
+    inodes = used_inodes + max(used_inodes * 2 // 1000, 1)
+
+  reserved_size = int(prop_dict.get("partition_reserved_size", 0))
+  partition_headroom = int(prop_dict.get("partition_headroom", 0))
+  if prop_dict.get("fs_type", "").startswith("ext4"):
+    reserved_size = max(reserved_size, partition_headroom)
+
+  # The metadata depends on the number of groups, which in turn depends on the
+  # total size. It converges in a few rounds.
+  used_blocks = data_blocks + journal_blocks
+  size = 0
+  for _ in range(4):
+    total_blocks = max(used_blocks, size // block_size)
+    used_blocks = data_blocks + journal_blocks + _GetExt4MetadataBlocks(
+        total_blocks, inodes, inode_size, block_size)
+    if not reserved_size:
+      # add .3% margin
+      margin = used_blocks * block_size * 3 // 1000
+    else:
+      margin = reserved_size
+    size = used_blocks * block_size + margin
+    size = common.RoundUpTo4K(max(size, 256 * 1024))
+
+  return Ext4Estimate(used_blocks, block_size, size, inodes, margin)
+
+
+def _ParseExt4Stats(mkfs_output):
+  """Returns the characteristics in the summary line from mkuserimg_mke2fs.
+
+  Returns:
+    A dict in the same format as GetFilesystemCharacteristics(), or None if
+    the summary line isn't found.
+  """
+  m = re.search(
+      r'Created filesystem with (?P<used_inodes>[0-9]+)/'
+      r'(?P<total_inodes>[0-9]+) inodes and (?P<used_blocks>[0-9]+)/'
+      r'(?P<total_blocks>[0-9]+) blocks', mkfs_output or '')
+  if not m:
+    return None
+  stats = {key: int(value) for key, value in m.groupdict().items()}
+  return {
+      "Block size": str(BLOCK_SIZE),
+      "Block count": str(stats["total_blocks"]),
+      "Free blocks": str(stats["total_blocks"] - stats["used_blocks"]),
+      "Inode count": str(stats["total_inodes"]),
+      "Free inodes": str(stats["total_inodes"] - stats["used_inodes"]),
+  }
+
+
+def _ShrinkExt4Size(size, fs_dict, prop_dict):
+  """Shrinks the ext4 size and inode count based on a first pass image.
+
+  Args:
+    size: The size that the first pass image was built with.
+    fs_dict: The characteristics of the first pass image.
+    prop_dict: The property dict. "extfs_inode_count" will be updated.
+
+  Returns:
+    The size for the final image.
+  """
+  fs_type = prop_dict.get("fs_type", "")
+  block_size = int(fs_dict.get("Block size", "4096"))
+  free_size = int(fs_dict.get("Free blocks", "0")) * block_size
+  reserved_size = int(prop_dict.get("partition_reserved_size", 0))
+  partition_headroom = int(prop_dict.get("partition_headroom", 0))
+  if fs_type.startswith("ext4") and partition_headroom > reserved_size:
+    reserved_size = partition_headroom
+  if free_size <= reserved_size:
+    logger.info(
+        "Not worth reducing image %d <= %d.", free_size, reserved_size)
+  else:
+    size -= free_size
+    size += reserved_size
+    if reserved_size == 0:
+      # add .3% margin
+      size = size * 1003 // 1000
+    # Use a minimum size, otherwise we will fail to calculate an AVB footer
+    # or fail to construct an ext4 image.
+    size = max(size, 256 * 1024)
+    if block_size <= 4096:
+      size = common.RoundUpTo4K(size)
+    else:
+      size = ((size + block_size - 1) // block_size) * block_size
+  extfs_inode_count = prop_dict["extfs_inode_count"]
+  inodes = int(fs_dict.get("Inode count", extfs_inode_count))
+  inodes -= int(fs_dict.get("Free inodes", "0"))
+  # add .2% margin or 1 inode, whichever is greater
+  spare_inodes = inodes * 2 // 1000
+  min_spare_inodes = 1
+  if spare_inodes < min_spare_inodes:
+    spare_inodes = min_spare_inodes
+  inodes += spare_inodes
+  prop_dict["extfs_inode_count"] = str(inodes)
+  return size
+
+
+def _CheckExt4Estimate(estimate, fs_dict, name, elapsed):
+  """Checks a single-pass ext4 image against its estimate.
+
+  The image is good to keep if its free space covers the reserved space, and
+  it doesn't exceed the estimated free space by more than
+  EXT4_ESTIMATE_SLACK_BLOCKS. Otherwise it would be larger than the image that
+  _ShrinkExt4Size() gives.
+
+  Returns:
+    Whether the image can be used as is.
+  """
+  block_size = int(fs_dict["Block size"])
+  total_blocks = int(fs_dict["Block count"])
+  free_blocks = int(fs_dict["Free blocks"])
+  used_blocks = total_blocks - free_blocks
+  logger.info(
+      "Estimated %d blocks for %s, %d used (%+.2f%%).", estimate.used_blocks,
+      name, used_blocks,
+      (estimate.used_blocks - used_blocks) * 100.0 / used_blocks)
+
+  free_size = free_blocks * block_size
+  max_free_size = (estimate.size - estimate.used_blocks * block_size +
+                   EXT4_ESTIMATE_SLACK_BLOCKS * block_size)
+  if (int(fs_dict["Free inodes"]) == 0 or
+          not estimate.reserved_size <= free_size <= max_free_size):
+    logger.info(
+        "Estimate missed for %s (%d bytes free, %d reserved); shrinking it "
+        "as a first pass.", name, free_size, estimate.reserved_size)
+    return False
+
+  logger.info("Skipped the first pass for %s, saving %.1fs.", name, elapsed)
+  return True
+
+
+def BuildExt4FirstPass(in_dir, prop_dict, out_file, target_out, fs_config,
+                       size):
+  """Builds a trial ext4 image to find out the size the files actually take.
+
+  Args:
+    in_dir: Path to input directory.
+    prop_dict: The property dict. "extfs_inode_count" will be updated.
+    out_file: The output image file, which will be removed afterwards.
+    target_out: Path to the TARGET_OUT directory as in Makefile.
+    fs_config: The fs_config file that drives the prototype.
+    size: The estimated size to build the trial image with.
+
+  Returns:
+    The size for the final image.
+  """
+  prop_dict["partition_size"] = str(size)
+  prop_dict["image_size"] = str(size)
+  if "extfs_inode_count" not in prop_dict:
+    prop_dict["extfs_inode_count"] = str(GetInodeUsage(in_dir))
+  logger.info(
+      "First Pass based on estimates of %d MB and %s inodes.",
+      size // BYTES_IN_MB, prop_dict["extfs_inode_count"])
+  BuildImageMkfs(in_dir, prop_dict, out_file, target_out, fs_config)
+  sparse_image = False
+  if "extfs_sparse_flag" in prop_dict and "disable_sparse" not in prop_dict:
+    sparse_image = True
+  fs_dict = GetFilesystemCharacteristics(
+      prop_dict["fs_type"], out_file, sparse_image)
+  os.remove(out_file)
+  return _ShrinkExt4Size(size, fs_dict, prop_dict)
+
+
+def BuildExt4ImageWithEstimate(in_dir, prop_dict, out_file, target_out,
+                               fs_config, estimate, verity_image_builder):
+  """Builds an ext4 image in a single pass, at the size from the estimate.
+
+  If the built image turns out to miss the estimate, it serves as the first
+  pass instead, and gets removed.
+
+  Args:
+    in_dir: Path to input directory.
+    prop_dict: The property dict. Values will be updated with computed values.
+    out_file: The output image file.
+    target_out: Path to the TARGET_OUT directory as in Makefile.
+    fs_config: The fs_config file that drives the prototype.
+    estimate: The Ext4Estimate from EstimateExt4Image().
+    verity_image_builder: The VerityImageBuilder for the image, or None.
+
+  Returns:
+    A tuple of (mkfs_output, size). On a miss, mkfs_output is None, and size
+    is what the first pass gives for the final image.
+
+  Raises:
+    ExternalError: If mkfs fails, e.g. for running out of space.
+  """
+  size = estimate.size
+  prop_dict["extfs_inode_count"] = str(estimate.inodes)
+  partition_size = size
+  if verity_image_builder:
+    partition_size = verity_image_builder.CalculateDynamicPartitionSize(size)
+  prop_dict["partition_size"] = str(partition_size)
+  prop_dict["image_size"] = str(partition_size)
+  if verity_image_builder:
+    prop_dict["image_size"] = str(verity_image_builder.CalculateMaxImageSize())
+  logger.info(
+      "Single pass based on estimates of %d MB and %d inodes.",
+      size // BYTES_IN_MB, estimate.inodes)
+
+  start = time.time()
+  mkfs_output = BuildImageMkfs(in_dir, prop_dict, out_file, target_out,
+                               fs_config)
+  elapsed = time.time() - start
+
+  fs_dict = _ParseExt4Stats(mkfs_output)
+  if fs_dict is None:
+    sparse_image = ("extfs_sparse_flag" in prop_dict and
+                    "disable_sparse" not in prop_dict)
+    fs_dict = GetFilesystemCharacteristics(
+        prop_dict["fs_type"], out_file, sparse_image)
+  if _CheckExt4Estimate(estimate, fs_dict, os.path.basename(out_file),
+                        elapsed):
+    return mkfs_output, size
+
+  os.remove(out_file)
+  built_size = int(fs_dict["Block count"]) * int(fs_dict["Block size"])
+  return None, _ShrinkExt4Size(built_size, fs_dict, prop_dict)
+
+
+@common.Traced
 def BuildImage(in_dir, prop_dict, out_file, target_out=None):
   """Builds an image for the files under in_dir and writes it to out_file.
 
@@ -529,54 +869,33 @@ def BuildImage(in_dir, prop_dict, out_file, target_out=None):
     # Round this up to a multiple of 4K so that avbtool works
     size = common.RoundUpTo4K(size)
     if fs_type.startswith("ext"):
-      prop_dict["partition_size"] = str(size)
-      prop_dict["image_size"] = str(size)
-      if "extfs_inode_count" not in prop_dict:
-        prop_dict["extfs_inode_count"] = str(GetInodeUsage(in_dir))
-      logger.info(
-          "First Pass based on estimates of %d MB and %s inodes.",
-          size // BYTES_IN_MB, prop_dict["extfs_inode_count"])
-      BuildImageMkfs(in_dir, prop_dict, out_file, target_out, fs_config)
-      sparse_image = False
-      if "extfs_sparse_flag" in prop_dict and not disable_sparse:
-        sparse_image = True
-      fs_dict = GetFilesystemCharacteristics(fs_type, out_file, sparse_image)
-      os.remove(out_file)
-      block_size = int(fs_dict.get("Block size", "4096"))
-      free_size = int(fs_dict.get("Free blocks", "0")) * block_size
-      reserved_size = int(prop_dict.get("partition_reserved_size", 0))
-      partition_headroom = int(fs_dict.get("partition_headroom", 0))
-      if fs_type.startswith("ext4") and partition_headroom > reserved_size:
-        reserved_size = partition_headroom
-      if free_size <= reserved_size:
-        logger.info(
-            "Not worth reducing image %d <= %d.", free_size, reserved_size)
-      else:
-        size -= free_size
-        size += reserved_size
-        if reserved_size == 0:
-          # add .3% margin
-          size = size * 1003 // 1000
-        # Use a minimum size, otherwise we will fail to calculate an AVB footer
-        # or fail to construct an ext4 image.
-        size = max(size, 256 * 1024)
-        if block_size <= 4096:
-          size = common.RoundUpTo4K(size)
+      ext4_estimate = EstimateExt4Image(in_dir, prop_dict)
+      if ext4_estimate:
+        saved_inode_count = prop_dict.get("extfs_inode_count")
+        try:
+          mkfs_output, ext4_size = BuildExt4ImageWithEstimate(
+              in_dir, prop_dict, out_file, target_out, fs_config,
+              ext4_estimate, verity_image_builder)
+        except common.ExternalError:
+          logger.warning(
+              "Failed to build %s at the estimated size; falling back to two "
+              "passes.", out_file)
+          if os.path.exists(out_file):
+            os.remove(out_file)
+          if saved_inode_count is None:
+            del prop_dict["extfs_inode_count"]
+          else:
+            prop_dict["extfs_inode_count"] = saved_inode_count
+          ext4_estimate = None
         else:
-          size = ((size + block_size - 1) // block_size) * block_size
-      extfs_inode_count = prop_dict["extfs_inode_count"]
-      inodes = int(fs_dict.get("Inode count", extfs_inode_count))
-      inodes -= int(fs_dict.get("Free inodes", "0"))
-      # add .2% margin or 1 inode, whichever is greater
-      spare_inodes = inodes * 2 // 1000
-      min_spare_inodes = 1
-      if spare_inodes < min_spare_inodes:
-        spare_inodes = min_spare_inodes
-      inodes += spare_inodes
-      prop_dict["extfs_inode_count"] = str(inodes)
+          size = ext4_size
+      if not ext4_estimate:
+        size = BuildExt4FirstPass(
+            in_dir, prop_dict, out_file, target_out, fs_config, size)
       prop_dict["partition_size"] = str(size)
       logger.info(
-          "Allocating %d Inodes for %s.", inodes, out_file)
+          "Allocating %s Inodes for %s.", prop_dict["extfs_inode_count"],
+          out_file)
     elif fs_type.startswith("f2fs") and prop_dict.get("f2fs_compress") == "true":
       prop_dict["partition_size"] = str(size)
       prop_dict["image_size"] = str(size)
@@ -178,6 +178,7 @@ def BuildSuperImageFromTargetFiles(inp, out):
   return BuildSuperImageFromExtractedTargetFiles(input_tmp, out)
 
 
+@common.Traced
 def BuildSuperImage(inp, out):
 
   if isinstance(inp, dict):
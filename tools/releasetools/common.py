@@ -14,12 +14,15 @@
 
 from __future__ import print_function
 
+import atexit
 import base64
 import collections
+import contextlib
 import copy
 import datetime
 import errno
 import fnmatch
+import functools
 import getopt
 import getpass
 import gzip
@@ -32,12 +35,15 @@ import platform
 import re
 import shlex
 import shutil
+import stat
+import struct
 import subprocess
 import sys
 import tempfile
 import threading
 import time
 import zipfile
+import zlib
 from hashlib import sha1, sha256
 
 import images
@@ -96,6 +102,7 @@ class Options(object):
     self.cache_size = None
     self.stash_threshold = 0.8
     self.logfile = None
+    self.trace_file = None
     self.host_tools = {}
 
 
@@ -249,6 +256,204 @@ def FindHostToolPath(tool_name):
   return tool_name
 
 
+class Tracer(object):
+  """Records the phases of a run, and the external commands in each of them.
+
+  The trace is written in the Chrome trace event format, which loads in
+  chrome://tracing or ui.perfetto.dev. Phases are recorded per thread, so that
+  the images built in parallel show up side by side. Each command records its
+  argv, wall and CPU time, the bytes it read from and wrote to disk (as counted
+  by its rusage) and the phase that started it.
+  """
+
+  def __init__(self, trace_file):
+    self.trace_file = trace_file
+    self.events = []
+    self._start = time.time()
+    self._lock = threading.Lock()
+    self._local = threading.local()
+
+  def _AddEvent(self, name, category, start, duration, event_args):
+    event = {
+        "name": name,
+        "cat": category,
+        "ph": "X",
+        "ts": int((start - self._start) * 1e6),
+        "dur": int(duration * 1e6),
+        "pid": os.getpid(),
+        "tid": threading.current_thread().ident,
+        "args": event_args,
+    }
+    with self._lock:
+      self.events.append(event)
+
+  def CurrentPhase(self):
+    phases = getattr(self._local, "phases", None)
+    return phases[-1] if phases else None
+
+  @contextlib.contextmanager
+  def Phase(self, name):
+    if not hasattr(self._local, "phases"):
+      self._local.phases = []
+    parent = self.CurrentPhase()
+    self._local.phases.append(name)
+    start = time.time()
+    try:
+      yield
+    finally:
+      self._local.phases.pop()
+      self._AddEvent(name, "phase", start, time.time() - start,
+                     {"parent": parent})
+
+  def RecordCommand(self, args, parent, start, rusage):
+    # args is a string with shell=True, or a sequence of str, bytes or paths.
+    if isinstance(args, (str, bytes)):
+      argv = shlex.split(os.fsdecode(args))
+    else:
+      argv = [os.fsdecode(arg) for arg in args]
+    # ru_inblock and ru_oublock are in 512-byte units.
+    self._AddEvent(
+        os.path.basename(argv[0]) if argv else "", "command", start,
+        time.time() - start, {
+            "argv": argv,
+            "parent": parent,
+            "cpu_time": rusage.ru_utime + rusage.ru_stime,
+            "bytes_read": rusage.ru_inblock * 512,
+            "bytes_written": rusage.ru_oublock * 512,
+        })
+
+  def GetHotspots(self):
+    """Returns the phases and commands by name, the slowest first.
+
+    Returns:
+      A list of (name, category, count, wall_time, cpu_time) tuples, sorted by
+      the total wall time. cpu_time is only tracked for commands.
+    """
+    hotspots = {}
+    with self._lock:
+      events = list(self.events)
+    for event in events:
+      key = (event["name"], event["cat"])
+      count, wall_time, cpu_time = hotspots.get(key, (0, 0, 0))
+      hotspots[key] = (count + 1, wall_time + event["dur"] / 1e6,
+                       cpu_time + event["args"].get("cpu_time", 0))
+    return sorted(
+        [key + value for key, value in hotspots.items()],
+        key=lambda hotspot: hotspot[3], reverse=True)
+
+  def Write(self):
+    with self._lock:
+      events = list(self.events)
+    with open(self.trace_file, "w") as f:
+      json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+    # The summary is printed regardless of the logging level, as it's what
+    # --trace_file asks for.
+    print("Wrote the trace to {}. Hotspots:".format(self.trace_file),
+          file=sys.stderr)
+    for name, category, count, wall_time, cpu_time in self.GetHotspots()[:20]:
+      print("  {:9.2f}s wall {:9.2f}s cpu {:5d}x {:<7} {}".format(
+          wall_time, cpu_time, count, category, name), file=sys.stderr)
+
+
+# The tracer of the run, if --trace_file is given.
+_tracer = None
+
+
+def StartTracing(trace_file):
+  """Starts tracing the run, and writes the trace to trace_file at exit."""
+  global _tracer
+  _tracer = Tracer(trace_file)
+  atexit.register(StopTracing)
+
+
+def StopTracing():
+  """Stops tracing, and writes the trace if it was started."""
+  global _tracer
+  tracer, _tracer = _tracer, None
+  if tracer:
+    tracer.Write()
+
+
+def TracePhase(name):
+  """Returns a context manager that traces its body as a phase named name."""
+  if not _tracer:
+    return contextlib.nullcontext()
+  return _tracer.Phase(name)
+
+
+def Traced(func):
+  """Decorator that traces each call to func as a phase."""
+  @functools.wraps(func)
+  def Wrapper(*args, **kwargs):
+    with TracePhase(func.__name__):
+      return func(*args, **kwargs)
+  return Wrapper
+
+
+class _TracedPopen(subprocess.Popen):
+  """A Popen that records the command to the tracer when it's reaped.
+
+  It reaps the process with os.wait4() in poll() and wait(), so that the rusage
+  of each command is its own, even when several of them run in parallel. Only
+  the public Popen API is overridden: communicate(), the context manager and
+  the module-level helpers all go through wait(). A command is not recorded if
+  something else reaps it, e.g. os.wait() from outside of subprocess.
+  """
+
+  def __init__(self, args, **kwargs):
+    self._tracer = _tracer
+    self._trace_parent = _tracer.CurrentPhase()
+    self._trace_start = time.time()
+    self._trace_lock = threading.Lock()
+    super(_TracedPopen, self).__init__(args, **kwargs)
+
+  def _Reap(self, wait_flags):
+    """Reaps the process with os.wait4(), and records it to the tracer.
+
+    The caller must hold _trace_lock. Returns False if the process has been
+    reaped elsewhere.
+    """
+    try:
+      pid, sts, rusage = os.wait4(self.pid, wait_flags)
+    except ChildProcessError:
+      return False
+    if pid == self.pid:
+      self.returncode = os.waitstatus_to_exitcode(sts)
+      self._tracer.RecordCommand(
+          self.args, self._trace_parent, self._trace_start, rusage)
+    return True
+
+  def poll(self):
+    # Doesn't block if another thread is waiting for the process.
+    if self.returncode is None and self._trace_lock.acquire(blocking=False):
+      try:
+        if self.returncode is None and not self._Reap(os.WNOHANG):
+          # Lets Popen set the returncode, as it does in that case.
+          super(_TracedPopen, self).poll()
+      finally:
+        self._trace_lock.release()
+    return self.returncode
+
+  def wait(self, timeout=None):
+    if timeout is None:
+      with self._trace_lock:
+        if self.returncode is None and not self._Reap(0):
+          super(_TracedPopen, self).wait()
+      return self.returncode
+
+    # Same as Popen.wait() with a timeout: polls with a growing delay.
+    endtime = time.monotonic() + timeout
+    delay = 0.0005
+    while self.poll() is None:
+      remaining = endtime - time.monotonic()
+      if remaining <= 0:
+        raise subprocess.TimeoutExpired(self.args, timeout)
+      delay = min(delay * 2, remaining, .05)
+      time.sleep(delay)
+    return self.returncode
+
+
 def Run(args, verbose=None, **kwargs):
   """Creates and returns a subprocess.Popen object.
 
@@ -282,6 +487,8 @@ def Run(args, verbose=None, **kwargs):
   # Don't log any if caller explicitly says so.
   if verbose:
     logger.info("  Running: \"%s\"", " ".join(args))
+  if _tracer:
+    return _TracedPopen(args, **kwargs)
   return subprocess.Popen(args, **kwargs)
 
 
@@ -2528,6 +2735,10 @@ Global options
 
   --logfile <file>
       Put verbose logs to specified file (regardless of --verbose option.)
+
+  --trace_file <file>
+      Write a Chrome trace (JSON) of the phases and the external commands of
+      the run to the specified file, and log the slowest ones at exit.
 """
 
 
@@ -2554,7 +2765,7 @@ def ParseOptions(argv,
          "java_path=", "java_args=", "android_jar_path=", "public_key_suffix=",
          "private_key_suffix=", "boot_signer_path=", "boot_signer_args=",
          "verity_signer_path=", "verity_signer_args=", "device_specific=",
-         "extra=", "logfile="] + list(extra_long_opts))
+         "extra=", "logfile=", "trace_file="] + list(extra_long_opts))
   except getopt.GetoptError as err:
     Usage(docstring)
     print("**", str(err), "**")
@@ -2601,6 +2812,8 @@ def ParseOptions(argv,
       OPTIONS.extras[key] = value
     elif o in ("--logfile",):
       OPTIONS.logfile = a
+    elif o in ("--trace_file",):
+      OPTIONS.trace_file = a
     else:
       if extra_option_handler is None or not extra_option_handler(o, a):
         assert False, "unknown option \"%s\"" % (o,)
@@ -2609,6 +2822,9 @@ def ParseOptions(argv,
     os.environ["PATH"] = (os.path.join(OPTIONS.search_path, "bin") +
                           os.pathsep + os.environ["PATH"])
 
+  if OPTIONS.trace_file:
+    StartTracing(OPTIONS.trace_file)
+
   return args
 
 
@@ -2641,6 +2857,139 @@ def Cleanup():
   del OPTIONS.tempfiles[:]
 
 
+def RemoveTempFile(filename):
+  """Removes a temp file early, instead of waiting for Cleanup()."""
+  if filename in OPTIONS.tempfiles:
+    OPTIONS.tempfiles.remove(filename)
+  if os.path.exists(filename):
+    os.remove(filename)
+
+
+class DiskUsage(object):
+  """The space that a file or a directory tree occupies on host.
+
+  Attributes:
+    apparent_size: The total size of the files and directories in bytes, with
+        the hard-linked files counted once, as 'du -b' does.
+    size: apparent_size rounded up to 1K blocks, as 'du -b -k' reports it.
+    inodes: The number of files and directories, including the path itself,
+        i.e. the number of lines from 'find'.
+    dirs: A dict from the relative paths of the directories (including '.'
+        for the path itself) to their (apparent_size, inodes), as if they were
+        scanned on their own.
+  """
+
+  def __init__(self, apparent_size, inodes, dirs):
+    self.apparent_size = apparent_size
+    self.size = (apparent_size + 1023) // 1024 * 1024
+    self.inodes = inodes
+    self.dirs = dirs
+
+
+# The DiskUsage of the scanned directories, keyed by their real paths. Each
+# entry also keeps the mtimes of all the directories in the tree, so that it
+# gets invalidated once any file is added, removed or renamed.
+_disk_usage_cache = {}
+
+
+def _ScanDirectory(path, relpath, dir_stat, dirs, mtimes):
+  """Scans a directory tree for ScanDiskUsage().
+
+  Returns:
+    A tuple of (size, inodes, links) of the tree, where links maps the
+    (st_dev, st_ino) of the hard-linked files to their sizes. The sizes of the
+    hard-linked files aren't included in size, so that they can be counted
+    once.
+  """
+  size = dir_stat.st_size
+  inodes = 1
+  links = {}
+  mtimes[relpath] = dir_stat.st_mtime_ns
+  with os.scandir(path) as entries:
+    for entry in entries:
+      st = entry.stat(follow_symlinks=False)
+      if entry.is_dir(follow_symlinks=False):
+        subdir_size, subdir_inodes, subdir_links = _ScanDirectory(
+            entry.path, os.path.join(relpath, entry.name), st, dirs, mtimes)
+        size += subdir_size
+        inodes += subdir_inodes
+        links.update(subdir_links)
+      elif st.st_nlink > 1:
+        inodes += 1
+        links[(st.st_dev, st.st_ino)] = st.st_size
+      else:
+        inodes += 1
+        size += st.st_size
+  dirs[relpath] = (size + sum(links.values()), inodes)
+  return size, inodes, links
+
+
+def ScanDiskUsage(path, num_threads=1):
+  """Returns the DiskUsage of a file or a directory tree.
+
+  This gives the results of 'du -b -k -s' and 'find' in a single pass over the
+  tree. Directories are cached until any directory in the tree changes, so the
+  repeated calls while building an image are free. Note that files that are
+  rewritten in place (without being renamed) don't invalidate the cache.
+
+  Args:
+    path: The directory or file to scan.
+    num_threads: The number of threads to scan the top-level subdirectories
+        with.
+
+  Returns:
+    A DiskUsage instance.
+  """
+  st = os.lstat(path)
+  if not stat.S_ISDIR(st.st_mode):
+    return DiskUsage(st.st_size, 1, {})
+
+  real_path = os.path.realpath(path)
+  cached = _disk_usage_cache.get(real_path)
+  if cached:
+    cached_mtimes, usage = cached
+    try:
+      if all(os.stat(os.path.join(real_path, relpath)).st_mtime_ns == mtime
+             for relpath, mtime in cached_mtimes.items()):
+        return usage
+    except OSError:
+      pass
+
+  dirs = {}
+  mtimes = {'.': st.st_mtime_ns}
+  size = st.st_size
+  inodes = 1
+  links = {}
+  with os.scandir(real_path) as scanner:
+    entries = sorted(scanner, key=lambda entry: entry.name)
+
+  # Scan the top-level subdirectories as separate tasks, so that they can go
+  # in parallel.
+  tasks = TaskGraph(num_workers=num_threads)
+  for entry in entries:
+    entry_st = entry.stat(follow_symlinks=False)
+    if entry.is_dir(follow_symlinks=False):
+      tasks.AddTask(entry.name, functools.partial(
+          _ScanDirectory, entry.path, entry.name, entry_st, dirs, mtimes))
+      continue
+    inodes += 1
+    if entry_st.st_nlink > 1:
+      links[(entry_st.st_dev, entry_st.st_ino)] = entry_st.st_size
+    else:
+      size += entry_st.st_size
+
+  for subdir_size, subdir_inodes, subdir_links in tasks.Run().values():
+    size += subdir_size
+    inodes += subdir_inodes
+    links.update(subdir_links)
+  apparent_size = size + sum(links.values())
+  dirs['.'] = (apparent_size, inodes)
+
+  usage = DiskUsage(apparent_size, inodes, dirs)
+  _disk_usage_cache[real_path] = (mtimes, usage)
+  return usage
+
+
 class PasswordManager(object):
   def __init__(self):
     self.editor = os.getenv("EDITOR")
@@ -2744,6 +3093,12 @@ class PasswordManager(object):
     return result
 
 
+# zipfile.ZIP64_LIMIT is process-wide, so the functions that temporarily raise
+# it must not interleave, e.g. when images are built in parallel. Every
+# function that changes ZIP64_LIMIT holds this lock while doing so.
+_ZIP64_LIMIT_LOCK = threading.RLock()
+
+
 def ZipWrite(zip_file, filename, arcname=None, perms=0o644,
              compress_type=None):
 
@@ -2756,35 +3111,36 @@ def ZipWrite(zip_file, filename, arcname=None, perms=0o644,
   # `zipfile.write()` must be used directly to work around this.
   #
   # This mess can be avoided if we port to python3.
-  saved_zip64_limit = zipfile.ZIP64_LIMIT
-  zipfile.ZIP64_LIMIT = (1 << 32) - 1
+  with _ZIP64_LIMIT_LOCK:
+    saved_zip64_limit = zipfile.ZIP64_LIMIT
+    zipfile.ZIP64_LIMIT = (1 << 32) - 1
 
-  if compress_type is None:
-    compress_type = zip_file.compression
-  if arcname is None:
-    arcname = filename
+    if compress_type is None:
+      compress_type = zip_file.compression
+    if arcname is None:
+      arcname = filename
 
-  saved_stat = os.stat(filename)
+    saved_stat = os.stat(filename)
 
-  try:
-    # `zipfile.write()` doesn't allow us to pass ZipInfo, so just modify the
-    # file to be zipped and reset it when we're done.
-    os.chmod(filename, perms)
-
-    # Use a fixed timestamp so the output is repeatable.
-    # Note: Use of fromtimestamp rather than utcfromtimestamp here is
-    # intentional. zip stores datetimes in local time without a time zone
-    # attached, so we need "epoch" but in the local time zone to get 2009/01/01
-    # in the zip archive.
-    local_epoch = datetime.datetime.fromtimestamp(0)
-    timestamp = (datetime.datetime(2009, 1, 1) - local_epoch).total_seconds()
-    os.utime(filename, (timestamp, timestamp))
-
-    zip_file.write(filename, arcname=arcname, compress_type=compress_type)
-  finally:
-    os.chmod(filename, saved_stat.st_mode)
-    os.utime(filename, (saved_stat.st_atime, saved_stat.st_mtime))
-    zipfile.ZIP64_LIMIT = saved_zip64_limit
+    try:
+      # `zipfile.write()` doesn't allow us to pass ZipInfo, so just modify the
+      # file to be zipped and reset it when we're done.
+      os.chmod(filename, perms)
+
+      # Use a fixed timestamp so the output is repeatable.
+      # Note: Use of fromtimestamp rather than utcfromtimestamp here is
+      # intentional. zip stores datetimes in local time without a time zone
+      # attached, so we need "epoch" but in the local time zone to get
+      # 2009/01/01 in the zip archive.
+      local_epoch = datetime.datetime.fromtimestamp(0)
+      timestamp = (datetime.datetime(2009, 1, 1) - local_epoch).total_seconds()
+      os.utime(filename, (timestamp, timestamp))
+
+      zip_file.write(filename, arcname=arcname, compress_type=compress_type)
+    finally:
+      os.chmod(filename, saved_stat.st_mode)
+      os.utime(filename, (saved_stat.st_atime, saved_stat.st_mtime))
+      zipfile.ZIP64_LIMIT = saved_zip64_limit
 
 
 def ZipWriteStr(zip_file, zinfo_or_arcname, data, perms=None,
@@ -2800,76 +3156,338 @@ def ZipWriteStr(zip_file, zinfo_or_arcname, data, perms=None,
   when we know the string won't be too long.
   """
 
-  saved_zip64_limit = zipfile.ZIP64_LIMIT
-  zipfile.ZIP64_LIMIT = (1 << 32) - 1
+  with _ZIP64_LIMIT_LOCK:
+    saved_zip64_limit = zipfile.ZIP64_LIMIT
+    zipfile.ZIP64_LIMIT = (1 << 32) - 1
+
+    if not isinstance(zinfo_or_arcname, zipfile.ZipInfo):
+      zinfo = zipfile.ZipInfo(filename=zinfo_or_arcname)
+      zinfo.compress_type = zip_file.compression
+      if perms is None:
+        perms = 0o100644
+    else:
+      zinfo = zinfo_or_arcname
+      # Python 2 and 3 behave differently when calling ZipFile.writestr() with
+      # zinfo.external_attr being 0. Python 3 uses `0o600 << 16` as the value
+      # for such a case (since
+      # https://github.com/python/cpython/commit/18ee29d0b870caddc0806916ca2c823254f1a1f9),
+      # which seems to make more sense. Otherwise the entry will have 0o000 as
+      # the permission bits. We follow the logic in Python 3 to get consistent
+      # behavior between using the two versions.
+      if not zinfo.external_attr:
+        zinfo.external_attr = 0o600 << 16
+
+    # If compress_type is given, it overrides the value in zinfo.
+    if compress_type is not None:
+      zinfo.compress_type = compress_type
+
+    # If perms is given, it has a priority.
+    if perms is not None:
+      # If perms doesn't set the file type, mark it as a regular file.
+      if perms & 0o770000 == 0:
+        perms |= 0o100000
+      zinfo.external_attr = perms << 16
+
+    # Use a fixed timestamp so the output is repeatable.
+    zinfo.date_time = (2009, 1, 1, 0, 0, 0)
+
+    try:
+      zip_file.writestr(zinfo, data)
+    finally:
+      zipfile.ZIP64_LIMIT = saved_zip64_limit
+
+
+def _CopyFileRange(src, dst, offset, length, chunk_size=4 * 1024 * 1024):
+  """Copies length bytes at offset of src to the current position of dst."""
+  src.seek(offset)
+  while length > 0:
+    data = src.read(min(chunk_size, length))
+    if not data:
+      raise ExternalError(
+          "Unexpected EOF when copying {} bytes at {}".format(length, offset))
+    dst.write(data)
+    length -= len(data)
+
+
+def _StripZip64Extra(extra):
+  """Removes the ZIP64 extended information (0x0001) from an extra field."""
+  result = b''
+  while len(extra) >= 4:
+    tag, size = struct.unpack('<HH', extra[:4])
+    if tag != 0x0001:
+      result += extra[:size + 4]
+    extra = extra[size + 4:]
+  return result
+
+
+def _GetZipEntryDataOffset(zip_file, zinfo):
+  """Returns the offset of the (compressed) data of an entry in a ZIP file."""
+  zip_file.fp.seek(zinfo.header_offset)
+  header = zip_file.fp.read(zipfile.sizeFileHeader)
+  if (len(header) != zipfile.sizeFileHeader or
+          header[:4] != zipfile.stringFileHeader):
+    raise ExternalError(
+        "Bad local file header for {}".format(zinfo.filename))
+  filename_length, extra_length = struct.unpack('<HH', header[26:30])
+  return (zinfo.header_offset + zipfile.sizeFileHeader + filename_length +
+          extra_length)
 
-  if not isinstance(zinfo_or_arcname, zipfile.ZipInfo):
-    zinfo = zipfile.ZipInfo(filename=zinfo_or_arcname)
-    zinfo.compress_type = zip_file.compression
-    if perms is None:
-      perms = 0o100644
+
+def ZipCopyRaw(input_zip, output_zip, zinfo_or_arcname, arcname=None,
+               perms=None):
+  """Copies an entry between ZIP files without recompressing it.
+
+  The compressed bytes of the entry are copied verbatim together with its CRC
+  and sizes, instead of inflating them with read() and deflating them again
+  with ZipWriteStr(). Entries that need to be modified should still go
+  through ZipWriteStr() or ZipWrite().
+
+  Args:
+    input_zip: The ZipFile to copy the entry from.
+    output_zip: The ZipFile to copy the entry to, opened for writing.
+    zinfo_or_arcname: The ZipInfo, or the name of the entry in input_zip.
+    arcname: The name of the entry in output_zip. Defaults to the name in
+        input_zip.
+    perms: The permission bits to set, which has a priority over the ones in
+        the original entry.
+
+  Raises:
+    ExternalError: On encrypted entries or malformed input.
+  """
+  if isinstance(zinfo_or_arcname, zipfile.ZipInfo):
+    input_info = zinfo_or_arcname
   else:
-    zinfo = zinfo_or_arcname
-    # Python 2 and 3 behave differently when calling ZipFile.writestr() with
-    # zinfo.external_attr being 0. Python 3 uses `0o600 << 16` as the value for
-    # such a case (since
-    # https://github.com/python/cpython/commit/18ee29d0b870caddc0806916ca2c823254f1a1f9),
-    # which seems to make more sense. Otherwise the entry will have 0o000 as the
-    # permission bits. We follow the logic in Python 3 to get consistent
-    # behavior between using the two versions.
-    if not zinfo.external_attr:
-      zinfo.external_attr = 0o600 << 16
-
-  # If compress_type is given, it overrides the value in zinfo.
-  if compress_type is not None:
-    zinfo.compress_type = compress_type
-
-  # If perms is given, it has a priority.
+    input_info = input_zip.getinfo(zinfo_or_arcname)
+  zinfo = copy.copy(input_info)
+  if zinfo.flag_bits & 0x1:
+    raise ExternalError(
+        "Can't copy encrypted entry {}".format(zinfo.filename))
+  if output_zip._writing:  # pylint: disable=protected-access
+    raise ExternalError(
+        "Can't copy {} while another entry is being written".format(
+            zinfo.filename))
+
+  if arcname is not None:
+    zinfo.filename = arcname
+    zinfo.orig_filename = arcname
+
+  # The CRC and sizes are known up front, so we never need a data descriptor.
+  zinfo.flag_bits &= ~0x08
+  zinfo.extra = _StripZip64Extra(zinfo.extra)
   if perms is not None:
-    # If perms doesn't set the file type, mark it as a regular file.
     if perms & 0o770000 == 0:
       perms |= 0o100000
     zinfo.external_attr = perms << 16
+  elif not zinfo.external_attr:
+    zinfo.external_attr = 0o600 << 16
 
   # Use a fixed timestamp so the output is repeatable.
   zinfo.date_time = (2009, 1, 1, 0, 0, 0)
 
-  zip_file.writestr(zinfo, data)
-  zipfile.ZIP64_LIMIT = saved_zip64_limit
+  with _ZIP64_LIMIT_LOCK:
+    saved_zip64_limit = zipfile.ZIP64_LIMIT
+    zipfile.ZIP64_LIMIT = (1 << 32) - 1
+    try:
+      data_offset = _GetZipEntryDataOffset(input_zip, input_info)
+      zip64 = (zinfo.file_size > zipfile.ZIP64_LIMIT or
+               zinfo.compress_size > zipfile.ZIP64_LIMIT)
+
+      # pylint: disable=protected-access
+      output_zip.fp.seek(output_zip.start_dir)
+      zinfo.header_offset = output_zip.fp.tell()
+      output_zip._writecheck(zinfo)
+      output_zip._didModify = True
+      output_zip.fp.write(zinfo.FileHeader(zip64))
+      _CopyFileRange(input_zip.fp, output_zip.fp, data_offset,
+                     zinfo.compress_size)
+      output_zip.start_dir = output_zip.fp.tell()
+      output_zip.filelist.append(zinfo)
+      output_zip.NameToInfo[zinfo.filename] = zinfo
+    finally:
+      zipfile.ZIP64_LIMIT = saved_zip64_limit
+
+
+def ZipOverwriteStoredEntry(zip_filename, arcname, data):
+  """Overwrites the data of a ZIP_STORED entry in place.
+
+  The new data must be of the same size as the existing one, so that none of
+  the entries move. This allows updating an entry (e.g. the OTA metadata)
+  without rewriting the whole archive, as ZipDelete() followed by a write
+  would do.
+
+  Args:
+    zip_filename: The name of the ZIP file.
+    arcname: The name of the entry to overwrite.
+    data: The new data, as str or bytes.
+
+  Raises:
+    ExternalError: If the entry isn't ZIP_STORED or the sizes don't match.
+  """
+  if isinstance(data, str):
+    data = data.encode()
+
+  with zipfile.ZipFile(zip_filename, allowZip64=True) as zip_file:
+    info = zip_file.getinfo(arcname)
+    if info.compress_type != zipfile.ZIP_STORED:
+      raise ExternalError("Can't overwrite compressed entry {}".format(arcname))
+    if info.file_size != len(data):
+      raise ExternalError(
+          "Size mismatch when overwriting {}: {} vs {}".format(
+              arcname, info.file_size, len(data)))
+    data_offset = _GetZipEntryDataOffset(zip_file, info)
+
+    # Central directory records are in the same order as the infolist.
+    central_dir_offset = zip_file.start_dir
+    zip_file.fp.seek(central_dir_offset)
+    for entry in zip_file.infolist():
+      if entry is info:
+        break
+      record = zip_file.fp.read(zipfile.sizeCentralDir)
+      filename_length, extra_length, comment_length = struct.unpack(
+          '<HHH', record[28:34])
+      central_dir_offset += (zipfile.sizeCentralDir + filename_length +
+                             extra_length + comment_length)
+      zip_file.fp.seek(central_dir_offset)
+
+  crc = struct.pack('<L', zlib.crc32(data) & 0xffffffff)
+  with open(zip_filename, 'r+b') as f:
+    # CRC-32 lives at offset 14 of the local file header, and at offset 16 of
+    # the central directory record.
+    f.seek(info.header_offset + 14)
+    f.write(crc)
+    f.seek(data_offset)
+    f.write(data)
+    if info.flag_bits & 0x08:
+      # The data descriptor may or may not start with a signature.
+      if f.read(4) != b'PK\x07\x08':
+        f.seek(-4, os.SEEK_CUR)
+      f.write(crc)
+    f.seek(central_dir_offset + 16)
+    f.write(crc)
+
+
+def _MoveFileRange(fd, src_offset, dst_offset, length,
+                   chunk_size=64 * 1024 * 1024):
+  """Moves length bytes within a file towards its beginning."""
+  assert dst_offset <= src_offset
+  use_copy_file_range = hasattr(os, 'copy_file_range')
+  while length > 0:
+    count = min(chunk_size, length)
+    copied = 0
+    # copy_file_range() rejects overlapping ranges within the same file, in
+    # which case we go through a buffer instead.
+    if use_copy_file_range and src_offset - dst_offset >= count:
+      try:
+        copied = os.copy_file_range(fd, fd, count, src_offset, dst_offset)
+      except OSError:
+        use_copy_file_range = False
+    if not copied:
+      data = os.pread(fd, count, src_offset)
+      if not data:
+        raise ExternalError(
+            "Unexpected EOF when moving {} bytes at {}".format(
+                length, src_offset))
+      copied = os.pwrite(fd, data, dst_offset)
+    src_offset += copied
+    dst_offset += copied
+    length -= copied
 
 
 def ZipDelete(zip_filename, entries):
-  """Deletes entries from a ZIP file.
+  """Deletes entries from a ZIP file in place.
 
-  Since deleting entries from a ZIP file is not supported, it shells out to
-  'zip -d'.
+  The raw bytes of the entries that follow the first deleted one are moved
+  over the deleted ones, then the central directory is rewritten. Unlike
+  'zip -d', this leaves the entries ahead of the first deleted one untouched,
+  and doesn't need a second copy of the archive.
 
   Args:
     zip_filename: The name of the ZIP file.
-    entries: The name of the entry, or the list of names to be deleted.
+    entries: The name of the entry, or the list of names to be deleted. Names
+        that don't exist in the ZIP file are ignored, as long as at least one
+        entry gets deleted.
+
+  Returns:
+    The number of bytes that have been moved.
 
   Raises:
-    AssertionError: In case of non-zero return from 'zip'.
+    ExternalError: If none of the entries exist in the ZIP file.
   """
   if isinstance(entries, str):
     entries = [entries]
   # If list is empty, nothing to do
   if not entries:
-    return
-  cmd = ["zip", "-d", zip_filename] + entries
-  RunAndCheckOutput(cmd)
+    return 0
+  entries = set(entries)
+
+  with zipfile.ZipFile(zip_filename, allowZip64=True) as zip_file:
+    infolist = sorted(zip_file.infolist(), key=lambda i: i.header_offset)
+    start_dir = zip_file.start_dir
+
+  if not any(info.filename in entries for info in infolist):
+    raise ExternalError(
+        "None of {} found in {}".format(sorted(entries), zip_filename))
+
+  # Each entry spans up to the next one (or the central directory), which
+  # covers its local header, data and the optional data descriptor.
+  ends = [info.header_offset for info in infolist[1:]] + [start_dir]
+  new_offsets = {}
+  write_offset = None
+  moved = 0
+  fd = os.open(zip_filename, os.O_RDWR)
+  try:
+    for info, end in zip(infolist, ends):
+      if info.filename in entries:
+        if write_offset is None:
+          write_offset = info.header_offset
+        continue
+      if write_offset is None:
+        continue
+      length = end - info.header_offset
+      _MoveFileRange(fd, info.header_offset, write_offset, length)
+      new_offsets[info.header_offset] = write_offset
+      write_offset += length
+      moved += length
+  finally:
+    os.close(fd)
+
+  # The old central directory is still intact after the move, as everything
+  # got moved towards the beginning.
+  with _ZIP64_LIMIT_LOCK:
+    saved_zip64_limit = zipfile.ZIP64_LIMIT
+    zipfile.ZIP64_LIMIT = (1 << 32) - 1
+    try:
+      with zipfile.ZipFile(zip_filename, 'a', allowZip64=True) as zip_file:
+        filelist = []
+        for info in zip_file.infolist():
+          if info.filename in entries:
+            continue
+          info.header_offset = new_offsets.get(info.header_offset,
+                                               info.header_offset)
+          filelist.append(info)
+        zip_file.filelist = filelist
+        zip_file.NameToInfo = {info.filename: info for info in filelist}
+        zip_file.start_dir = write_offset
+        zip_file._didModify = True  # pylint: disable=protected-access
+    finally:
+      zipfile.ZIP64_LIMIT = saved_zip64_limit
+
+  logger.info("Deleted %d entries from %s, moved %d bytes",
+              len(infolist) - len(filelist), zip_filename, moved)
+  return moved
 
 
 def ZipClose(zip_file):
   # http://b/18015246
   # zipfile also refers to ZIP64_LIMIT during close() when it writes out the
   # central directory.
-  saved_zip64_limit = zipfile.ZIP64_LIMIT
-  zipfile.ZIP64_LIMIT = (1 << 32) - 1
-
-  zip_file.close()
-
-  zipfile.ZIP64_LIMIT = saved_zip64_limit
+  with _ZIP64_LIMIT_LOCK:
+    saved_zip64_limit = zipfile.ZIP64_LIMIT
+    zipfile.ZIP64_LIMIT = (1 << 32) - 1
+    try:
+      zip_file.close()
+    finally:
+      zipfile.ZIP64_LIMIT = saved_zip64_limit
 
 
 class DeviceSpecificParams(object):
@@ -3132,6 +3750,117 @@ def ComputeDifferences(diffs):
     threads.pop().join()
 
 
+class TaskGraph(object):
+  """Runs a set of tasks in worker threads, honoring their dependencies.
+
+  A task is started once all the tasks it depends on have finished. The tasks
+  are expected to spend most of their time in external programs (or in code
+  that releases the GIL), so that running them in threads pays off.
+
+  Each task may also declare the amount of a shared resource (e.g. temp space)
+  it needs while running. A task won't be started if that would exceed the
+  budget given to the graph, unless nothing else is running.
+
+  Ready tasks are picked in the order they were added, so the scheduling is
+  deterministic with a single worker.
+  """
+
+  def __init__(self, num_workers=None, budget=None):
+    self.num_workers = num_workers or OPTIONS.worker_threads or 1
+    self.budget = budget
+    self.results = {}
+    self.durations = {}
+    self._tasks = collections.OrderedDict()
+
+  def AddTask(self, name, func, deps=(), cost=0):
+    """Adds a task to the graph.
+
+    Args:
+      name: A unique name of the task.
+      func: The callable to run, with no arguments. Its return value will be
+          saved in self.results[name].
+      deps: The names of the tasks that must finish before this one starts.
+          They must have been added already, which rules out cycles.
+      cost: The amount of the budgeted resource this task holds while running.
+    """
+    assert name not in self._tasks, "Duplicate task {}".format(name)
+    for dep in deps:
+      assert dep in self._tasks, "Unknown dependency {} of {}".format(dep, name)
+    self._tasks[name] = (func, tuple(deps), cost)
+
+  def Run(self):
+    """Runs all the tasks and waits for them to finish.
+
+    Once a task fails, no further tasks will be started. The exception of the
+    first failed task is re-raised after the running ones have finished.
+    """
+    cond = threading.Condition()
+    pending = list(self._tasks)
+    done = set()
+    running = {}    # name -> cost, accessed under cond
+    errors = []
+
+    def NextTask():
+      in_use = sum(running.values())
+      for name in pending:
+        _, deps, cost = self._tasks[name]
+        if not all(dep in done for dep in deps):
+          continue
+        if (self.budget is not None and running and
+                in_use + cost > self.budget):
+          continue
+        return name
+      return None
+
+    def worker():
+      with cond:
+        while True:
+          while not errors and pending:
+            name = NextTask()
+            if name is not None:
+              break
+            cond.wait()
+          if errors or not pending:
+            cond.notify_all()
+            return
+          pending.remove(name)
+          func, _, cost = self._tasks[name]
+          running[name] = cost
+
+          cond.release()
+          start = time.time()
+          try:
+            result = func()
+          except Exception as e:  # pylint: disable=broad-except
+            logger.exception("Task %s failed", name)
+            result = None
+            error = e
+          else:
+            error = None
+          finally:
+            cond.acquire()
+
+          del running[name]
+          self.durations[name] = time.time() - start
+          if error is not None:
+            errors.append(error)
+          else:
+            self.results[name] = result
+            done.add(name)
+          cond.notify_all()
+
+    threads = [threading.Thread(target=worker)
+               for _ in range(min(self.num_workers, len(self._tasks)))]
+    for th in threads:
+      th.start()
+    for th in threads:
+      th.join()
+
+    if errors:
+      raise errors[0]
+    return self.results
+
+
 class BlockDifference(object):
   def __init__(self, partition, tgt, src=None, check_first_block=False,
                version=None, disable_imgdiff=False):
@@ -3982,7 +4711,9 @@ def GetCareMap(which, imgname):
   # For sparse images, we will only check the blocks that are listed in the care
   # map, i.e. the ones with meaningful data.
   if "extfs_sparse_flag" in OPTIONS.info_dict and not disable_sparse:
-    simg = sparse_img.SparseImage(imgname)
+    # Only the care_map is needed, which doesn't need the extended blocks or
+    # the file map.
+    simg = sparse_img.SparseImage(imgname, lazy=True)
     care_map_ranges = simg.care_map.intersect(
         rangelib.RangeSet("0-{}".format(image_blocks)))
 
@@ -3994,6 +4725,7 @@ def GetCareMap(which, imgname):
   return [which, care_map_ranges.to_string_raw()]
 
 
+@Traced
 def AddCareMapForAbOta(output_file, ab_partitions, image_paths):
   """Generates and adds care_map.pb for a/b partition that has care_map.
 
@@ -22,19 +22,16 @@ can be trusted.
 
 import argparse
 import common
+import concurrent.futures
 import os
-import subprocess
 import sys
 from fsverity_digests_pb2 import FSVerityDigests
+from fsverity_metadata_generator import compute_digest
 
 HASH_ALGORITHM = 'sha256'
 
-def _digest(fsverity_path, input_file):
-  cmd = [fsverity_path, 'digest', input_file]
-  cmd.extend(['--compact'])
-  cmd.extend(['--hash-alg', HASH_ALGORITHM])
-  out = subprocess.check_output(cmd, universal_newlines=True).strip()
-  return bytes(bytearray.fromhex(out))
+def _digest(input_file):
+  return compute_digest(input_file, HASH_ALGORITHM)
 
 if __name__ == '__main__':
   p = argparse.ArgumentParser()
@@ -42,10 +39,11 @@ if __name__ == '__main__':
       '--output',
       help='Path to the output manifest APK',
       required=True)
+  # Deprecated: the digests are computed in-process. Still accepted so that
+  # existing callers don't break, but ignored.
   p.add_argument(
       '--fsverity-path',
-      help='path to the fsverity program',
-      required=True)
+      help=argparse.SUPPRESS)
   p.add_argument(
       '--aapt2-path',
       help='path to the aapt2 program',
@@ -82,17 +80,28 @@ if __name__ == '__main__':
       '--base-dir',
       help='directory to use as a relative root for the inputs',
       required=True)
+  p.add_argument(
+      '--threads',
+      type=int,
+      help='number of files to digest in parallel. Default is the number of '
+           'CPUs')
   p.add_argument(
       'inputs',
       nargs='+',
       help='input file for the build manifest')
   args = p.parse_args(sys.argv[1:])
 
+  # The files are digested in a pool of threads, as hashlib releases the GIL
+  # while hashing.
+  inputs = sorted(args.inputs)
+  with concurrent.futures.ThreadPoolExecutor(args.threads) as executor:
+    file_digests = list(executor.map(_digest, inputs))
+
   digests = FSVerityDigests()
-  for f in sorted(args.inputs):
+  for f, file_digest in zip(inputs, file_digests):
     # f is a full path for now; make it relative so it starts with {mount_point}/
     digest = digests.digests[os.path.relpath(f, args.base_dir)]
-    digest.digest = _digest(args.fsverity_path, f)
+    digest.digest = file_digest
     digest.hash_alg = HASH_ALGORITHM
 
   temp_dir = common.MakeTempDir()
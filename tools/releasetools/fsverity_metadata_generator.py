@@ -18,10 +18,11 @@
 `fsverity_metadata_generator` generates fsverity metadata and signature to a
 container file
 
-This actually is a simple wrapper around the `fsverity` program. A file is
-signed by the program which produces the PKCS#7 signature file, merkle tree file
-, and the fsverity_descriptor file. Then the files are packed into a single
-output file so that the information about the signing stays together.
+The merkle tree and the fsverity_descriptor of a file are computed in-process.
+When a signature is requested, the file is signed by the `fsverity` program
+instead, which produces the PKCS#7 signature file, merkle tree file, and the
+fsverity_descriptor file. Then the files are packed into a single output file
+so that the information about the signing stays together.
 
 Currently, the output of this script is used by `fd_server` which is the host-
 side backend of an authfs filesystem. `fd_server` uses this file in case when
@@ -31,6 +32,8 @@ the filesystem using ioctl.
 """
 
 import argparse
+import concurrent.futures
+import hashlib
 import os
 import re
 import shutil
@@ -39,6 +42,72 @@ import sys
 import tempfile
 from struct import *
 
+# From the fsverity_descriptor in linux/fsverity.h
+FSVERITY_HASH_ALGS = {'sha256': 1, 'sha512': 2}
+FSVERITY_BLOCK_SIZE = 4096
+FSVERITY_MAX_DIGEST_SIZE = 64
+FSVERITY_MAX_SALT_SIZE = 32
+
+def compute_merkle_tree(input_file, hash_alg='sha256', salt=b''):
+  """ Computes the fs-verity merkle tree of a file, same as `fsverity digest`
+
+  Each data block, and then each block of the level below, is hashed with the
+  salt (zero-padded to the hash block size) prepended. A partial block at the
+  end of each level is zero-padded.
+
+  Returns a tuple of (root_hash, merkle_tree), where merkle_tree has the levels
+  from the root down, as written by `--out-merkle-tree`. A file of a single
+  block has an empty tree; an empty file has an all-zero root hash.
+  """
+  salted_hash = hashlib.new(hash_alg)
+  if salt:
+    salted_hash.update(salt + b'\0' * (-len(salt) % salted_hash.block_size))
+
+  def hash_blocks(data):
+    hashes = []
+    for offset in range(0, len(data), FSVERITY_BLOCK_SIZE):
+      block = data[offset:offset + FSVERITY_BLOCK_SIZE]
+      block_hash = salted_hash.copy()
+      block_hash.update(block)
+      if len(block) < FSVERITY_BLOCK_SIZE:
+        block_hash.update(b'\0' * (FSVERITY_BLOCK_SIZE - len(block)))
+      hashes.append(block_hash.digest())
+    return b''.join(hashes)
+
+  # Level 0 is read in large chunks, which are whole blocks but the last one.
+  level_hashes = []
+  with open(input_file, 'rb') as f:
+    while True:
+      data = f.read(256 * FSVERITY_BLOCK_SIZE)
+      if not data:
+        break
+      level_hashes.append(hash_blocks(memoryview(data)))
+  level = b''.join(level_hashes)
+  if not level:
+    return bytes(salted_hash.digest_size), b''
+
+  levels = []
+  while len(level) > salted_hash.digest_size:
+    level += b'\0' * (-len(level) % FSVERITY_BLOCK_SIZE)
+    levels.append(level)
+    level = hash_blocks(memoryview(level))
+  return level, b''.join(reversed(levels))
+
+def build_descriptor(data_size, root_hash, hash_alg='sha256', salt=b''):
+  """ Returns the fsverity_descriptor, as written by `--out-descriptor` """
+  if len(salt) > FSVERITY_MAX_SALT_SIZE:
+    raise ValueError("salt can be at most %d bytes." % FSVERITY_MAX_SALT_SIZE)
+  return pack('<BBBBIQ64s32s144x', 1, FSVERITY_HASH_ALGS[hash_alg],
+              FSVERITY_BLOCK_SIZE.bit_length() - 1, len(salt), 0, data_size,
+              root_hash, salt)
+
+def compute_digest(input_file, hash_alg='sha256', salt=b''):
+  """ Returns the fs-verity digest of a file, same as `fsverity digest` """
+  root_hash, _ = compute_merkle_tree(input_file, hash_alg, salt)
+  descriptor = build_descriptor(
+      os.path.getsize(input_file), root_hash, hash_alg, salt)
+  return hashlib.new(hash_alg, descriptor).digest()
+
 class TempDirectory(object):
   def __enter__(self):
     self.name = tempfile.mkdtemp()
@@ -98,11 +167,7 @@ class FSVerityMetadataGenerator:
       return f.read(size)
 
   def digest(self, input_file):
-    cmd = [self._fsverity_path, 'digest', input_file]
-    cmd.extend(['--compact'])
-    cmd.extend(['--hash-alg', self._hash_alg])
-    out = subprocess.check_output(cmd, universal_newlines=True).strip()
-    return bytes(bytearray.fromhex(out))
+    return compute_digest(input_file, self._hash_alg)
 
   def generate(self, input_file, output_file=None):
     if self._signature != 'none':
@@ -114,9 +179,28 @@ class FSVerityMetadataGenerator:
     if not output_file:
       output_file = input_file + '.fsv_meta'
 
+    # Only signing needs the fsverity program, and a place for its outputs.
+    if self._signature == 'none':
+      root_hash, merkletree = compute_merkle_tree(input_file, self._hash_alg)
+      desc = build_descriptor(
+          os.path.getsize(input_file), root_hash, self._hash_alg)
+      self._write_metadata(output_file, desc, None, merkletree)
+      return
+
     with TempDirectory() as temp_dir:
       self._do_generate(input_file, output_file, temp_dir)
 
+  def generate_all(self, input_files, num_threads=None):
+    """ Generates the .fsv_meta files for input_files, in a pool of threads
+
+    hashlib releases the GIL while hashing each block, so the files are hashed
+    in parallel.
+    """
+    with concurrent.futures.ThreadPoolExecutor(num_threads) as executor:
+      # Consumes the results, so that any error is raised.
+      for _ in executor.map(self.generate, input_files):
+        pass
+
   def _do_generate(self, input_file, output_file, work_dir):
     # temporary files
     desc_file = os.path.join(work_dir, 'desc')
@@ -125,41 +209,43 @@ class FSVerityMetadataGenerator:
 
     # run the fsverity util to create the temporary files
     cmd = [self._fsverity_path]
-    if self._signature == 'none':
-      cmd.append('digest')
-      cmd.append(input_file)
+    cmd.append('sign')
+    cmd.append(input_file)
+    cmd.append(sig_file)
+
+    # If key is DER, convert DER private key to PEM
+    if self._key_format == 'der':
+      pem_key = os.path.join(work_dir, 'key.pem')
+      key_cmd = ['openssl', 'pkcs8']
+      key_cmd.extend(['-inform', 'DER'])
+      key_cmd.extend(['-in', self._key])
+      key_cmd.extend(['-nocrypt'])
+      key_cmd.extend(['-out', pem_key])
+      subprocess.check_call(key_cmd)
     else:
-      cmd.append('sign')
-      cmd.append(input_file)
-      cmd.append(sig_file)
-
-      # If key is DER, convert DER private key to PEM
-      if self._key_format == 'der':
-        pem_key = os.path.join(work_dir, 'key.pem')
-        key_cmd = ['openssl', 'pkcs8']
-        key_cmd.extend(['-inform', 'DER'])
-        key_cmd.extend(['-in', self._key])
-        key_cmd.extend(['-nocrypt'])
-        key_cmd.extend(['-out', pem_key])
-        subprocess.check_call(key_cmd)
-      else:
-        pem_key = self._key
+      pem_key = self._key
 
-      cmd.extend(['--key', pem_key])
-      cmd.extend(['--cert', self._cert])
+    cmd.extend(['--key', pem_key])
+    cmd.extend(['--cert', self._cert])
     cmd.extend(['--hash-alg', self._hash_alg])
     cmd.extend(['--block-size', '4096'])
     cmd.extend(['--out-merkle-tree', merkletree_file])
     cmd.extend(['--out-descriptor', desc_file])
     subprocess.check_call(cmd, stdout=open(os.devnull, 'w'))
 
+    with open(desc_file, 'rb') as f:
+      desc = f.read()
+    with open(merkletree_file, 'rb') as f:
+      merkletree = f.read()
+    self._write_metadata(output_file, desc, sig_file, merkletree)
+
+  def _write_metadata(self, output_file, desc, sig_file, merkletree):
     with open(output_file, 'wb') as out:
       # 1. version
       out.write(pack('<I', 1))
 
       # 2. fsverity_descriptor
-      with open(desc_file, 'rb') as f:
-        out.write(f.read())
+      out.write(desc)
 
       # 3. signature
       SIG_TYPE_NONE = 0
@@ -181,11 +267,10 @@ class FSVerityMetadataGenerator:
         out.write(pack('<I', 0))
 
       # 4. merkle tree
-      with open(merkletree_file, 'rb') as f:
-        # merkle tree is placed at the next nearest page boundary to make
-        # mmapping possible
-        out.seek(next_page(out.tell()))
-        out.write(f.read())
+      # merkle tree is placed at the next nearest page boundary to make
+      # mmapping possible
+      out.seek(next_page(out.tell()))
+      out.write(merkletree)
 
 def next_page(n):
   """ Returns the next nearest page boundary from `n` """
@@ -201,7 +286,8 @@ if __name__ == '__main__':
       default=None)
   p.add_argument(
       'input',
-      help='input file to be signed')
+      nargs='+',
+      help='input files to be signed')
   p.add_argument(
       '--key-format',
       choices=['pem', 'der'],
@@ -225,10 +311,17 @@ if __name__ == '__main__':
       default='none')
   p.add_argument(
       '--fsverity-path',
-      help='path to the fsverity program',
-      required=True)
+      help='path to the fsverity program. Required only when signing')
+  p.add_argument(
+      '--threads',
+      type=int,
+      help='number of files to process in parallel. Default is the number of '
+           'CPUs')
   args = p.parse_args(sys.argv[1:])
 
+  if args.output and len(args.input) > 1:
+    raise ValueError("output can only be set for a single input")
+
   generator = FSVerityMetadataGenerator(args.fsverity_path)
   generator.set_signature(args.signature)
   if args.signature == 'none':
@@ -237,8 +330,13 @@ if __name__ == '__main__':
   else:
     if not args.key or not args.cert:
       raise ValueError("To generate signature, key and cert must be set")
+    if not args.fsverity_path:
+      raise ValueError("To generate signature, fsverity-path must be set")
     generator.set_key(args.key)
     generator.set_cert(args.cert)
   generator.set_key_format(args.key_format)
   generator.set_hash_alg(args.hash_alg)
-  generator.generate(args.input, args.output)
+  if args.output:
+    generator.generate(args.input[0], args.output)
+  else:
+    generator.generate_all(args.input, args.threads)
@@ -86,6 +86,7 @@ def LoadOptions(input_file):
   OPTIONS.sparse_userimages = bool(info.get('extfs_sparse_flag'))
 
 
+@common.Traced
 def CopyZipEntries(input_file, output_file, entries):
   """Copies ZIP entries between input and output files.
 
@@ -158,6 +159,7 @@ def EntriesForSplitSuperImages(input_file):
   return entries
 
 
+@common.Traced
 def RebuildAndWriteSuperImages(input_file, output_file):
   """Builds and writes super images to the output file."""
   logger.info('Building super image...')
@@ -177,6 +179,7 @@ def RebuildAndWriteSuperImages(input_file, output_file):
     common.ZipWrite(output_zip, super_file, 'super.img')
 
 
+@common.Traced
 def ImgFromTargetFiles(input_file, output_file):
   """Creates an image archive from the input target_files zip.
 
@@ -258,12 +258,13 @@ import shutil
 import struct
 import subprocess
 import sys
+import tempfile
 import zipfile
 
 import care_map_pb2
 import common
 import ota_utils
-from ota_utils import (UNZIP_PATTERN, FinalizeMetadata, GetPackageMetadata,
+from ota_utils import (FinalizeMetadata, GetPackageMetadata,
                        PropertyFiles, SECURITY_PATCH_LEVEL_PROP_NAME, GetZipEntryOffset)
 from common import IsSparseImage
 import target_files_diff
@@ -734,10 +735,8 @@ def GetTargetFilesZipForSecondaryImages(input_file, skip_postinstall=False):
     The filename of the target-files.zip for generating secondary payload.
   """
 
-  def GetInfoForSecondaryImages(info_file):
+  def GetInfoForSecondaryImages(content):
     """Updates info file for secondary payload generation."""
-    with open(info_file) as f:
-      content = f.read()
     # Remove virtual_ab flag from secondary payload so that OTA client
     # don't use snapshots for secondary update
     delete_keys = ['virtual_ab', "virtual_ab_retrofit"]
@@ -748,14 +747,12 @@ def GetTargetFilesZipForSecondaryImages(input_file, skip_postinstall=False):
   target_file = common.MakeTempFile(prefix="targetfiles-", suffix=".zip")
   target_zip = zipfile.ZipFile(target_file, 'w', allowZip64=True)
 
-  with zipfile.ZipFile(input_file, 'r', allowZip64=True) as input_zip:
-    infolist = input_zip.infolist()
-
-  input_tmp = common.UnzipTemp(input_file, UNZIP_PATTERN)
-  for info in infolist:
-    unzipped_file = os.path.join(input_tmp, *info.filename.split('/'))
+  # Unchanged entries are copied over without being decompressed.
+  input_zip = zipfile.ZipFile(input_file, 'r', allowZip64=True)
+  for info in input_zip.infolist():
     if info.filename == 'IMAGES/system_other.img':
-      common.ZipWrite(target_zip, unzipped_file, arcname='IMAGES/system.img')
+      common.ZipCopyRaw(input_zip, target_zip, info,
+                        arcname='IMAGES/system.img')
 
     # Primary images and friends need to be skipped explicitly.
     elif info.filename in ('IMAGES/system.img',
@@ -767,7 +764,7 @@ def GetTargetFilesZipForSecondaryImages(input_file, skip_postinstall=False):
       image_name = os.path.basename(info.filename)
       if image_name not in ['{}.img'.format(partition) for partition in
                             SECONDARY_PAYLOAD_SKIPPED_IMAGES]:
-        common.ZipWrite(target_zip, unzipped_file, arcname=info.filename)
+        common.ZipCopyRaw(input_zip, target_zip, info)
 
     # Skip copying the postinstall config if requested.
     elif skip_postinstall and info.filename == POSTINSTALL_CONFIG:
@@ -777,8 +774,7 @@ def GetTargetFilesZipForSecondaryImages(input_file, skip_postinstall=False):
       # Remove the unnecessary partitions for secondary images from the
       # ab_partitions file.
       if info.filename == AB_PARTITIONS:
-        with open(unzipped_file) as f:
-          partition_list = f.read().splitlines()
+        partition_list = input_zip.read(info).decode().splitlines()
         partition_list = [partition for partition in partition_list if partition
                           and partition not in SECONDARY_PAYLOAD_SKIPPED_IMAGES]
         common.ZipWriteStr(target_zip, info.filename,
@@ -786,16 +782,29 @@ def GetTargetFilesZipForSecondaryImages(input_file, skip_postinstall=False):
       # Remove the unnecessary partitions from the dynamic partitions list.
       elif (info.filename == 'META/misc_info.txt' or
             info.filename == DYNAMIC_PARTITION_INFO):
-        modified_info = GetInfoForSecondaryImages(unzipped_file)
+        modified_info = GetInfoForSecondaryImages(
+            input_zip.read(info).decode())
         common.ZipWriteStr(target_zip, info.filename, modified_info)
       else:
-        common.ZipWrite(target_zip, unzipped_file, arcname=info.filename)
+        common.ZipCopyRaw(input_zip, target_zip, info)
 
+  input_zip.close()
   common.ZipClose(target_zip)
 
   return target_file
 
 
+def GetTargetFilesImageSize(input_file):
+  """Returns the total uncompressed size of the images in a target-files.zip.
+
+  This serves as an estimate of the temp space needed to generate a payload
+  from the given target-files.zip.
+  """
+  with zipfile.ZipFile(input_file, allowZip64=True) as input_zip:
+    return sum(info.file_size for info in input_zip.infolist()
+               if info.filename.startswith(('IMAGES/', 'RADIO/')))
+
+
 def GetTargetFilesZipWithoutPostinstallConfig(input_file):
   """Returns a target-files.zip that's not containing postinstall_config.txt.
 
@@ -1249,31 +1258,51 @@ def GenerateAbOtaPackage(target_file, output_file, source_file=None):
         "Detected build with mainline GKI, include full boot image.")
     additional_args.extend(["--full_boot", "true"])
 
-  payload.Generate(
-      target_file,
-      source_file,
-      additional_args + partition_timestamps_flags
-  )
-
-  # Sign the payload.
   payload_signer = PayloadSigner()
-  payload.Sign(payload_signer)
 
-  # Write the payload into output zip.
-  payload.WriteToZip(output_zip)
+  def GeneratePrimaryPayload():
+    payload.Generate(
+        target_file,
+        source_file,
+        additional_args + partition_timestamps_flags
+    )
+    payload.Sign(payload_signer)
 
-  # Generate and include the secondary payload that installs secondary images
-  # (e.g. system_other.img).
-  if OPTIONS.include_secondary:
+  # Generate the secondary payload that installs secondary images (e.g.
+  # system_other.img). It only depends on the final target_file, so it's built
+  # alongside the primary payload.
+  secondary_payload = Payload(secondary=True)
+
+  def GenerateSecondaryPayload():
     # We always include a full payload for the secondary slot, even when
     # building an incremental OTA. See the comments for "--include_secondary".
     secondary_target_file = GetTargetFilesZipForSecondaryImages(
         target_file, OPTIONS.skip_postinstall)
-    secondary_payload = Payload(secondary=True)
     secondary_payload.Generate(secondary_target_file,
                                additional_args=["--max_timestamp",
                                                 max_timestamp])
+    # Release the temp space early, as the primary payload may still be
+    # running.
+    common.RemoveTempFile(secondary_target_file)
     secondary_payload.Sign(payload_signer)
+
+  # Only run the two in parallel if the temp dir can hold both at a time.
+  image_size = GetTargetFilesImageSize(target_file)
+  tasks = common.TaskGraph(
+      num_workers=2,
+      budget=shutil.disk_usage(tempfile.gettempdir()).free)
+  tasks.AddTask("payload", GeneratePrimaryPayload, cost=image_size)
+  if OPTIONS.include_secondary:
+    # Holds both the secondary target-files and its payload.
+    tasks.AddTask("secondary_payload", GenerateSecondaryPayload,
+                  cost=2 * image_size)
+  tasks.Run()
+  for name, duration in tasks.durations.items():
+    logger.info("Generated %s in %.2f sec", name, duration)
+
+  # Write the payloads into output zip.
+  payload.WriteToZip(output_zip)
+  if OPTIONS.include_secondary:
     secondary_payload.WriteToZip(output_zip)
 
   # If dm-verity is supported for the device, copy contents of care_map
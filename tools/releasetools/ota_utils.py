@@ -22,7 +22,8 @@ import zipfile
 import ota_metadata_pb2
 from common import (ZipDelete, ZipClose, OPTIONS, MakeTempFile,
                     ZipWriteStr, BuildInfo, LoadDictionaryFromFile,
-                    SignFile, PARTITIONS_WITH_BUILD_PROP, PartitionBuildProps)
+                    SignFile, PARTITIONS_WITH_BUILD_PROP, PartitionBuildProps,
+                    ZipOverwriteStoredEntry, ExternalError)
 
 logger = logging.getLogger(__name__)
 
@@ -110,11 +111,20 @@ def FinalizeMetadata(metadata, input_file, output_file, needed_property_files):
         prelim_signing, needed_property_files)
     FinalizeAllPropertyFiles(prelim_signing, needed_property_files)
 
-  # Replace the METADATA entry.
-  ZipDelete(prelim_signing, [METADATA_NAME, METADATA_PROTO_NAME])
-  output_zip = zipfile.ZipFile(prelim_signing, 'a', allowZip64=True)
-  WriteMetadata(metadata, output_zip)
-  ZipClose(output_zip)
+  # Replace the METADATA entries. Finalize() pads the property-files strings to
+  # the reserved length, so the entries keep their sizes and can be updated in
+  # place, without rewriting the whole package.
+  metadata_proto_data, legacy_metadata = SerializeMetadata(metadata)
+  try:
+    ZipOverwriteStoredEntry(
+        prelim_signing, METADATA_PROTO_NAME, metadata_proto_data)
+    ZipOverwriteStoredEntry(prelim_signing, METADATA_NAME, legacy_metadata)
+  except ExternalError:
+    logger.warning("Failed to update the metadata in place", exc_info=True)
+    ZipDelete(prelim_signing, [METADATA_NAME, METADATA_PROTO_NAME])
+    output_zip = zipfile.ZipFile(prelim_signing, 'a', allowZip64=True)
+    WriteMetadata(metadata, output_zip)
+    ZipClose(output_zip)
 
   # Re-sign the package after updating the metadata entry.
   if OPTIONS.no_signing:
@@ -134,6 +144,14 @@ def FinalizeMetadata(metadata, input_file, output_file, needed_property_files):
     WriteMetadata(metadata, output_metadata_path)
 
 
+def SerializeMetadata(metadata_proto):
+  """Returns the metadata in the protobuf and the legacy text formats."""
+  metadata_dict = BuildLegacyOtaMetadata(metadata_proto)
+  legacy_metadata = "".join(["%s=%s\n" % kv for kv in
+                             sorted(metadata_dict.items())])
+  return metadata_proto.SerializeToString(), legacy_metadata
+
+
 def WriteMetadata(metadata_proto, output):
   """Writes the metadata to the zip archive or a file.
 
@@ -144,18 +162,16 @@ def WriteMetadata(metadata_proto, output):
       {output}.pb, e.g. ota_metadata.pb
   """
 
-  metadata_dict = BuildLegacyOtaMetadata(metadata_proto)
-  legacy_metadata = "".join(["%s=%s\n" % kv for kv in
-                             sorted(metadata_dict.items())])
+  metadata_proto_data, legacy_metadata = SerializeMetadata(metadata_proto)
   if isinstance(output, zipfile.ZipFile):
-    ZipWriteStr(output, METADATA_PROTO_NAME, metadata_proto.SerializeToString(),
+    ZipWriteStr(output, METADATA_PROTO_NAME, metadata_proto_data,
                 compress_type=zipfile.ZIP_STORED)
     ZipWriteStr(output, METADATA_NAME, legacy_metadata,
                 compress_type=zipfile.ZIP_STORED)
     return
 
   with open('{}.pb'.format(output), 'wb') as f:
-    f.write(metadata_proto.SerializeToString())
+    f.write(metadata_proto_data)
   with open(output, 'w') as f:
     f.write(legacy_metadata)
 
@@ -542,7 +542,6 @@ def ProcessTargetFiles(input_tf_zip, output_tf_zip, misc_info,
     if filename.startswith("OTA/") and filename.endswith(".img"):
       continue
 
-    data = input_tf_zip.read(filename)
     out_info = copy.copy(info)
     (is_apk, is_compressed, should_be_skipped) = GetApkFileInfo(
         filename, compressed_extension, OPTIONS.skip_apks_with_path_prefix)
@@ -552,7 +551,7 @@ def ProcessTargetFiles(input_tf_zip, output_tf_zip, misc_info,
       print(
           "NOT signing: %s\n"
           "        (skipped due to matching prefix)" % (filename,))
-      common.ZipWriteStr(output_tf_zip, out_info, data)
+      common.ZipCopyRaw(input_tf_zip, output_tf_zip, out_info)
 
     # Sign APKs.
     elif is_apk:
@@ -563,6 +562,7 @@ def ProcessTargetFiles(input_tf_zip, output_tf_zip, misc_info,
       key = apk_keys[name]
       if key not in common.SPECIAL_CERT_STRINGS:
         print("    signing: %-*s (%s)" % (maxsize, name, key))
+        data = input_tf_zip.read(filename)
         signed_data = SignApk(data, key, key_passwords[key], platform_api_level,
                               codename_to_api_level_map, is_compressed, name)
         common.ZipWriteStr(output_tf_zip, out_info, signed_data)
@@ -571,7 +571,7 @@ def ProcessTargetFiles(input_tf_zip, output_tf_zip, misc_info,
         print(
             "NOT signing: %s\n"
             "        (skipped due to special cert string)" % (name,))
-        common.ZipWriteStr(output_tf_zip, out_info, data)
+        common.ZipCopyRaw(input_tf_zip, output_tf_zip, out_info)
 
     # Sign bundled APEX files on all partitions
     elif IsApexFile(filename):
@@ -589,7 +589,7 @@ def ProcessTargetFiles(input_tf_zip, output_tf_zip, misc_info,
 
         signed_apex = apex_utils.SignApex(
             misc_info['avb_avbtool'],
-            data,
+            input_tf_zip.read(filename),
             payload_key,
             container_key,
             key_passwords,
@@ -604,22 +604,22 @@ def ProcessTargetFiles(input_tf_zip, output_tf_zip, misc_info,
         print(
             "NOT signing: %s\n"
             "        (skipped due to special cert string)" % (name,))
-        common.ZipWriteStr(output_tf_zip, out_info, data)
+        common.ZipCopyRaw(input_tf_zip, output_tf_zip, out_info)
 
     # System properties.
     elif IsBuildPropFile(filename):
       print("Rewriting %s:" % (filename,))
       if stat.S_ISLNK(info.external_attr >> 16):
-        new_data = data
+        common.ZipCopyRaw(input_tf_zip, output_tf_zip, out_info)
       else:
-        new_data = RewriteProps(data.decode())
-      common.ZipWriteStr(output_tf_zip, out_info, new_data)
+        new_data = RewriteProps(input_tf_zip.read(filename).decode())
+        common.ZipWriteStr(output_tf_zip, out_info, new_data)
 
     # Replace the certs in *mac_permissions.xml (there could be multiple, such
     # as {system,vendor}/etc/selinux/{plat,vendor}_mac_permissions.xml).
     elif filename.endswith("mac_permissions.xml"):
       print("Rewriting %s with new keys." % (filename,))
-      new_data = ReplaceCerts(data.decode())
+      new_data = ReplaceCerts(input_tf_zip.read(filename).decode())
       common.ZipWriteStr(output_tf_zip, out_info, new_data)
 
     # Ask add_img_to_target_files to rebuild the recovery patch if needed.
@@ -658,7 +658,7 @@ def ProcessTargetFiles(input_tf_zip, output_tf_zip, misc_info,
           break
       if not matched_removal:
         # Copy it verbatim if we don't want to remove it.
-        common.ZipWriteStr(output_tf_zip, out_info, data)
+        common.ZipCopyRaw(input_tf_zip, output_tf_zip, out_info)
 
     # Skip verity keyid (for system_root_image use) if we will replace it.
     elif OPTIONS.replace_verity_keyid and filename == "BOOT/cmdline":
@@ -706,6 +706,7 @@ def ProcessTargetFiles(input_tf_zip, output_tf_zip, misc_info,
             misc_info['avb_avbtool'], payload_key)
         with open(new_pubkey_path, 'rb') as f:
           new_pubkey = f.read()
+        data = input_tf_zip.read(filename)
         pubkey_info = copy.copy(
             input_tf_zip.getinfo("PREBUILT_IMAGES/pvmfw_embedded.avbpubkey"))
         old_pubkey = input_tf_zip.read(pubkey_info.filename)
@@ -736,11 +737,11 @@ def ProcessTargetFiles(input_tf_zip, output_tf_zip, misc_info,
         raise common.ExternalError("debug sepolicy shouldn't be included")
       else:
         # Copy it verbatim if we allow the file to exist.
-        common.ZipWriteStr(output_tf_zip, out_info, data)
+        common.ZipCopyRaw(input_tf_zip, output_tf_zip, out_info)
 
     # A non-APK file; copy it verbatim.
     else:
-      common.ZipWriteStr(output_tf_zip, out_info, data)
+      common.ZipCopyRaw(input_tf_zip, output_tf_zip, out_info)
 
   if OPTIONS.replace_ota_keys:
     ReplaceOtaKeys(input_tf_zip, output_tf_zip, misc_info)
@@ -19,6 +19,7 @@ from __future__ import print_function
 import argparse
 import bisect
 import logging
+import mmap
 import os
 import struct
 import threading
@@ -28,6 +29,8 @@ import rangelib
 
 logger = logging.getLogger(__name__)
 
+CHUNK_HEADER = struct.Struct("<2H2I")
+
 
 class SparseImage(object):
   """Wraps a sparse image file into an image object.
@@ -38,11 +41,19 @@ class SparseImage(object):
   of blocks that should be always written to the target regardless of the old
   contents (i.e. copying instead of patching). clobbered_blocks should be in
   the form of a string like "0" or "0 1-5 8".
+
+  With lazy=True, the chunk headers are only parsed on the first access to
+  care_map (or offset_map), and extended and file_map are only computed when
+  accessed. This suits callers like GetCareMap() that only need the header
+  level data.
   """
 
+  # The attributes that a lazy image computes on first access.
+  CHUNK_ATTRIBUTES = ("care_map", "offset_map", "offset_index")
+
   def __init__(self, simg_fn, file_map_fn=None, clobbered_blocks=None,
                mode="rb", build_map=True, allow_shared_blocks=False,
-               hashtree_info_generator=None):
+               hashtree_info_generator=None, lazy=False):
     self.simg_f = f = open(simg_fn, mode)
 
     header_bin = f.read(28)
@@ -78,67 +89,122 @@ class SparseImage(object):
         "Cannot generate the hashtree info without building the offset map."
       return
 
-    pos = 0   # in blocks
-    care_data = []
-    self.offset_map = offset_map = []
     self.clobbered_blocks = rangelib.RangeSet(data=clobbered_blocks)
+    self.generator_lock = threading.Lock()
+    self.hashtree_info = None
 
-    for i in range(total_chunks):
-      header_bin = f.read(12)
-      header = struct.unpack("<2H2I", header_bin)
-      chunk_type = header[0]
-      chunk_sz = header[2]
-      total_sz = header[3]
-      data_sz = total_sz - 12
-
-      if chunk_type == 0xCAC1:
-        if data_sz != (chunk_sz * blk_sz):
-          raise ValueError(
-              "Raw chunk input size (%u) does not match output size (%u)" %
-              (data_sz, chunk_sz * blk_sz))
-        else:
-          care_data.append(pos)
-          care_data.append(pos + chunk_sz)
-          offset_map.append((pos, chunk_sz, f.tell(), None))
-          pos += chunk_sz
-          f.seek(data_sz, os.SEEK_CUR)
-
-      elif chunk_type == 0xCAC2:
-        fill_data = f.read(4)
-        care_data.append(pos)
-        care_data.append(pos + chunk_sz)
-        offset_map.append((pos, chunk_sz, None, fill_data))
-        pos += chunk_sz
-
-      elif chunk_type == 0xCAC3:
-        if data_sz != 0:
-          raise ValueError("Don't care chunk input size is non-zero (%u)" %
-                           (data_sz))
-        # Fills the don't care data ranges with zeros.
-        # TODO(xunchang) pass the care_map to hashtree info generator.
-        if hashtree_info_generator:
-          fill_data = '\x00' * 4
-          # In order to compute verity hashtree on device, we need to write
-          # zeros explicitly to the don't care ranges. Because these ranges may
-          # contain non-zero data from the previous build.
+    if lazy:
+      assert not hashtree_info_generator, \
+        "Cannot generate the hashtree info for a lazy image."
+      self.lazy = True
+      self._file_map_args = (file_map_fn, allow_shared_blocks)
+      return
+
+    self._ParseChunks(hashtree_info_generator is not None)
+    self.extended = self._GetExtendedBlocks()
+
+    if hashtree_info_generator:
+      self.hashtree_info = hashtree_info_generator.Generate(self)
+
+    if file_map_fn:
+      self.LoadFileBlockMap(file_map_fn, self.clobbered_blocks,
+                            allow_shared_blocks)
+    else:
+      self.file_map = {"__DATA": self.care_map}
+
+  def __getattr__(self, name):
+    # Only called for the attributes that haven't been set yet, i.e. the ones
+    # that a lazy image hasn't computed so far.
+    if not self.__dict__.get("lazy"):
+      raise AttributeError(name)
+
+    if name in self.CHUNK_ATTRIBUTES:
+      self._ParseChunks(False)
+    elif name == "extended":
+      self.extended = self._GetExtendedBlocks()
+    elif name == "file_map":
+      file_map_fn, allow_shared_blocks = self._file_map_args
+      if file_map_fn:
+        self.LoadFileBlockMap(file_map_fn, self.clobbered_blocks,
+                              allow_shared_blocks)
+      else:
+        self.file_map = {"__DATA": self.care_map}
+    else:
+      raise AttributeError(name)
+    return self.__dict__[name]
+
+  def _ParseChunks(self, fill_dont_care):
+    """Parses the chunk headers into care_map, offset_map and offset_index.
+
+    The headers are read from an mmap of the image, rather than seeking and
+    reading the file once per chunk.
+
+    Args:
+      fill_dont_care: Whether to treat the don't care chunks as zero-filled
+          data, which is needed to compute the verity hashtree.
+    """
+    blk_sz = self.blocksize
+    pos = 0   # in blocks
+    care_data = []
+    offset_map = []
+
+    with mmap.mmap(self.simg_f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+      offset = 28
+      for _ in range(self.total_chunks):
+        chunk_type, _, chunk_sz, total_sz = CHUNK_HEADER.unpack_from(
+            data, offset)
+        offset += CHUNK_HEADER.size
+        data_sz = total_sz - CHUNK_HEADER.size
+
+        if chunk_type == 0xCAC1:
+          if data_sz != (chunk_sz * blk_sz):
+            raise ValueError(
+                "Raw chunk input size (%u) does not match output size (%u)" %
+                (data_sz, chunk_sz * blk_sz))
+          else:
+            care_data.append(pos)
+            care_data.append(pos + chunk_sz)
+            offset_map.append((pos, chunk_sz, offset, None))
+            pos += chunk_sz
+            offset += data_sz
+
+        elif chunk_type == 0xCAC2:
+          fill_data = data[offset:offset + 4]
           care_data.append(pos)
           care_data.append(pos + chunk_sz)
           offset_map.append((pos, chunk_sz, None, fill_data))
+          pos += chunk_sz
+          offset += data_sz
+
+        elif chunk_type == 0xCAC3:
+          if data_sz != 0:
+            raise ValueError("Don't care chunk input size is non-zero (%u)" %
+                             (data_sz))
+          # Fills the don't care data ranges with zeros.
+          # TODO(xunchang) pass the care_map to hashtree info generator.
+          if fill_dont_care:
+            fill_data = '\x00' * 4
+            # In order to compute verity hashtree on device, we need to write
+            # zeros explicitly to the don't care ranges. Because these ranges
+            # may contain non-zero data from the previous build.
+            care_data.append(pos)
+            care_data.append(pos + chunk_sz)
+            offset_map.append((pos, chunk_sz, None, fill_data))
 
-        pos += chunk_sz
-
-      elif chunk_type == 0xCAC4:
-        raise ValueError("CRC32 chunks are not supported")
+          pos += chunk_sz
 
-      else:
-        raise ValueError("Unknown chunk type 0x%04X not supported" %
-                         (chunk_type,))
+        elif chunk_type == 0xCAC4:
+          raise ValueError("CRC32 chunks are not supported")
 
-    self.generator_lock = threading.Lock()
+        else:
+          raise ValueError("Unknown chunk type 0x%04X not supported" %
+                           (chunk_type,))
 
     self.care_map = rangelib.RangeSet(care_data)
+    self.offset_map = offset_map
     self.offset_index = [i[0] for i in offset_map]
 
+  def _GetExtendedBlocks(self):
     # Bug: 20881595
     # Introduce extended blocks as a workaround for the bug. dm-verity may
     # touch blocks that are not in the care_map due to block device
@@ -147,18 +213,7 @@ class SparseImage(object):
     # are the maximum read-ahead we configure for dm-verity block devices.
     extended = self.care_map.extend(512)
     all_blocks = rangelib.RangeSet(data=(0, self.total_blocks))
-    extended = extended.intersect(all_blocks).subtract(self.care_map)
-    self.extended = extended
-
-    self.hashtree_info = None
-    if hashtree_info_generator:
-      self.hashtree_info = hashtree_info_generator.Generate(self)
-
-    if file_map_fn:
-      self.LoadFileBlockMap(file_map_fn, self.clobbered_blocks,
-                            allow_shared_blocks)
-    else:
-      self.file_map = {"__DATA": self.care_map}
+    return extended.intersect(all_blocks).subtract(self.care_map)
 
   def AppendFillChunk(self, data, blocks):
     f = self.simg_f
@@ -183,6 +238,11 @@ class SparseImage(object):
   def ReadRangeSet(self, ranges):
     return [d for d in self._GetRangeData(ranges)]
 
+  def IterRangeSet(self, ranges):
+    """Like ReadRangeSet(), but yields the pieces one at a time so that large
+    ranges don't have to be held in memory."""
+    return self._GetRangeData(ranges)
+
   def TotalSha1(self, include_clobbered_blocks=False):
     """Return the SHA-1 hash of all data in the 'care' regions.
 
@@ -18,11 +18,18 @@ import os
 import os.path
 import zipfile
 
+import build_image
 import common
 import test_utils
 from add_img_to_target_files import (
     AddPackRadioImages,
-    CheckAbOtaImages)
+    CheckAbOtaImages,
+    ComputeImageFingerprint,
+    CreateImage,
+    DeferredOutputZip,
+    OptimizeCompressedEntries,
+    OutputFile,
+    _GetTreeSize)
 from rangelib import RangeSet
 from common import AddCareMapForAbOta, GetCareMap
 
@@ -427,3 +434,238 @@ class AddImagesToTargetFilesTest(test_utils.ReleaseToolsTestCase):
     name, care_map = GetCareMap('system', 'foo')
     self.assertEqual('system', name)
     self.assertEqual(RangeSet("0-12").to_string_raw(), care_map)
+
+  def test_OptimizeCompressedEntries(self):
+    incompressible = os.urandom(65536)
+    compressible = b'a' * 65536
+    target_files = common.MakeTempFile(suffix='.zip')
+    with zipfile.ZipFile(target_files, 'w', allowZip64=True) as target_zip:
+      for name, data in (('IMAGES/system.img', incompressible),
+                         ('IMAGES/vendor.img', compressible),
+                         ('IMAGES/userdata.img', incompressible),
+                         ('META/care_map.pb', incompressible),
+                         ('SYSTEM/bin/foo', incompressible)):
+        common.ZipWriteStr(target_zip, name, data,
+                           compress_type=zipfile.ZIP_DEFLATED)
+    os.chmod(target_files, 0o644)
+
+    # Entries to be replaced are taken from OPTIONS.input_tmp.
+    os.mkdir(os.path.join(OPTIONS.input_tmp, 'META'))
+    with open(os.path.join(OPTIONS.input_tmp, 'META', 'care_map.pb'),
+              'wb') as f:
+      f.write(b'new-care-map')
+
+    OptimizeCompressedEntries(target_files, ['META/care_map.pb'])
+
+    with zipfile.ZipFile(target_files, allowZip64=True) as verify_zip:
+      self.assertIsNone(verify_zip.testzip())
+      self.assertEqual(
+          ['IMAGES/system.img', 'IMAGES/vendor.img', 'IMAGES/userdata.img',
+           'SYSTEM/bin/foo', 'META/care_map.pb'],
+          verify_zip.namelist())
+      expected = {
+          'IMAGES/system.img': zipfile.ZIP_STORED,
+          'IMAGES/vendor.img': zipfile.ZIP_DEFLATED,
+          'IMAGES/userdata.img': zipfile.ZIP_DEFLATED,
+          'SYSTEM/bin/foo': zipfile.ZIP_DEFLATED,
+      }
+      for name, compress_type in expected.items():
+        self.assertEqual(compress_type, verify_zip.getinfo(name).compress_type)
+      self.assertEqual(incompressible, verify_zip.read('IMAGES/system.img'))
+      self.assertEqual(compressible, verify_zip.read('IMAGES/vendor.img'))
+      self.assertEqual(b'new-care-map', verify_zip.read('META/care_map.pb'))
+    self.assertEqual(0o644, os.stat(target_files).st_mode & 0o777)
+
+  def test_OptimizeCompressedEntries_nothingToDo(self):
+    target_files = common.MakeTempFile(suffix='.zip')
+    with zipfile.ZipFile(target_files, 'w', allowZip64=True) as target_zip:
+      common.ZipWriteStr(target_zip, 'IMAGES/vendor.img', b'a' * 65536,
+                         compress_type=zipfile.ZIP_DEFLATED)
+    expected_stat = os.stat(target_files)
+
+    OptimizeCompressedEntries(target_files)
+
+    self.assertEqual(expected_stat.st_ino, os.stat(target_files).st_ino)
+    self.assertEqual(expected_stat.st_mtime, os.stat(target_files).st_mtime)
+
+  def test_DeferredOutputZip(self):
+    image = os.path.join(OPTIONS.input_tmp, 'system.img')
+    with open(image, 'wb') as f:
+      f.write(b'system-image')
+
+    def write_files(output_zip):
+      common.ZipWrite(output_zip, image, 'IMAGES/system.img')
+      common.ZipWriteStr(output_zip, 'META/foo.txt', 'foo')
+      common.ZipWrite(output_zip, image, 'IMAGES/system.map', perms=0o600,
+                      compress_type=zipfile.ZIP_STORED)
+
+    expected_zip_file = common.MakeTempFile(suffix='.zip')
+    with zipfile.ZipFile(expected_zip_file, 'w',
+                         compression=zipfile.ZIP_DEFLATED) as expected_zip:
+      write_files(expected_zip)
+
+    output_zip_file = common.MakeTempFile(suffix='.zip')
+    with zipfile.ZipFile(output_zip_file, 'w',
+                         compression=zipfile.ZIP_DEFLATED) as output_zip:
+      common.ZipWriteStr(output_zip, 'META/bar.txt', 'bar')
+      deferred_zip = DeferredOutputZip(output_zip)
+      write_files(deferred_zip)
+      # Nothing gets written until it's replayed.
+      self.assertEqual(['META/bar.txt'], output_zip.namelist())
+      self.assertEqual(
+          ['META/bar.txt', 'IMAGES/system.img', 'META/foo.txt',
+           'IMAGES/system.map'],
+          deferred_zip.namelist())
+      deferred_zip.Replay()
+
+    with zipfile.ZipFile(expected_zip_file) as expected_zip, \
+        zipfile.ZipFile(output_zip_file) as output_zip:
+      self.assertEqual(['META/bar.txt'] + expected_zip.namelist(),
+                       output_zip.namelist())
+      for expected in expected_zip.infolist():
+        actual = output_zip.getinfo(expected.filename)
+        for attr in ('date_time', 'external_attr', 'compress_type', 'CRC'):
+          self.assertEqual(getattr(expected, attr), getattr(actual, attr))
+
+  def test_ComputeImageFingerprint(self):
+    system_dir = os.path.join(OPTIONS.input_tmp, 'SYSTEM')
+    os.makedirs(os.path.join(system_dir, 'bin'))
+    with open(os.path.join(system_dir, 'bin', 'foo'), 'w') as f:
+      f.write('foo')
+    os.symlink('foo', os.path.join(system_dir, 'bin', 'bar'))
+    fs_config = common.MakeTempFile()
+    with open(fs_config, 'w') as f:
+      f.write('system/bin/foo 0 2000 0755\n')
+    image_props = {
+        'fs_type': 'ext4',
+        'fs_config': fs_config,
+        'block_list': common.MakeTempFile(),
+    }
+
+    fingerprint = ComputeImageFingerprint(
+        OPTIONS.input_tmp, 'system', image_props)
+    self.assertEqual(fingerprint, ComputeImageFingerprint(
+        OPTIONS.input_tmp, 'system', image_props))
+
+    # The outputs of the build don't count.
+    image_props['block_list'] = common.MakeTempFile()
+    self.assertEqual(fingerprint, ComputeImageFingerprint(
+        OPTIONS.input_tmp, 'system', image_props))
+
+    # Nor does the staged tree of another partition.
+    os.mkdir(os.path.join(OPTIONS.input_tmp, 'VENDOR'))
+    self.assertEqual(fingerprint, ComputeImageFingerprint(
+        OPTIONS.input_tmp, 'system', image_props))
+
+    fingerprints = set([fingerprint])
+    with open(fs_config, 'a') as f:
+      f.write('system/bin/bar 0 2000 0755\n')
+    fingerprints.add(ComputeImageFingerprint(
+        OPTIONS.input_tmp, 'system', image_props))
+
+    with open(os.path.join(system_dir, 'bin', 'foo'), 'w') as f:
+      f.write('FOO')
+    fingerprints.add(ComputeImageFingerprint(
+        OPTIONS.input_tmp, 'system', image_props))
+
+    os.remove(os.path.join(system_dir, 'bin', 'bar'))
+    os.symlink('baz', os.path.join(system_dir, 'bin', 'bar'))
+    fingerprints.add(ComputeImageFingerprint(
+        OPTIONS.input_tmp, 'system', image_props))
+
+    image_props['fs_type'] = 'erofs'
+    fingerprints.add(ComputeImageFingerprint(
+        OPTIONS.input_tmp, 'system', image_props))
+    self.assertEqual(5, len(fingerprints))
+
+  def test_GetTreeSize(self):
+    system_dir = os.path.join(OPTIONS.input_tmp, 'SYSTEM')
+    os.makedirs(os.path.join(system_dir, 'bin'))
+    with open(os.path.join(system_dir, 'bin', 'foo'), 'wb') as f:
+      f.write(b'x' * 1000)
+    with open(os.path.join(system_dir, 'bar'), 'wb') as f:
+      f.write(b'x' * 24)
+    os.symlink('bin/foo', os.path.join(system_dir, 'link'))
+    self.assertEqual(1024, _GetTreeSize(system_dir))
+    self.assertEqual(0, _GetTreeSize(os.path.join(OPTIONS.input_tmp, 'ODM')))
+
+  def test_ComputeImageFingerprint_inputDirIndependent(self):
+    fingerprints = set()
+    for _ in range(2):
+      input_dir = common.MakeTempDir()
+      os.makedirs(os.path.join(input_dir, 'SYSTEM', 'bin'))
+      os.mkdir(os.path.join(input_dir, 'META'))
+      with open(os.path.join(input_dir, 'SYSTEM', 'bin', 'foo'), 'w') as f:
+        f.write('foo')
+      fs_config = os.path.join(input_dir, 'META', 'filesystem_config.txt')
+      with open(fs_config, 'w') as f:
+        f.write('system/bin/foo 0 2000 0755\n')
+      image_props = {
+          'fs_type': 'ext4',
+          'fs_config': fs_config,
+          'avb_add_hashtree_footer_args':
+              '--prop_file ' + os.path.join(input_dir, 'META', 'props'),
+      }
+      fingerprints.add(
+          ComputeImageFingerprint(input_dir, 'system', image_props))
+    self.assertEqual(1, len(fingerprints))
+
+  def test_CreateImage_upToDate(self):
+    system_dir = os.path.join(OPTIONS.input_tmp, 'SYSTEM')
+    os.mkdir(system_dir)
+    with open(os.path.join(system_dir, 'foo'), 'w') as f:
+      f.write('foo')
+    info_dict = {
+        'build.prop': common.PartitionBuildProps.FromDictionary(
+            'system', {
+                'ro.build.fingerprint': 'build-fingerprint',
+                'ro.product.device': 'product-device'}),
+        'system.build.prop': common.PartitionBuildProps.FromDictionary(
+            'system', {'ro.system.build.fingerprint': 'build-fingerprint'}),
+        'avb_enable': 'true',
+        'avb_system_hashtree_enable': 'true',
+    }
+    OPTIONS.image_build_manifest = {}
+    img = OutputFile(None, OPTIONS.input_tmp, 'IMAGES', 'system.img')
+    os.mkdir(os.path.dirname(img.name))
+
+    built_images = []
+
+    def BuildImage(in_dir, prop_dict, out_file):
+      built_images.append(in_dir)
+      with open(out_file, 'w') as f:
+        f.write('image')
+      prop_dict['image_size'] = '4096'
+
+    build_image_func = build_image.BuildImage
+    build_image.BuildImage = BuildImage
+    try:
+      # Without --add_missing, the image is always built and not recorded.
+      CreateImage(OPTIONS.input_tmp, info_dict, 'system', img)
+      CreateImage(OPTIONS.input_tmp, info_dict, 'system', img)
+      self.assertEqual(2, len(built_images))
+      self.assertEqual({}, OPTIONS.image_build_manifest)
+
+      del built_images[:]
+      OPTIONS.add_missing = True
+      CreateImage(OPTIONS.input_tmp, info_dict, 'system', img)
+      self.assertEqual(1, len(built_images))
+      self.assertEqual(4096, info_dict['system_image_size'])
+      self.assertEqual(
+          {'system_image_size': 4096},
+          OPTIONS.image_build_manifest['system']['info'])
+
+      # Reuses the existing image, and restores the info set by the build.
+      del info_dict['system_image_size']
+      CreateImage(OPTIONS.input_tmp, info_dict, 'system', img)
+      self.assertEqual(1, len(built_images))
+      self.assertEqual(4096, info_dict['system_image_size'])
+
+      with open(os.path.join(system_dir, 'foo'), 'w') as f:
+        f.write('FOO')
+      CreateImage(OPTIONS.input_tmp, info_dict, 'system', img)
+      self.assertEqual(2, len(built_images))
+    finally:
+      build_image.BuildImage = build_image_func
+      OPTIONS.add_missing = False
+      OPTIONS.image_build_manifest = {}
@@ -16,12 +16,14 @@
 
 import filecmp
 import os.path
+import re
 
 import common
 import test_utils
 from build_image import (
-    BuildImageError, CheckHeadroom, GetFilesystemCharacteristics,
-    SetUpInDirAndFsConfig)
+    BuildImageError, CheckHeadroom, EstimateExt4Image, Ext4Estimate,
+    GetFilesystemCharacteristics, SetUpInDirAndFsConfig, _CheckExt4Estimate,
+    _ShrinkExt4Size)
 
 
 class BuildImageTest(test_utils.ReleaseToolsTestCase):
@@ -202,3 +204,121 @@ class BuildImageTest(test_utils.ReleaseToolsTestCase):
     self.assertGreater(int(fs_dict['Inode count']), 0)      # expect ~64
     self.assertGreaterEqual(int(fs_dict['Free inodes']), 0) # expect ~53
     self.assertGreater(int(fs_dict['Inode count']), int(fs_dict['Free inodes']))
+
+  @staticmethod
+  def _CreateExt4Tree():
+    input_dir = common.MakeTempDir()
+    os.makedirs(os.path.join(input_dir, 'bin'))
+    os.makedirs(os.path.join(input_dir, 'etc', 'init'))
+    for name, size in (('bin/foo', 123456), ('etc/bar', 0),
+                       ('etc/init/baz.rc', 4096)):
+      with open(os.path.join(input_dir, name), 'wb') as f:
+        f.write(b'x' * size)
+    os.symlink('/system/bin/foo', os.path.join(input_dir, 'bin', 'link'))
+    return input_dir
+
+  def test_EstimateExt4Image(self):
+    input_dir = self._CreateExt4Tree()
+    prop_dict = {
+        'fs_type': 'ext4',
+        'journal_size': '0',
+        'mount_point': 'system',
+    }
+    estimate = EstimateExt4Image(input_dir, prop_dict)
+    # 7 entries, plus the 11 reserved inodes, plus 1 spare.
+    self.assertEqual(19, estimate.inodes)
+    # The files take 32 blocks, the directories 4 and lost+found 4.
+    self.assertGreater(estimate.used_blocks, 40)
+    self.assertEqual(0, estimate.size % 4096)
+    # The .3% margin, while the image is padded to the 256K minimum.
+    self.assertEqual(estimate.used_blocks * 4096 * 3 // 1000,
+                     estimate.reserved_size)
+    self.assertEqual(256 * 1024, estimate.size)
+
+  def test_EstimateExt4Image_ReservedSize(self):
+    input_dir = self._CreateExt4Tree()
+    prop_dict = {
+        'fs_type': 'ext4',
+        'journal_size': '16',
+        'mount_point': 'system',
+        'partition_reserved_size': str(8 * 1024 * 1024),
+    }
+    estimate = EstimateExt4Image(input_dir, prop_dict)
+    self.assertEqual(8 * 1024 * 1024, estimate.reserved_size)
+    self.assertEqual(estimate.used_blocks * 4096 + 8 * 1024 * 1024,
+                     estimate.size)
+    # The journal takes 16MB.
+    self.assertGreater(estimate.used_blocks, 4096)
+
+  def test_EstimateExt4Image_Unsupported(self):
+    input_dir = self._CreateExt4Tree()
+    prop_dict = {
+        'fs_type': 'ext4',
+        'ext4_share_dup_blocks': 'true',
+        'mount_point': 'system',
+    }
+    self.assertIsNone(EstimateExt4Image(input_dir, prop_dict))
+
+  def test_EstimateExt4Image_Headroom(self):
+    input_dir = self._CreateExt4Tree()
+    prop_dict = {
+        'fs_type': 'ext4',
+        'journal_size': '0',
+        'mount_point': 'system',
+        'partition_headroom': str(4 * 1024 * 1024),
+    }
+    estimate = EstimateExt4Image(input_dir, prop_dict)
+    self.assertEqual(4 * 1024 * 1024, estimate.reserved_size)
+
+    # The first pass reserves the same headroom as the estimate.
+    fs_dict = {
+        'Block size': '4096',
+        'Block count': '10000',
+        'Free blocks': '9000',
+        'Inode count': '100',
+        'Free inodes': '50',
+    }
+    prop_dict['extfs_inode_count'] = '100'
+    self.assertEqual(1000 * 4096 + 4 * 1024 * 1024,
+                     _ShrinkExt4Size(10000 * 4096, fs_dict, prop_dict))
+
+  def test_CheckExt4Estimate(self):
+    # 1000 blocks estimated to be used, and 100 blocks reserved.
+    estimate = Ext4Estimate(1000, 4096, 1100 * 4096, 100, 100 * 4096)
+
+    def fs_dict(free_blocks):
+      return {
+          'Block size': '4096',
+          'Block count': '1100',
+          'Free blocks': str(free_blocks),
+          'Free inodes': '1',
+      }
+
+    self.assertTrue(_CheckExt4Estimate(estimate, fs_dict(100), 'foo', 1))
+    self.assertTrue(_CheckExt4Estimate(estimate, fs_dict(108), 'foo', 1))
+    # Short of the reserved space.
+    self.assertFalse(_CheckExt4Estimate(estimate, fs_dict(99), 'foo', 1))
+    # Larger than the image that the first pass would give.
+    self.assertFalse(_CheckExt4Estimate(estimate, fs_dict(109), 'foo', 1))
+
+  @test_utils.SkipIfExternalToolsUnavailable()
+  def test_EstimateExt4Image_MatchesMkfs(self):
+    input_dir = self._CreateExt4Tree()
+    prop_dict = {
+        'fs_type': 'ext4',
+        'journal_size': '0',
+        'mount_point': 'system',
+    }
+    estimate = EstimateExt4Image(input_dir, prop_dict)
+    output_image = common.MakeTempFile(suffix='.img')
+    command = ['mkuserimg_mke2fs', input_dir, output_image, 'ext4',
+               '/system', str(estimate.size), '-j', '0', '-i',
+               str(estimate.inodes)]
+    output = common.RunAndCheckOutput(command)
+    m = re.search(r'([0-9]+)/([0-9]+) inodes and ([0-9]+)/([0-9]+) blocks',
+                  output)
+    used_inodes, _, used_blocks, _ = map(int, m.groups())
+    self.assertGreater(estimate.inodes, used_inodes)
+    # The estimate may be slightly pessimistic, but never short.
+    self.assertLessEqual(used_blocks, estimate.used_blocks)
+    self.assertLess(estimate.used_blocks - used_blocks, 8)
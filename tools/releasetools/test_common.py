@@ -19,12 +19,14 @@ import json
 import os
 import subprocess
 import tempfile
+import threading
 import time
 import unittest
 import zipfile
 from hashlib import sha1
 
 import common
+import sparse_img
 import test_utils
 import validate_target_files
 from images import EmptyImage, DataImage
@@ -636,6 +638,13 @@ class CommonZipTest(test_utils.ReleaseToolsTestCase):
     zinfo = zipfile.ZipInfo(filename="foo")
     self._test_reset_ZIP64_LIMIT(self._test_ZipWriteStr, zinfo, b'')
 
+  def test_ZipWriteStr_resets_ZIP64_LIMIT_onError(self):
+    zip_file = zipfile.ZipFile(common.MakeTempFile(suffix='.zip'), 'w')
+    zip_file.close()
+    self.assertRaises(ValueError, self._test_reset_ZIP64_LIMIT,
+                      common.ZipWriteStr, zip_file, 'foo', b'')
+    self.assertEqual((1 << 31) - 1, zipfile.ZIP64_LIMIT)
+
   def test_bug21309935(self):
     zip_file = tempfile.NamedTemporaryFile(delete=False)
     zip_file_name = zip_file.name
@@ -673,7 +682,112 @@ class CommonZipTest(test_utils.ReleaseToolsTestCase):
     finally:
       os.remove(zip_file_name)
 
-  @test_utils.SkipIfExternalToolsUnavailable()
+  def test_ZipCopyRaw(self):
+    input_file = common.MakeTempFile(suffix='.zip')
+    output_file = common.MakeTempFile(suffix='.zip')
+    random_string = os.urandom(1024)
+    compressible_string = b'a' * 65536
+    with zipfile.ZipFile(input_file, 'w', allowZip64=True) as input_zip:
+      common.ZipWriteStr(input_zip, 'foo', random_string)
+      common.ZipWriteStr(input_zip, 'bar', compressible_string, perms=0o755,
+                         compress_type=zipfile.ZIP_DEFLATED)
+
+    with zipfile.ZipFile(input_file, 'r', allowZip64=True) as input_zip, \
+        zipfile.ZipFile(output_file, 'w', allowZip64=True) as output_zip:
+      common.ZipCopyRaw(input_zip, output_zip, 'foo')
+      common.ZipCopyRaw(input_zip, output_zip, input_zip.getinfo('bar'))
+      common.ZipCopyRaw(input_zip, output_zip, 'bar', arcname='baz',
+                        perms=0o400)
+      # Mixing with regular writes should still work.
+      common.ZipWriteStr(output_zip, 'qux', random_string)
+
+    self._verify(None, output_file, 'foo', sha1(random_string).hexdigest())
+    self._verify(None, output_file, 'bar',
+                 sha1(compressible_string).hexdigest(), expected_mode=0o755,
+                 expected_compress_type=zipfile.ZIP_DEFLATED)
+    self._verify(None, output_file, 'baz',
+                 sha1(compressible_string).hexdigest(), expected_mode=0o400,
+                 expected_compress_type=zipfile.ZIP_DEFLATED)
+    self._verify(None, output_file, 'qux', sha1(random_string).hexdigest())
+
+    # The compressed data should be copied as is.
+    with zipfile.ZipFile(input_file, 'r', allowZip64=True) as input_zip, \
+        zipfile.ZipFile(output_file, 'r', allowZip64=True) as output_zip:
+      self.assertEqual(input_zip.getinfo('bar').compress_size,
+                       output_zip.getinfo('baz').compress_size)
+      self.assertEqual(input_zip.getinfo('bar').CRC,
+                       output_zip.getinfo('baz').CRC)
+
+  def test_ZipCopyRaw_resets_ZIP64_LIMIT(self):
+    input_file = common.MakeTempFile(suffix='.zip')
+    output_file = common.MakeTempFile(suffix='.zip')
+    with zipfile.ZipFile(input_file, 'w', allowZip64=True) as input_zip:
+      common.ZipWriteStr(input_zip, 'foo', b'')
+    with zipfile.ZipFile(input_file, 'r', allowZip64=True) as input_zip, \
+        zipfile.ZipFile(output_file, 'w', allowZip64=True) as output_zip:
+      self._test_reset_ZIP64_LIMIT(
+          common.ZipCopyRaw, input_zip, output_zip, 'foo')
+
+  def test_ZipClose_holds_ZIP64_LIMIT_lock(self):
+    zip_file = zipfile.ZipFile(common.MakeTempFile(suffix='.zip'), 'w',
+                               allowZip64=True)
+    lock_available = []
+    close = zip_file.close
+
+    def try_lock():
+      acquired = common._ZIP64_LIMIT_LOCK.acquire(blocking=False)
+      if acquired:
+        common._ZIP64_LIMIT_LOCK.release()
+      lock_available.append(acquired)
+
+    def check_lock_and_close():
+      # Another thread must not be able to change ZIP64_LIMIT meanwhile.
+      thread = threading.Thread(target=try_lock)
+      thread.start()
+      thread.join()
+      close()
+
+    zip_file.close = check_lock_and_close
+    self._test_reset_ZIP64_LIMIT(common.ZipClose, zip_file)
+    # ZipFile.__del__() calls close() again.
+    del zip_file.close
+    self.assertEqual([False], lock_available)
+
+  def test_ZipOverwriteStoredEntry(self):
+    zip_file = common.MakeTempFile(suffix='.zip')
+    with zipfile.ZipFile(zip_file, 'w', allowZip64=True) as output_zip:
+      common.ZipWriteStr(output_zip, 'foo', b'foo-data')
+      common.ZipWriteStr(output_zip, 'bar', b'bar-data')
+      common.ZipWriteStr(output_zip, 'baz', b'baz-data')
+    with zipfile.ZipFile(zip_file, allowZip64=True) as check_zip:
+      expected_offsets = [info.header_offset for info in check_zip.infolist()]
+
+    common.ZipOverwriteStoredEntry(zip_file, 'bar', 'new-data')
+
+    with zipfile.ZipFile(zip_file, allowZip64=True) as check_zip:
+      self.assertIsNone(check_zip.testzip())
+      self.assertEqual(b'foo-data', check_zip.read('foo'))
+      self.assertEqual(b'new-data', check_zip.read('bar'))
+      self.assertEqual(b'baz-data', check_zip.read('baz'))
+      self.assertEqual(
+          expected_offsets,
+          [info.header_offset for info in check_zip.infolist()])
+
+  def test_ZipOverwriteStoredEntry_sizeMismatch(self):
+    zip_file = common.MakeTempFile(suffix='.zip')
+    with zipfile.ZipFile(zip_file, 'w', allowZip64=True) as output_zip:
+      common.ZipWriteStr(output_zip, 'foo', b'foo-data')
+    self.assertRaises(common.ExternalError, common.ZipOverwriteStoredEntry,
+                      zip_file, 'foo', b'longer-data')
+
+  def test_ZipOverwriteStoredEntry_compressedEntry(self):
+    zip_file = common.MakeTempFile(suffix='.zip')
+    with zipfile.ZipFile(zip_file, 'w', allowZip64=True) as output_zip:
+      common.ZipWriteStr(output_zip, 'foo', b'foo-data',
+                         compress_type=zipfile.ZIP_DEFLATED)
+    self.assertRaises(common.ExternalError, common.ZipOverwriteStoredEntry,
+                      zip_file, 'foo', b'new-data')
+
   def test_ZipDelete(self):
     zip_file = tempfile.NamedTemporaryFile(delete=False, suffix='.zip')
     output_zip = zipfile.ZipFile(zip_file.name, 'w',
@@ -718,6 +832,46 @@ class CommonZipTest(test_utils.ReleaseToolsTestCase):
     finally:
       os.remove(zip_file.name)
 
+  def test_ZipDelete_movesFollowingEntries(self):
+    zip_file = common.MakeTempFile(suffix='.zip')
+    contents = {
+        'Test1': os.urandom(1024),
+        'Test2': b'a' * 65536,
+        'Test3': os.urandom(4096),
+        'Test4': b'b' * 65536,
+    }
+    with zipfile.ZipFile(zip_file, 'w', allowZip64=True) as output_zip:
+      for name, data in sorted(contents.items()):
+        common.ZipWriteStr(output_zip, name, data,
+                           compress_type=zipfile.ZIP_DEFLATED)
+      # An entry with a data descriptor, as written by streaming writers.
+      with output_zip.open('Test5', 'w') as entry:
+        entry.write(b'c' * 1024)
+      contents['Test5'] = b'c' * 1024
+    with zipfile.ZipFile(zip_file, allowZip64=True) as check_zip:
+      offsets = {info.filename: info.header_offset
+                 for info in check_zip.infolist()}
+      start_dir = check_zip.start_dir
+
+    moved = common.ZipDelete(zip_file, ['Test2', 'Test4'])
+
+    self.assertEqual(
+        start_dir - offsets['Test3'] - (offsets['Test5'] - offsets['Test4']),
+        moved)
+    with zipfile.ZipFile(zip_file, allowZip64=True) as check_zip:
+      self.assertIsNone(check_zip.testzip())
+      self.assertEqual(['Test1', 'Test3', 'Test5'], check_zip.namelist())
+      for name in check_zip.namelist():
+        self.assertEqual(contents[name], check_zip.read(name))
+      self.assertEqual(offsets['Test1'],
+                       check_zip.getinfo('Test1').header_offset)
+      self.assertEqual(offsets['Test2'],
+                       check_zip.getinfo('Test3').header_offset)
+    self.assertEqual(
+        start_dir - (offsets['Test3'] - offsets['Test2']) -
+        (offsets['Test5'] - offsets['Test4']),
+        check_zip.start_dir)
+
   @staticmethod
   def _test_UnzipTemp_createZipFile():
     zip_file = common.MakeTempFile(suffix='.zip')
@@ -1284,6 +1438,29 @@ class CommonUtilsTest(test_utils.ReleaseToolsTestCase):
           AssertionError, common.GetSparseImage, 'system', tempdir, input_zip,
           False)
 
+  def test_SparseImage_lazy(self):
+    image_file = test_utils.construct_sparse_image([
+        (0xCAC1, 6),
+        (0xCAC3, 3),
+        (0xCAC2, 4),
+        (0xCAC3, 600)])
+    image = sparse_img.SparseImage(image_file)
+    lazy_image = sparse_img.SparseImage(image_file, lazy=True)
+
+    self.assertNotIn('care_map', lazy_image.__dict__)
+    self.assertEqual(RangeSet("0-5 9-12"), lazy_image.care_map)
+    self.assertNotIn('extended', lazy_image.__dict__)
+    self.assertNotIn('file_map', lazy_image.__dict__)
+
+    self.assertEqual(image.offset_map, lazy_image.offset_map)
+    self.assertEqual(image.extended, lazy_image.extended)
+    self.assertEqual(RangeSet("6-8 13-524"), lazy_image.extended)
+    self.assertEqual(image.file_map, lazy_image.file_map)
+    self.assertEqual(
+        b''.join(image.ReadRangeSet(image.care_map)),
+        b''.join(lazy_image.ReadRangeSet(lazy_image.care_map)))
+    self.assertRaises(AttributeError, getattr, lazy_image, 'foo')
+
   @test_utils.SkipIfExternalToolsUnavailable()
   def test_GetAvbChainedPartitionArg(self):
     pubkey = os.path.join(self.testdata_dir, 'testkey.pubkey.pem')
@@ -1664,6 +1841,173 @@ class CommonUtilsTest(test_utils.ReleaseToolsTestCase):
     self.assertRaises(common.ExternalError, common._GenerateGkiCertificate,
                       test_file.name, 'generic_kernel')
 
+  def test_TaskGraph(self):
+    order = []
+    tasks = common.TaskGraph(num_workers=4)
+    tasks.AddTask('a', lambda: order.append('a') or 1)
+    tasks.AddTask('b', lambda: order.append('b') or 2, deps=['a'])
+    tasks.AddTask('c', lambda: order.append('c') or 3, deps=['a'])
+    tasks.AddTask('d', lambda: order.append('d') or 4, deps=['b', 'c'])
+    results = tasks.Run()
+    self.assertEqual({'a': 1, 'b': 2, 'c': 3, 'd': 4}, results)
+    self.assertEqual('a', order[0])
+    self.assertEqual('d', order[-1])
+    self.assertEqual(['a', 'b', 'c', 'd'], sorted(tasks.durations))
+
+  def test_TaskGraph_singleWorkerKeepsOrder(self):
+    order = []
+    tasks = common.TaskGraph(num_workers=1)
+    for name in ('c', 'b', 'a'):
+      tasks.AddTask(name, lambda name=name: order.append(name))
+    tasks.Run()
+    self.assertEqual(['c', 'b', 'a'], order)
+
+  def test_TaskGraph_budget(self):
+    lock = threading.Lock()
+    state = {'in_use': 0, 'peak': 0}
+
+    def task(cost):
+      with lock:
+        state['in_use'] += cost
+        state['peak'] = max(state['peak'], state['in_use'])
+      time.sleep(0.1)
+      with lock:
+        state['in_use'] -= cost
+
+    tasks = common.TaskGraph(num_workers=4, budget=10)
+    for i in range(4):
+      tasks.AddTask(i, lambda: task(6), cost=6)
+    # A task exceeding the whole budget still runs on its own.
+    tasks.AddTask('large', lambda: task(20), cost=20)
+    tasks.Run()
+    self.assertEqual(20, state['peak'])
+    self.assertEqual(5, len(tasks.durations))
+
+  def test_TaskGraph_failure(self):
+    def fail():
+      raise ValueError('failed')
+
+    order = []
+    tasks = common.TaskGraph(num_workers=2)
+    tasks.AddTask('a', fail)
+    tasks.AddTask('b', lambda: order.append('b'), deps=['a'])
+    self.assertRaises(ValueError, tasks.Run)
+    self.assertEqual([], order)
+
+  def test_TaskGraph_unknownDependency(self):
+    tasks = common.TaskGraph()
+    self.assertRaises(AssertionError, tasks.AddTask, 'a', lambda: None,
+                      deps=['b'])
+
+  @staticmethod
+  def _CreateDiskUsageTree():
+    root = common.MakeTempDir()
+    for subdir in ('a', 'a/b', 'c', 'd'):
+      os.mkdir(os.path.join(root, subdir))
+    for name, size in (('foo', 5000), ('a/bar', 1), ('a/b/baz', 123456),
+                       ('c/qux', 0)):
+      with open(os.path.join(root, name), 'wb') as f:
+        f.write(b'x' * size)
+    os.link(os.path.join(root, 'a/b/baz'), os.path.join(root, 'c/baz'))
+    os.symlink('a/bar', os.path.join(root, 'd/link'))
+    return root
+
+  def test_ScanDiskUsage(self):
+    root = self._CreateDiskUsageTree()
+    for num_threads in (1, 4):
+      common._disk_usage_cache.clear()
+      usage = common.ScanDiskUsage(root, num_threads=num_threads)
+      du = subprocess.check_output(['du', '-b', '-k', '-s', root])
+      self.assertEqual(int(du.split()[0]) * 1024, usage.size)
+      find = subprocess.check_output(['find', root, '-print'])
+      self.assertEqual(find.count(b'\n'), usage.inodes)
+
+      self.assertEqual(
+          ['.', 'a', 'a/b', 'c', 'd'], sorted(usage.dirs.keys()))
+      for subdir in ('a', 'c'):
+        du = subprocess.check_output(
+            ['du', '-b', '-s', os.path.join(root, subdir)])
+        find = subprocess.check_output(
+            ['find', os.path.join(root, subdir), '-print'])
+        self.assertEqual((int(du.split()[0]), find.count(b'\n')),
+                         usage.dirs[subdir])
+
+  def test_ScanDiskUsage_file(self):
+    root = self._CreateDiskUsageTree()
+    usage = common.ScanDiskUsage(os.path.join(root, 'foo'))
+    self.assertEqual(5120, usage.size)
+    self.assertEqual(1, usage.inodes)
+
+  def test_ScanDiskUsage_cache(self):
+    root = self._CreateDiskUsageTree()
+    usage = common.ScanDiskUsage(root)
+    self.assertIs(usage, common.ScanDiskUsage(root))
+
+    # Adding a file anywhere in the tree invalidates the cached result.
+    with open(os.path.join(root, 'a', 'b', 'new'), 'wb') as f:
+      f.write(b'x' * 4096)
+    os.utime(os.path.join(root, 'a', 'b'), ns=(0, 0))
+    new_usage = common.ScanDiskUsage(root)
+    self.assertEqual(usage.inodes + 1, new_usage.inodes)
+    self.assertEqual(usage.apparent_size + 4096, new_usage.apparent_size)
+
+  def test_Tracer(self):
+    trace_file = common.MakeTempFile(suffix='.json')
+    common.StartTracing(trace_file)
+    try:
+      with common.TracePhase('outer'):
+        common.RunAndCheckOutput(['dd', 'if=/dev/zero', 'of=/dev/null',
+                                  'count=1'])
+        common.Traced(common.RunAndCheckOutput)(['true'])
+    finally:
+      common.StopTracing()
+    self.assertFalse(common.RunAndCheckOutput(['true']))
+
+    with open(trace_file) as f:
+      events = {event['name']: event for event in json.load(f)['traceEvents']}
+    self.assertEqual(
+        ['RunAndCheckOutput', 'dd', 'outer', 'true'], sorted(events))
+    self.assertEqual('phase', events['outer']['cat'])
+    self.assertIsNone(events['outer']['args']['parent'])
+    self.assertEqual('outer', events['RunAndCheckOutput']['args']['parent'])
+
+    dd = events['dd']
+    self.assertEqual('command', dd['cat'])
+    self.assertEqual('outer', dd['args']['parent'])
+    self.assertEqual(
+        ['dd', 'if=/dev/zero', 'of=/dev/null', 'count=1'], dd['args']['argv'])
+    self.assertGreaterEqual(dd['args']['cpu_time'], 0)
+    self.assertLessEqual(events['outer']['ts'], dd['ts'])
+    self.assertEqual('RunAndCheckOutput', events['true']['args']['parent'])
+
+  def test_Tracer_pollAndShell(self):
+    trace_file = common.MakeTempFile(suffix='.json')
+    common.StartTracing(trace_file)
+    try:
+      # Reaped by poll(), rather than by wait().
+      proc = common.Run(['sleep', '0.1'])
+      while proc.poll() is None:
+        time.sleep(0.01)
+      self.assertEqual(0, proc.returncode)
+
+      proc = common.Run(['sleep', '10'])
+      self.assertRaises(subprocess.TimeoutExpired, proc.wait, 0.05)
+      proc.kill()
+      self.assertEqual(-9, proc.wait(5))
+
+      # The command is a string with shell=True.
+      proc = common._TracedPopen('exit 3', shell=True)
+      self.assertEqual(3, proc.wait())
+    finally:
+      common.StopTracing()
+
+    with open(trace_file) as f:
+      events = json.load(f)['traceEvents']
+    self.assertEqual(['exit', 'sleep', 'sleep'],
+                     sorted(event['name'] for event in events))
+    self.assertEqual(['exit', '3'], events[-1]['args']['argv'])
+
+
 class InstallRecoveryScriptFormatTest(test_utils.ReleaseToolsTestCase):
   """Checks the format of install-recovery.sh.
 
@@ -0,0 +1,99 @@
+#
+# Copyright (C) 2022 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Unittests for fsverity_metadata_generator.py."""
+
+import os
+import os.path
+import struct
+
+import common
+import test_utils
+from fsverity_metadata_generator import (
+    build_descriptor, compute_digest, compute_merkle_tree,
+    FSVerityMetadataGenerator)
+
+
+class FSVerityMetadataGeneratorTest(test_utils.ReleaseToolsTestCase):
+
+  # fsverity digest --compact /dev/null
+  EMPTY_FILE_DIGEST = (
+      '3d248ca542a24fc62d1c43b916eae5016878e2533c88238480b26128a1f1af95')
+
+  @staticmethod
+  def _create_file(size):
+    input_file = common.MakeTempFile()
+    with open(input_file, 'wb') as f:
+      f.write(os.urandom(size))
+    return input_file
+
+  def test_compute_digest_emptyFile(self):
+    self.assertEqual(
+        self.EMPTY_FILE_DIGEST, compute_digest(self._create_file(0)).hex())
+
+  def test_compute_merkle_tree(self):
+    # A single block has no tree, and is the root itself.
+    root_hash, merkle_tree = compute_merkle_tree(self._create_file(4096))
+    self.assertEqual(32, len(root_hash))
+    self.assertEqual(b'', merkle_tree)
+
+    # 129 blocks take two blocks of hashes, which hash into the root block.
+    input_file = self._create_file(4096 * 128 + 1)
+    root_hash, merkle_tree = compute_merkle_tree(input_file)
+    self.assertEqual(3 * 4096, len(merkle_tree))
+    self.assertEqual(
+        root_hash, compute_merkle_tree(input_file, 'sha256', b'')[0])
+    self.assertNotEqual(
+        root_hash, compute_merkle_tree(input_file, 'sha256', b'salt')[0])
+
+    # With SHA-512, the 129 hashes take three blocks.
+    root_hash, merkle_tree = compute_merkle_tree(input_file, 'sha512')
+    self.assertEqual(64, len(root_hash))
+    self.assertEqual(4 * 4096, len(merkle_tree))
+
+  def test_build_descriptor(self):
+    descriptor = build_descriptor(12345, b'\x01' * 32, 'sha256', b'salt')
+    self.assertEqual(256, len(descriptor))
+    self.assertEqual(
+        (1, 1, 12, 4, 0, 12345),
+        struct.unpack('<BBBBIQ', descriptor[:16]))
+    self.assertRaises(
+        ValueError, build_descriptor, 0, b'', 'sha256', b'\x00' * 33)
+
+  def test_generate_all(self):
+    input_files = [self._create_file(size) for size in (0, 4096, 40960)]
+    generator = FSVerityMetadataGenerator('fsverity')
+    generator.generate_all(input_files, num_threads=2)
+
+    for input_file in input_files:
+      root_hash, merkle_tree = compute_merkle_tree(input_file)
+      with open(input_file + '.fsv_meta', 'rb') as f:
+        metadata = f.read()
+      self.assertEqual(1, struct.unpack('<I', metadata[:4])[0])
+      self.assertEqual(
+          build_descriptor(os.path.getsize(input_file), root_hash),
+          metadata[4:260])
+      self.assertEqual((0, 0), struct.unpack('<II', metadata[260:268]))
+      self.assertEqual(merkle_tree, metadata[4096:])
+
+  @test_utils.SkipIfExternalToolsUnavailable()
+  def test_compute_digest_matchesFsverity(self):
+    for size in (0, 1, 4096, 4097, 4096 * 128 + 1, 4096 * 128 * 128 + 1):
+      input_file = self._create_file(size)
+      expected = common.RunAndCheckOutput(
+          ['fsverity', 'digest', input_file, '--compact', '--hash-alg',
+           'sha256'], verbose=False).strip()
+      self.assertEqual(expected, compute_digest(input_file).hex())
@@ -21,10 +21,12 @@ import zipfile
 
 import common
 import ota_metadata_pb2
+import ota_utils
 import test_utils
 from ota_utils import (
     BuildLegacyOtaMetadata, CalculateRuntimeDevicesAndFingerprints,
-    ConstructOtaApexInfo, FinalizeMetadata, GetPackageMetadata, PropertyFiles)
+    ConstructOtaApexInfo, FinalizeMetadata, GetPackageMetadata, PropertyFiles,
+    METADATA_NAME, METADATA_PROTO_NAME)
 from ota_from_target_files import (
     _LoadOemDicts, AbOtaPropertyFiles,
     GetTargetFilesZipForCustomImagesUpdates,
@@ -672,6 +674,39 @@ class OtaFromTargetFilesTest(test_utils.ReleaseToolsTestCase):
     common.OPTIONS.no_signing = True
     self._test_FinalizeMetadata()
 
+  def test_FinalizeMetadata_withNoSigning_updatesMetadataInPlace(self):
+    common.OPTIONS.no_signing = True
+    zip_file = PropertyFilesTest.construct_zip_package(
+        ['required-entry1', 'required-entry2'])
+    with zipfile.ZipFile(zip_file, allowZip64=True) as zip_fp:
+      expected_offsets = [info.header_offset for info in zip_fp.infolist()]
+
+    metadata = ota_metadata_pb2.OtaMetadata()
+    output_file = common.MakeTempFile(suffix='.zip')
+    FinalizeMetadata(metadata, zip_file, output_file, (TestPropertyFiles(),))
+
+    # The metadata entries are appended once and then updated in place.
+    with zipfile.ZipFile(zip_file, allowZip64=True) as zip_fp:
+      self.assertEqual(
+          ['required-entry1', 'required-entry2', METADATA_PROTO_NAME,
+           METADATA_NAME],
+          zip_fp.namelist())
+      self.assertEqual(
+          expected_offsets,
+          [info.header_offset for info in zip_fp.infolist()][:2])
+      self.assertIsNone(zip_fp.testzip())
+      tokens = PropertyFilesTest._parse_property_files_string(
+          metadata.property_files['ota-test-property-files'].strip())
+      offset, size = map(int, tokens['metadata'].split(':'))
+      metadata_info = zip_fp.getinfo(METADATA_NAME)
+      self.assertEqual(metadata_info.file_size, size)
+      self.assertEqual(zip_fp.read(METADATA_NAME).decode(),
+                       ota_utils.SerializeMetadata(metadata)[1])
+    with open(zip_file, 'rb') as f:
+      f.seek(offset)
+      self.assertEqual(ota_utils.SerializeMetadata(metadata)[1].encode(),
+                       f.read(size))
+
   @test_utils.SkipIfExternalToolsUnavailable()
   def test_FinalizeMetadata_largeEntry(self):
     self._test_FinalizeMetadata(large_entry=True)
@@ -17,18 +17,24 @@
 """Unittests for verity_utils.py."""
 
 import copy
+import hashlib
 import math
 import os.path
 import random
+import struct
+import zipfile
 
 import common
 import sparse_img
 from rangelib import RangeSet
 from test_utils import (
-    get_testdata_dir, ReleaseToolsTestCase, SkipIfExternalToolsUnavailable)
+    construct_sparse_image, get_testdata_dir, ReleaseToolsTestCase,
+    SkipIfExternalToolsUnavailable)
 from verity_utils import (
+    BuildVerityHashtree, BuildVerityHashtreeFromSparseImage, BuildVerityTree,
     CalculateVbmetaDigest, CreateHashtreeInfoGenerator,
-    CreateVerityImageBuilder, HashtreeInfo,
+    CreateVerityImageBuilder, GetVerityFECSize, GetVerityMetadataSize,
+    GetVeritySize, GetVerityTreeSize, HashtreeInfo,
     VerifiedBootVersion1HashtreeInfoGenerator)
 
 BLOCK_SIZE = common.BLOCK_SIZE
@@ -170,6 +176,54 @@ class VerifiedBootVersion1HashtreeInfoGeneratorTest(ReleaseToolsTestCase):
     self.assertEqual(self.fixed_salt, info.salt)
     self.assertEqual(self.expected_root_hash, info.root_hash)
 
+  def test_GetVeritySize(self):
+    self.assertEqual(4096, GetVerityTreeSize(4096))
+    self.assertEqual(12288, GetVerityTreeSize(991232))
+    self.assertEqual(32768, GetVerityMetadataSize(991232))
+    self.assertEqual(12288, GetVerityFECSize(991232 + 12288 + 32768))
+    self.assertEqual(
+        self.partition_size - 991232, GetVeritySize(991232, True))
+    self.assertEqual(12288 + 32768, GetVeritySize(991232, False))
+
+  def test_BuildVerityHashtree(self):
+    raw_image = bytes(bytearray(ord('0') + i % 10 for i in range(991232)))
+
+    root_hash, tree = BuildVerityHashtree([raw_image], self.fixed_salt)
+    self.assertEqual(self.expected_root_hash, root_hash)
+    self.assertEqual(GetVerityTreeSize(991232), len(tree))
+
+    # The result doesn't depend on how the data is split or hashed.
+    chunks = [raw_image[:4096], raw_image[4096:40960], raw_image[40960:]]
+    self.assertEqual((root_hash, tree), BuildVerityHashtree(
+        chunks, self.fixed_salt, num_threads=3))
+
+  def test_BuildVerityHashtreeFromSparseImage(self):
+    sparse_image = construct_sparse_image(
+        [(0xCAC1, 6), (0xCAC2, 4), (0xCAC3, 3), (0xCAC1, 2)])
+    simg = sparse_img.SparseImage(sparse_image)
+    raw_image = b''.join(
+        simg.ReadRangeSet(RangeSet("0-9")) + [b'\0' * BLOCK_SIZE * 3] +
+        simg.ReadRangeSet(RangeSet("13-14")))
+    simg.simg_f.close()
+
+    self.assertEqual(
+        BuildVerityHashtree([raw_image], self.fixed_salt),
+        BuildVerityHashtreeFromSparseImage(
+            sparse_image, self.fixed_salt, num_threads=2))
+
+  @SkipIfExternalToolsUnavailable()
+  def test_BuildVerityHashtreeFromSparseImage_MatchesBuildVerityTree(self):
+    sparse_image = construct_sparse_image(
+        [(0xCAC1, 1000), (0xCAC2, 24), (0xCAC3, 100), (0xCAC1, 1)])
+
+    verity_tree = common.MakeTempFile()
+    expected_root_hash, salt = BuildVerityTree(sparse_image, verity_tree)
+    with open(verity_tree, 'rb') as f:
+      expected_tree = f.read()
+
+    self.assertEqual((expected_root_hash, expected_tree),
+                     BuildVerityHashtreeFromSparseImage(sparse_image, salt))
+
 
 class VerifiedBootVersion1VerityImageBuilderTest(ReleaseToolsTestCase):
 
@@ -390,6 +444,61 @@ class VerifiedBootVersion2VerityImageBuilderTest(ReleaseToolsTestCase):
           _SizeCalculator(min_partition_size - BLOCK_SIZE),
           image_size)
 
+  @SkipIfExternalToolsUnavailable()
+  def test_EstimateMaxImageSize(self):
+    for footer_args in ('', '--hash_algorithm sha256', '--do_not_generate_fec',
+                        '--fec_num_roots 8', '--prop foo:bar'):
+      prop_dict = copy.deepcopy(self.DEFAULT_PROP_DICT)
+      prop_dict['avb_add_hashtree_footer_args'] = footer_args
+      builder = CreateVerityImageBuilder(prop_dict)
+      for partition_size in (BLOCK_SIZE * 1024, BLOCK_SIZE * 65536,
+                             BLOCK_SIZE * 262139, BLOCK_SIZE * 524288):
+        self.assertEqual(
+            builder.CalculateMaxImageSize(partition_size),
+            builder.EstimateMaxImageSize(partition_size))
+
+  def test_EstimateMaxImageSize_UnsupportedArgs(self):
+    prop_dict = copy.deepcopy(self.DEFAULT_PROP_DICT)
+    prop_dict['avb_add_hashtree_footer_args'] = '--hash_algorithm foo'
+    builder = CreateVerityImageBuilder(prop_dict)
+    self.assertIsNone(builder.EstimateMaxImageSize(BLOCK_SIZE * 1024))
+
+  def test_CalculateMinPartitionSize_WithEstimation(self):
+    image_sizes, builder = self._test_CalculateMinPartitionSize_SetUp()
+    builder.signing_args = ''
+    avbtool_calls = []
+
+    def _CalculateMaxImageSize(partition_size):
+      avbtool_calls.append(partition_size)
+      return builder.EstimateMaxImageSize(partition_size)
+    builder.CalculateMaxImageSize = _CalculateMaxImageSize
+
+    for image_size in image_sizes[::256]:
+      del avbtool_calls[:]
+      min_partition_size = builder.CalculateMinPartitionSize(image_size)
+      self.assertEqual(
+          [min_partition_size - BLOCK_SIZE, min_partition_size],
+          avbtool_calls)
+      self.assertGreaterEqual(
+          builder.EstimateMaxImageSize(min_partition_size), image_size)
+      self.assertLess(
+          builder.EstimateMaxImageSize(min_partition_size - BLOCK_SIZE),
+          image_size)
+
+  def test_CalculateMinPartitionSize_EstimationMismatch(self):
+    image_sizes, builder = self._test_CalculateMinPartitionSize_SetUp()
+    builder.signing_args = ''
+
+    def _CalculateMaxImageSize(partition_size):
+      return builder.EstimateMaxImageSize(partition_size) - 10 * BLOCK_SIZE
+    builder.CalculateMaxImageSize = _CalculateMaxImageSize
+
+    for image_size in image_sizes[::256]:
+      self.assertEqual(
+          builder.CalculateMinPartitionSize(
+              image_size, _CalculateMaxImageSize),
+          builder.CalculateMinPartitionSize(image_size))
+
   @SkipIfExternalToolsUnavailable()
   def test_CalculateVbmetaDigest(self):
     prop_dict = copy.deepcopy(self.DEFAULT_PROP_DICT)
@@ -417,3 +526,42 @@ class VerifiedBootVersion2VerityImageBuilderTest(ReleaseToolsTestCase):
     common.RunAndCheckOutput(cmd)
     digest = CalculateVbmetaDigest(image_dir, 'avbtool')
     self.assertIsNotNone(digest)
+
+  def test_CalculateVbmetaDigest_chainedPartitions(self):
+    image_dir = common.MakeTempDir()
+    for name in ('IMAGES', 'PREBUILT_IMAGES'):
+      os.mkdir(os.path.join(image_dir, name))
+
+    # An image with an AVB hashtree footer.
+    with zipfile.ZipFile(
+        os.path.join(get_testdata_dir(), 'foo.apex')) as apex_zip:
+      system_image_data = apex_zip.read('apex_payload.img')
+    with open(os.path.join(image_dir, 'IMAGES', 'system.img'), 'wb') as f:
+      f.write(system_image_data)
+    _, _, _, _, vbmeta_offset, vbmeta_size = struct.unpack(
+        '!4s2L3Q28x', system_image_data[-64:])
+    system_vbmeta_blob = system_image_data[
+        vbmeta_offset:vbmeta_offset + vbmeta_size]
+
+    # The one under IMAGES takes precedence.
+    with open(os.path.join(image_dir, 'PREBUILT_IMAGES', 'system.img'),
+              'wb') as f:
+      f.write(os.urandom(4096))
+
+    # A vbmeta image that chains to system, with no authentication data.
+    partition_name = b'system'
+    descriptor = struct.pack(
+        '!2Q4L60x', 4, 88, 1, len(partition_name), 0, 0) + partition_name
+    descriptor += b'\0' * (-len(descriptor) % 8)
+    auxiliary_data = descriptor + b'\0' * (-len(descriptor) % 64)
+    header = struct.pack(
+        '!4s2L2QL11Q2L47sx80x', b'AVB0', 1, 0, 0, len(auxiliary_data), 0,
+        0, 0, 0, 0, 0, 0, 0, 0, 0, len(descriptor), 0, 0, 0, b'avbtool 1.2.0')
+    vbmeta_blob = header + auxiliary_data
+    with open(os.path.join(image_dir, 'PREBUILT_IMAGES', 'vbmeta.img'),
+              'wb') as f:
+      f.write(vbmeta_blob + b'\0' * 4096)
+
+    self.assertEqual(
+        hashlib.sha256(vbmeta_blob + system_vbmeta_blob).hexdigest() + '\n',
+        CalculateVbmetaDigest(image_dir, 'avbtool'))
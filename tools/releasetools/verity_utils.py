@@ -22,7 +22,12 @@ Usage:  verity_utils properties_file output_image
 
 from __future__ import print_function
 
+import argparse
+import collections
+import concurrent.futures
+import hashlib
 import logging
+import mmap
 import os.path
 import shlex
 import struct
@@ -42,6 +47,25 @@ FIXED_SALT = "aee087a5be3b982978c923f566a94613496b417f2af592639bc80d141e34dfe7"
 MAX_VBMETA_SIZE = 64 * 1024
 MAX_FOOTER_SIZE = 4096
 
+# From system/extras/libfec/include/fec/io.h
+FEC_BLOCKSIZE = 4096
+FEC_RSM = 255
+FEC_DEFAULT_ROOTS = 2
+
+# From system/extras/verity/build_verity_metadata.py
+VERITY_METADATA_SIZE = 32768
+
+# build_verity_tree always uses SHA-256.
+VERITY_DIGEST_SIZE = hashlib.sha256().digest_size
+
+# The size of the data handed to each thread when hashing level 0 of the verity
+# tree.
+VERITY_HASH_CHUNK_SIZE = 16 * 1024 * 1024
+
+# The max image sizes given by avbtool, keyed by (avbtool, footer type,
+# partition size, signing args).
+_max_image_size_cache = {}
+
 class BuildVerityImageError(Exception):
   """An Exception raised during verity image building."""
 
@@ -50,21 +74,22 @@ class BuildVerityImageError(Exception):
 
 
 def GetVerityFECSize(image_size):
-  cmd = ["fec", "-s", str(image_size)]
-  output = common.RunAndCheckOutput(cmd, verbose=False)
-  return int(output)
+  """Returns the size of the FEC data, same as 'fec -s'."""
+  return CalculateFecSize(image_size, FEC_DEFAULT_ROOTS)
 
 
 def GetVerityTreeSize(image_size):
-  cmd = ["build_verity_tree", "-s", str(image_size)]
-  output = common.RunAndCheckOutput(cmd, verbose=False)
-  return int(output)
+  """Returns the size of the verity tree, same as 'build_verity_tree -s'."""
+  # Unlike avbtool, build_verity_tree keeps the top level even if the image
+  # fits in a single block.
+  return max(CalculateHashtreeSize(image_size, BLOCK_SIZE, VERITY_DIGEST_SIZE),
+             BLOCK_SIZE)
 
 
-def GetVerityMetadataSize(image_size):
-  cmd = ["build_verity_metadata", "size", str(image_size)]
-  output = common.RunAndCheckOutput(cmd, verbose=False)
-  return int(output)
+def GetVerityMetadataSize(image_size):  # pylint: disable=unused-argument
+  """Returns the size of the verity metadata, same as 'build_verity_metadata
+  size'."""
+  return VERITY_METADATA_SIZE
 
 
 def GetVeritySize(image_size, fec_supported):
@@ -77,6 +102,151 @@ def GetVeritySize(image_size, fec_supported):
   return verity_size
 
 
+def CalculateHashtreeSize(image_size, block_size, digest_size):
+  """Returns the size of the hashtree of an image, as avbtool lays it out."""
+  tree_size = 0
+  size = image_size
+  while size > block_size:
+    num_blocks = (size + block_size - 1) // block_size
+    level_size = num_blocks * digest_size
+    level_size = (level_size + block_size - 1) // block_size * block_size
+    tree_size += level_size
+    size = level_size
+  return tree_size
+
+
+def CalculateFecSize(image_size, num_roots):
+  """Returns the size of the FEC data of an image, same as 'fec -s'."""
+  num_blocks = (image_size + FEC_BLOCKSIZE - 1) // FEC_BLOCKSIZE
+  num_rounds = (num_blocks + FEC_RSM - num_roots - 1) // (FEC_RSM - num_roots)
+  return num_rounds * num_roots * FEC_BLOCKSIZE + FEC_BLOCKSIZE
+
+
+def _SplitVerityChunks(data_chunks):
+  """Splits the data into views of at most VERITY_HASH_CHUNK_SIZE bytes."""
+  unaligned = False
+  for chunk in data_chunks:
+    assert not unaligned, "Only the last chunk may end with a partial block"
+    view = memoryview(chunk)
+    for offset in range(0, len(view), VERITY_HASH_CHUNK_SIZE):
+      yield view[offset:offset + VERITY_HASH_CHUNK_SIZE]
+    unaligned = len(view) % BLOCK_SIZE != 0
+
+
+def _HashVerityBlocks(data, salted_hash):
+  """Returns the concatenated salted digests of each block in data.
+
+  A partial trailing block is zero-padded, as build_verity_tree does.
+  """
+  view = memoryview(data)
+  if len(view) % BLOCK_SIZE:
+    view = memoryview(
+        view.tobytes() + b"\0" * (BLOCK_SIZE - len(view) % BLOCK_SIZE))
+  digests = []
+  for offset in range(0, len(view), BLOCK_SIZE):
+    block_hash = salted_hash.copy()
+    block_hash.update(view[offset:offset + BLOCK_SIZE])
+    digests.append(block_hash.digest())
+  return b"".join(digests)
+
+
+def BuildVerityHashtree(data_chunks, salt=FIXED_SALT, num_threads=None):
+  """Builds the verity tree in-process, same as 'build_verity_tree'.
+
+  Level 0 is hashed by a pool of threads, one VERITY_HASH_CHUNK_SIZE chunk at
+  a time. hashlib releases the GIL while hashing each block, so this scales
+  with the number of cores. The upper levels are only 1/128 of the data, and
+  are hashed on the calling thread.
+
+  Args:
+    data_chunks: An iterable of bytes-like objects with the data to hash, such
+        as the pieces from SparseImage.IterRangeSet(). All the chunks but the
+        last one must be a multiple of BLOCK_SIZE.
+    salt: The salt, as a hex string.
+    num_threads: The number of threads to hash level 0 with. Defaults to the
+        number of CPUs.
+
+  Returns:
+    A tuple of (root_hash, tree), where root_hash is a hex string and tree is
+    the bytes of the verity tree, with the top level first.
+  """
+  salted_hash = hashlib.sha256(bytearray.fromhex(salt))
+  num_threads = num_threads or os.cpu_count() or 1
+
+  # Keeps a bounded number of chunks in flight, so that we don't read the
+  # whole image into memory ahead of the hashing threads.
+  level_hashes = []
+  pending = collections.deque()
+  with concurrent.futures.ThreadPoolExecutor(num_threads) as executor:
+    for chunk in _SplitVerityChunks(data_chunks):
+      if len(pending) >= 2 * num_threads:
+        level_hashes.append(pending.popleft().result())
+      pending.append(executor.submit(_HashVerityBlocks, chunk, salted_hash))
+    level_hashes.extend(future.result() for future in pending)
+
+  levels = []
+  level = b"".join(level_hashes)
+  while True:
+    level += b"\0" * (-len(level) % BLOCK_SIZE)
+    levels.append(level)
+    if len(level) <= BLOCK_SIZE:
+      break
+    level = _HashVerityBlocks(level, salted_hash)
+
+  root_hash = salted_hash.copy()
+  root_hash.update(levels[-1])
+  return root_hash.hexdigest(), b"".join(reversed(levels))
+
+
+def _IterSparseImageData(data, blocksize, total_chunks):
+  """Yields the unsparsed data of a sparse image mapped into memory.
+
+  Raw chunks are yielded as views of the mapping. The don't care chunks are
+  hashed as zeros, same as build_verity_tree does.
+  """
+  max_fill_blocks = VERITY_HASH_CHUNK_SIZE // blocksize
+  offset = 28
+  for _ in range(total_chunks):
+    chunk_type, _, chunk_sz, total_sz = sparse_img.CHUNK_HEADER.unpack_from(
+        data, offset)
+    offset += sparse_img.CHUNK_HEADER.size
+    data_sz = total_sz - sparse_img.CHUNK_HEADER.size
+
+    if chunk_type == 0xCAC1:
+      if data_sz != chunk_sz * blocksize:
+        raise ValueError(
+            "Raw chunk input size (%u) does not match output size (%u)" %
+            (data_sz, chunk_sz * blocksize))
+      yield memoryview(data)[offset:offset + data_sz]
+    elif chunk_type in (0xCAC2, 0xCAC3):
+      if chunk_type == 0xCAC2:
+        fill_data = data[offset:offset + 4]
+      else:
+        fill_data = b"\0" * 4
+      fill = fill_data * (min(chunk_sz, max_fill_blocks) * (blocksize >> 2))
+      for start in range(0, chunk_sz, max_fill_blocks):
+        blocks = min(chunk_sz - start, max_fill_blocks)
+        yield fill[:blocks * blocksize]
+    else:
+      raise ValueError("Unsupported chunk type 0x%04X" % (chunk_type,))
+    offset += data_sz
+
+
+def BuildVerityHashtreeFromSparseImage(image_path, salt=FIXED_SALT,
+                                       num_threads=None):
+  """Builds the verity tree of a sparse image file in-process.
+
+  The file is mmap'd, so that the hashing threads read the raw chunks without
+  copying. See BuildVerityHashtree() for the arguments and the return value.
+  """
+  simg = sparse_img.SparseImage(image_path, build_map=False)
+  with simg.simg_f as f, \
+      mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+    return BuildVerityHashtree(
+        _IterSparseImageData(data, simg.blocksize, simg.total_chunks),
+        salt, num_threads)
+
+
 def GetSimgSize(image_file):
   simg = sparse_img.SparseImage(image_file, build_map=False)
   return simg.blocksize * simg.total_blocks
@@ -328,8 +498,12 @@ class Version1VerityImageBuilder(VerityImageBuilder):
     verity_image_path = os.path.join(tempdir_name, "verity.img")
     verity_metadata_path = os.path.join(tempdir_name, "verity_metadata.img")
 
-    # Build the verity tree and get the root hash and salt.
-    root_hash, salt = BuildVerityTree(out_file, verity_image_path)
+    # Build the verity tree in-process. The tests check that it matches the
+    # output of BuildVerityTree() byte-for-byte.
+    salt = FIXED_SALT
+    root_hash, verity_tree = BuildVerityHashtreeFromSparseImage(out_file, salt)
+    with open(verity_image_path, "wb") as f:
+      f.write(verity_tree)
 
     # Build the metadata blocks.
     BuildVerityMetadata(
@@ -395,6 +569,11 @@ class VerifiedBootVersion2VerityImageBuilder(VerityImageBuilder):
     which should be cover the given image size (for filesystem files) as well as
     the verity metadata size.
 
+    Unless a size_calculator is given, the search runs against the in-process
+    model of avbtool (EstimateMaxImageSize()), and the result is then checked
+    against avbtool itself. It only falls back to searching with avbtool if the
+    model can't handle the signing args, or disagrees with avbtool.
+
     Args:
       image_size: The size of the image in question.
       size_calculator: The function to calculate max image size
@@ -404,6 +583,14 @@ class VerifiedBootVersion2VerityImageBuilder(VerityImageBuilder):
       The minimum partition size required to accommodate the image size.
     """
     if size_calculator is None:
+      if self.EstimateMaxImageSize(image_size) is not None:
+        partition_size = self.CalculateMinPartitionSize(
+            image_size, self.EstimateMaxImageSize)
+        if self._ValidateEstimatedSize(partition_size):
+          return partition_size
+        logger.warning(
+            "Size estimation of %s doesn't match avbtool; searching with "
+            "avbtool instead", self.partition_name)
       size_calculator = self.CalculateMaxImageSize
 
     # Use image size as partition size to approximate final partition size.
@@ -473,24 +660,88 @@ class VerifiedBootVersion2VerityImageBuilder(VerityImageBuilder):
     assert partition_size > 0, \
         "Invalid partition size: {}".format(partition_size)
 
-    add_footer = ("add_hash_footer" if self.footer_type == self.AVB_HASH_FOOTER
-                  else "add_hashtree_footer")
-    cmd = [self.avbtool, add_footer, "--partition_size",
-           str(partition_size), "--calc_max_image_size"]
-    cmd.extend(shlex.split(self.signing_args))
-
-    proc = common.Run(cmd)
-    output, _ = proc.communicate()
-    if proc.returncode != 0:
-      raise BuildVerityImageError(
-          "Failed to calculate max image size:\n{}".format(output))
-    image_size = int(output)
-    if image_size <= 0:
-      raise BuildVerityImageError(
-          "Invalid max image size: {}".format(output))
+    # avbtool gives the same answer for the same inputs, and it may be asked
+    # repeatedly while sizing a partition.
+    key = (self.avbtool, self.footer_type, partition_size, self.signing_args)
+    image_size = _max_image_size_cache.get(key)
+    if image_size is None:
+      add_footer = ("add_hash_footer"
+                    if self.footer_type == self.AVB_HASH_FOOTER
+                    else "add_hashtree_footer")
+      cmd = [self.avbtool, add_footer, "--partition_size",
+             str(partition_size), "--calc_max_image_size"]
+      cmd.extend(shlex.split(self.signing_args))
+
+      proc = common.Run(cmd)
+      output, _ = proc.communicate()
+      if proc.returncode != 0:
+        raise BuildVerityImageError(
+            "Failed to calculate max image size:\n{}".format(output))
+      image_size = int(output)
+      if image_size <= 0:
+        raise BuildVerityImageError(
+            "Invalid max image size: {}".format(output))
+      _max_image_size_cache[key] = image_size
     self.image_size = image_size
     return image_size
 
+  def EstimateMaxImageSize(self, partition_size):
+    """Estimates max image size for a given partition size, without avbtool.
+
+    It follows how 'avbtool add_hash{,tree}_footer --calc_max_image_size'
+    reserves the space for the hashtree, the FEC data and the AVB metadata.
+
+    Args:
+      partition_size: The partition size.
+
+    Returns:
+      The maximum image size, or None if the signing args have any values the
+      estimation doesn't support.
+    """
+    max_metadata_size = MAX_VBMETA_SIZE + MAX_FOOTER_SIZE
+    if self.footer_type == self.AVB_HASH_FOOTER:
+      return partition_size - max_metadata_size
+
+    parser = argparse.ArgumentParser(add_help=False, allow_abbrev=False)
+    parser.add_argument("--hash_algorithm", default="sha1")
+    parser.add_argument("--block_size", type=int, default=4096)
+    parser.add_argument("--fec_num_roots", type=int, default=2)
+    parser.add_argument("--do_not_generate_fec", action="store_true")
+    parser.add_argument("--no_hashtree", action="store_true")
+    try:
+      args, _ = parser.parse_known_args(
+          shlex.split(self.signing_args or ""))
+      digest_size = hashlib.new(args.hash_algorithm).digest_size
+    except (SystemExit, ValueError):
+      return None
+    if args.block_size <= 0 or not 0 < args.fec_num_roots < FEC_RSM:
+      return None
+
+    # Digests are padded to a power of 2 in the hashtree.
+    digest_size = 1 << (digest_size - 1).bit_length()
+    if not args.no_hashtree:
+      max_metadata_size += CalculateHashtreeSize(
+          partition_size, args.block_size, digest_size)
+      if not args.do_not_generate_fec:
+        max_metadata_size += CalculateFecSize(
+            partition_size, args.fec_num_roots)
+    return partition_size - max_metadata_size
+
+  def _ValidateEstimatedSize(self, partition_size):
+    """Checks EstimateMaxImageSize() against avbtool around partition_size."""
+    for size in (partition_size - BLOCK_SIZE, partition_size):
+      if size <= 0:
+        continue
+      estimated_size = self.EstimateMaxImageSize(size)
+      try:
+        if self.CalculateMaxImageSize(size) != estimated_size:
+          return False
+      except BuildVerityImageError:
+        # avbtool rejects the partition sizes that leave no room for the image.
+        if estimated_size > 0:
+          return False
+    return True
+
   def PadSparseImage(self, out_file):
     # No-op as the padding is taken care of by avbtool.
     pass
@@ -666,19 +917,16 @@ class VerifiedBootVersion1HashtreeInfoGenerator(HashtreeInfoGenerator):
   def ValidateHashtree(self):
     """Checks that we can reconstruct the verity hash tree."""
 
-    # Writes the filesystem section to a temp file; and calls the executable
-    # build_verity_tree to construct the hash tree.
-    adjusted_partition = common.MakeTempFile(prefix="adjusted_partition")
-    with open(adjusted_partition, "wb") as fd:
-      self.image.WriteRangeDataToFd(self.hashtree_info.filesystem_range, fd)
-
-    generated_verity_tree = common.MakeTempFile(prefix="verity")
-    root_hash, salt = BuildVerityTree(adjusted_partition, generated_verity_tree)
-
     # The salt should be always identical, as we use fixed value.
-    assert salt == self.hashtree_info.salt, \
+    assert FIXED_SALT == self.hashtree_info.salt, \
         "Calculated salt {} doesn't match the one in metadata {}".format(
-            salt, self.hashtree_info.salt)
+            FIXED_SALT, self.hashtree_info.salt)
+
+    # Hashes the filesystem section straight from the sparse image, instead of
+    # writing it to a temp file for build_verity_tree.
+    root_hash, generated_verity_tree = BuildVerityHashtree(
+        self.image.IterRangeSet(self.hashtree_info.filesystem_range),
+        FIXED_SALT)
 
     if root_hash != self.hashtree_info.root_hash:
       logger.warning(
@@ -686,11 +934,10 @@ class VerifiedBootVersion1HashtreeInfoGenerator(HashtreeInfoGenerator):
           root_hash, self.hashtree_info.root_hash)
       return False
 
-    # Reads the generated hash tree and checks if it has the exact same bytes
-    # as the one in the sparse image.
-    with open(generated_verity_tree, 'rb') as fd:
-      return fd.read() == b''.join(self.image.ReadRangeSet(
-          self.hashtree_info.hashtree_range))
+    # Checks if the generated hash tree has the exact same bytes as the one in
+    # the sparse image.
+    return generated_verity_tree == b''.join(self.image.ReadRangeSet(
+        self.hashtree_info.hashtree_range))
 
   def Generate(self, image):
     """Parses and validates the hashtree info in a sparse image.
@@ -740,33 +987,159 @@ def GetDiskUsage(path):
   Returns:
     The number of bytes based on a 1K block_size.
   """
-  cmd = ["du", "-b", "-k", "-s", path]
-  output = common.RunAndCheckOutput(cmd, verbose=False)
-  return int(output.split()[0]) * 1024
+  return common.ScanDiskUsage(path).size
 
 
-def CalculateVbmetaDigest(extracted_dir, avbtool):
-  """Calculates the vbmeta digest of the images in the extracted target_file"""
+class _ImageReader(object):
+  """Reads byte ranges of an image, which may be in the Android sparse format.
 
+  Sparse images are read through their chunk map, as avbtool does, so that the
+  offsets are those of the unsparsed image.
+  """
+
+  def __init__(self, path):
+    self.path = path
+    with open(path, "rb") as f:
+      magic = f.read(4)
+    self._simg = None
+    if len(magic) == 4 and struct.unpack("<I", magic)[0] == 0xED26FF3A:
+      self._simg = sparse_img.SparseImage(path, lazy=True)
+      self.size = self._simg.blocksize * self._simg.total_blocks
+    else:
+      self.size = os.path.getsize(path)
+
+  def Read(self, offset, size):
+    if offset < 0 or size < 0 or offset + size > self.size:
+      raise ValueError("Invalid range {}+{} of {} (size {})".format(
+          offset, size, self.path, self.size))
+    if not self._simg:
+      with open(self.path, "rb") as f:
+        f.seek(offset)
+        return f.read(size)
+
+    block_size = self._simg.blocksize
+    first_block = offset // block_size
+    last_block = (offset + size + block_size - 1) // block_size
+    data = b"".join(self._simg.ReadRangeSet(
+        RangeSet(data=[first_block, last_block])))
+    start = offset - first_block * block_size
+    return data[start:start + size]
+
+  def Close(self):
+    if self._simg:
+      self._simg.simg_f.close()
+
+
+# From external/avb/avbtool.py: AvbFooter, AvbVBMetaHeader and
+# AvbChainPartitionDescriptor.
+AVB_FOOTER_FORMAT = "!4s2L3Q28x"
+AVB_VBMETA_HEADER_FORMAT = "!4s2L2QL11Q2L47sx80x"
+AVB_DESCRIPTOR_HEADER_FORMAT = "!2Q"
+AVB_CHAIN_PARTITION_DESCRIPTOR_TAG = 4
+AVB_CHAIN_PARTITION_DESCRIPTOR_SIZE = 92
+
+
+def _ReadVbmetaBlob(image_path):
+  """Returns the vbmeta blob of an image, and the descriptors in it.
+
+  Only the AVB footer (if any) and the vbmeta blob are read, as avbtool does
+  when it parses an image.
+  """
+  reader = _ImageReader(image_path)
+  try:
+    vbmeta_offset = 0
+    footer_size = struct.calcsize(AVB_FOOTER_FORMAT)
+    if reader.size >= footer_size:
+      footer = struct.unpack(
+          AVB_FOOTER_FORMAT,
+          reader.Read(reader.size - footer_size, footer_size))
+      if footer[0] == b"AVBf":
+        vbmeta_offset = footer[4]
+
+    header_size = struct.calcsize(AVB_VBMETA_HEADER_FORMAT)
+    header = struct.unpack(
+        AVB_VBMETA_HEADER_FORMAT, reader.Read(vbmeta_offset, header_size))
+    if header[0] != b"AVB0":
+      raise ValueError("No vbmeta found in {}".format(image_path))
+    authentication_data_block_size = header[3]
+    auxiliary_data_block_size = header[4]
+    descriptors_offset, descriptors_size = header[14:16]
+
+    blob = reader.Read(
+        vbmeta_offset,
+        header_size + authentication_data_block_size +
+        auxiliary_data_block_size)
+  finally:
+    reader.Close()
+
+  descriptors = []
+  offset = header_size + authentication_data_block_size + descriptors_offset
+  end = offset + descriptors_size
+  while offset < end:
+    tag, num_bytes_following = struct.unpack_from(
+        AVB_DESCRIPTOR_HEADER_FORMAT, blob, offset)
+    descriptor_size = (struct.calcsize(AVB_DESCRIPTOR_HEADER_FORMAT) +
+                       num_bytes_following)
+    descriptors.append((tag, blob[offset:offset + descriptor_size]))
+    offset += descriptor_size
+  return blob, descriptors
+
+
+def _CalculateVbmetaDigestWithAvbtool(image_paths, avbtool):
   images_dir = common.MakeTempDir()
+  for name, path in image_paths.items():
+    os.symlink(path, os.path.join(images_dir, name + ".img"))
+
+  cmd = [avbtool, "calculate_vbmeta_digest", "--image",
+         os.path.join(images_dir, 'vbmeta.img')]
+  return common.RunAndCheckOutput(cmd)
+
+
+def CalculateVbmetaDigest(extracted_dir, avbtool):
+  """Calculates the vbmeta digest of the images in the extracted target_file
+
+  It works the same as 'avbtool calculate_vbmeta_digest': the digest is the
+  SHA-256 over the vbmeta blob of vbmeta.img, followed by those of the
+  partitions that it chains to. The blobs are parsed from the images directly,
+  reading only their footers and vbmeta. avbtool is only used as a fallback,
+  should the images fail to parse.
+
+  Returns:
+    The hex digest, with a trailing newline as printed by avbtool.
+  """
+
+  # Images under PREBUILT_IMAGES, RADIO and IMAGES, keyed by partition name.
+  # The images in latter directory take precedence.
+  image_paths = {}
   for name in ("PREBUILT_IMAGES", "RADIO", "IMAGES"):
     path = os.path.join(extracted_dir, name)
     if not os.path.exists(path):
       continue
 
-    # Create symlink for image files under PREBUILT_IMAGES, RADIO and IMAGES,
-    # and put them into one directory.
     for filename in os.listdir(path):
       if not filename.endswith(".img"):
         continue
-      symlink_path = os.path.join(images_dir, filename)
-      # The files in latter directory overwrite the existing links
-      common.RunAndCheckOutput(
-        ['ln', '-sf', os.path.join(path, filename), symlink_path])
+      image_paths[filename[:-len(".img")]] = os.path.join(path, filename)
 
-  cmd = [avbtool, "calculate_vbmeta_digest", "--image",
-         os.path.join(images_dir, 'vbmeta.img')]
-  return common.RunAndCheckOutput(cmd)
+  try:
+    vbmeta_blob, descriptors = _ReadVbmetaBlob(image_paths["vbmeta"])
+    hasher = hashlib.sha256(vbmeta_blob)
+    for tag, descriptor in descriptors:
+      if tag != AVB_CHAIN_PARTITION_DESCRIPTOR_TAG:
+        continue
+      partition_name_len = struct.unpack_from("!L", descriptor, 20)[0]
+      partition_name = descriptor[
+          AVB_CHAIN_PARTITION_DESCRIPTOR_SIZE:
+          AVB_CHAIN_PARTITION_DESCRIPTOR_SIZE + partition_name_len].decode()
+      chained_blob, _ = _ReadVbmetaBlob(image_paths[partition_name])
+      hasher.update(chained_blob)
+  except (KeyError, ValueError, struct.error) as e:
+    logger.warning(
+        "Failed to calculate the vbmeta digest in-process (%s), falling back "
+        "to avbtool", e)
+    return _CalculateVbmetaDigestWithAvbtool(image_paths, avbtool)
+
+  return hasher.hexdigest() + "\n"
 
 
 def main(argv):
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2022 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextlib
+import os
+import shutil
+import tempfile
+import types
+import unittest
+from unittest import mock
+from findleaves import load_cache, load_mount_points, perform_find
+
+class FindLeavesTest(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.top = os.path.join(self.tmpdir, "top")
+    for d in ["a/b/c", "a/x", "d/e", "out/q", "p/q"]:
+      os.makedirs(os.path.join(self.top, d))
+    for f in ["a/Android.mk", "a/b/c/Android.mk", "d/e/Android.mk",
+              "out/q/Android.mk", "p/q/Android.mk", "p/CleanSpec.mk"]:
+      open(os.path.join(self.top, f), "w").close()
+    os.symlink("../..", os.path.join(self.top, "a/b/loop"))
+    os.symlink("../d", os.path.join(self.top, "p/q/tod"))
+    os.symlink("nowhere", os.path.join(self.top, "a/x/Android.mk"))
+    # Make the directories old enough to be cached.
+    for root, dirs, _ in os.walk(self.top):
+      for d in dirs:
+        os.utime(os.path.join(root, d), (0, 0))
+    os.utime(self.top, (0, 0))
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def find(self, *args, **kwargs):
+    return sorted(os.path.relpath(path, self.top) for path in
+                  perform_find(*args, **kwargs))
+
+  def test_find(self):
+    self.assertEqual(["a/Android.mk", "d/e/Android.mk", "out/q/Android.mk",
+                      "p/q/Android.mk"],
+                     self.find(-1, [], [self.top], ["Android.mk"]))
+
+  def test_prune_and_mindepth(self):
+    # Directories above mindepth are not marked as seen, so the walk follows
+    # the loop symlink back to the top once.
+    self.assertEqual(["a/b/c/Android.mk", "a/b/loop/a/Android.mk",
+                      "a/b/loop/d/e/Android.mk", "a/b/loop/p/q/Android.mk",
+                      "a/x/Android.mk", "d/e/Android.mk", "p/q/Android.mk"],
+                     self.find(3, ["out"], [self.top], ["Android.mk"]))
+
+  def test_jobs(self):
+    self.assertEqual(self.find(2, ["out"], [self.top], ["Android.mk"]),
+                     self.find(2, ["out"], [self.top], ["Android.mk"], jobs=2))
+
+  def test_cache(self):
+    cache_path = os.path.join(self.tmpdir, "cache")
+    expected = self.find(2, [], [self.top], ["Android.mk"])
+    self.assertEqual(expected, self.find(2, [], [self.top], ["Android.mk"],
+                                         cache_path=cache_path))
+    self.assertIn(os.path.join(self.top, "a"),
+                  load_cache(cache_path, ["Android.mk"]))
+    self.assertEqual(expected, self.find(2, [], [self.top], ["Android.mk"],
+                                         cache_path=cache_path))
+    os.remove(os.path.join(self.top, "d/e/Android.mk"))
+    open(os.path.join(self.top, "d/Android.mk"), "w").close()
+    self.assertEqual(["a/Android.mk", "d/Android.mk", "out/q/Android.mk",
+                      "p/q/Android.mk"],
+                     self.find(2, [], [self.top], ["Android.mk"],
+                               cache_path=cache_path))
+
+  def test_mount_point(self):
+    # Mounting needs root, so os.stat and os.scandir pretend that another file
+    # system, with the same inode numbers as top, is mounted on top/m.
+    shutil.copytree(os.path.join(self.top, "a"), os.path.join(self.top, "m/a"),
+                    symlinks=True)
+    os.utime(os.path.join(self.top, "m"), (0, 0))
+    mount_point = os.path.join(self.top, "m")
+    real_stat = os.stat
+    real_scandir = os.scandir
+
+    def mirror(path):
+      if path == mount_point or path.startswith(mount_point + "/"):
+        return self.top + path[len(mount_point):]
+      return None
+
+    def fake_stat(path):
+      st = real_stat(path)
+      if mirror(path) is None:
+        return st
+      return types.SimpleNamespace(
+          st_mode=st.st_mode, st_mtime_ns=st.st_mtime_ns, st_dev=st.st_dev + 1,
+          st_ino=real_stat(mirror(path)).st_ino)
+
+    class FakeEntry(object):
+      def __init__(self, entry, inode):
+        self.entry = entry
+        self._inode = inode
+      def __getattr__(self, name):
+        return getattr(self.entry, name)
+      def inode(self):
+        return self._inode
+
+    @contextlib.contextmanager
+    def fake_scandir(path):
+      with real_scandir(path) as it:
+        if mirror(path) is None:
+          yield it
+          return
+        yield [FakeEntry(entry, real_stat(mirror(entry.path),
+                                          follow_symlinks=False).st_ino)
+               for entry in it]
+
+    mountinfo = os.path.join(self.tmpdir, "mountinfo")
+    with open(mountinfo, "w") as f:
+      f.write("22 1 8:1 / / rw - ext4 /dev/sda1 rw\n"
+              "42 22 0:40 / %s rw - tmpfs tmpfs rw\n" % mount_point)
+    # Without a mountinfo, every subdirectory is stat'ed.
+    for mountinfo_path in (mountinfo, os.path.join(self.tmpdir, "none")):
+      cache_path = os.path.join(self.tmpdir, "cache", "Android.mk")
+      with mock.patch("findleaves.os.stat", fake_stat), \
+           mock.patch("findleaves.os.scandir", fake_scandir), \
+           mock.patch("findleaves.MOUNTINFO", mountinfo_path):
+        for kwargs in ({}, {"cache_path": cache_path},
+                       {"cache_path": cache_path}):
+          self.assertEqual(["a/Android.mk", "d/e/Android.mk", "m/a/Android.mk",
+                            "p/q/Android.mk"],
+                           self.find(-1, ["out"], [self.top], ["Android.mk"],
+                                     **kwargs))
+      shutil.rmtree(os.path.dirname(cache_path))
+
+  def test_load_mount_points(self):
+    mountinfo = os.path.join(self.tmpdir, "mountinfo")
+    with open(mountinfo, "w") as f:
+      f.write("22 1 8:1 / / rw - ext4 /dev/sda1 rw\n"
+              "42 22 0:40 / %s/a\\040b rw - tmpfs tmpfs rw\n"
+              "43 22 0:41 / %s/nowhere/c rw - tmpfs tmpfs rw\n" %
+              (self.top, self.top))
+    st = os.stat(self.top)
+    with mock.patch("findleaves.MOUNTINFO", mountinfo):
+      self.assertEqual({(st.st_dev, st.st_ino): {"a b"}}, load_mount_points())
+    with mock.patch("findleaves.MOUNTINFO", os.path.join(self.tmpdir, "none")):
+      self.assertIsNone(load_mount_points())
+
+if __name__ == "__main__":
+  unittest.main(verbosity=2)
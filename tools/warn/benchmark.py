@@ -0,0 +1,404 @@
+# python3
+# Copyright (C) 2022 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark the warn.py pipeline on a real or synthetic build log.
+
+Run from the parent directory of the warn package:
+
+  python3 -m warn.benchmark --size_mb 2048 --processes 1,2,4,8,16 \\
+      --json report.json
+
+Each stage of the pipeline is run separately: find_android_root,
+parse_input_file_android (and parse_input_file_android_parallel),
+parallel_classify_warnings, stream_classified_warnings and
+html_writer.write_html in the legacy and compact formats. The report has the
+time, input lines per second and peak memory of every stage. The peak memory
+is measured with tracemalloc in a second run of the stage, and does not
+include worker processes.
+
+The report also checks that the results of the optimization modes are the
+same: parsing and classifying with each process count, classify_one_warning
+with and without the WarnPatternMatcher and the ProjectResolver on the first
+--sample_size warnings, classifying with a cold and a warm --cache_path, and
+stream_classified_warnings. The exit status is 1 if a check fails.
+
+Without --log, a synthetic build.log of --size_mb megabytes is generated with
+a mix of clang, javac, clang-tidy, make and rustc warnings.
+"""
+
+import argparse
+import io
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# pylint:disable=relative-beyond-top-level,no-name-in-module
+# suppress false positive of no-name-in-module warnings
+from . import html_writer
+from . import pattern_matcher
+from . import project_resolver
+from . import warn
+from . import warn_common as common
+from . import warning_delta
+
+
+# Directories of the synthetic source files, covering a range of projects.
+_DIRS = [
+    'art/runtime', 'bionic/libc/bionic', 'build/make/core',
+    'external/googletest/googlemock/src', 'external/libpng',
+    'external/rust/crates/serde/src', 'frameworks/av/media/libstagefright',
+    'frameworks/base/core/jni', 'frameworks/base/services/core/java/com/x',
+    'frameworks/native/libs/binder', 'hardware/interfaces/audio',
+    'packages/apps/Settings/src/com/android/settings', 'system/core/init',
+    'vendor/acme/camera', 'out/soong/.intermediates/gen',
+]
+
+# Warning message templates: (file extension, message).
+_MESSAGES = [
+    ('.cpp', "unused variable 'result{n}' [-Wunused-variable]"),
+    ('.cpp', "comparison of integers of different signs: 'int' and "
+             "'size_t' [-Wsign-compare]"),
+    ('.cpp', "'Foo{n}' overrides a member function but is not marked "
+             "'override' [-Winconsistent-missing-override]"),
+    ('.c', "implicit conversion loses integer precision: 'long' to 'int' "
+           "[-Wshorten-64-to-32]"),
+    ('.cpp', "use nullptr [modernize-use-nullptr]"),
+    ('.cpp', "the parameter 'arg{n}' is copied for each invocation but only "
+             "used as a const reference [performance-unnecessary-value-param]"),
+    ('.cpp', "Value stored to 'x{n}' is never read "
+             "[clang-analyzer-deadcode.DeadStores]"),
+    ('.java', "[deprecation] method{n}() in Foo has been deprecated"),
+    ('.java', "[unchecked] unchecked conversion"),
+    ('.java', "[cast] redundant cast to Object"),
+    ('.mk', "ignoring old commands for target `out/target/foo{n}'"),
+    ('.cpp', "an unknown warning that no pattern matches {n}"),
+]
+
+_RUST_MESSAGES = [
+    'unused variable: `v{n}`',
+    'unused import: `std::io{n}`',
+]
+
+_NOISE = [
+    '[ 12% 3456/27890] //frameworks/base:framework-minus-apex javac\n',
+    'FAILED: out/soong/.intermediates/foo/bar.o\n',
+    'In file included from frameworks/base/core/jni/foo.cpp:12:\n',
+    '1 warning generated.\n',
+]
+
+
+def generate_log(path, size, seed=0):
+  """Write a synthetic build.log of about size bytes to path."""
+  rng = random.Random(seed)
+  with io.open(path, 'w', encoding='utf-8') as log:
+    log.write('PLATFORM_VERSION=13\nTARGET_PRODUCT=aosp_arm64\n'
+              'TARGET_BUILD_VARIANT=userdebug\nBUILD_ID=BENCH\n')
+    written = 0
+    n = 0
+    while written < size:
+      n += 1
+      # About a third of the warnings repeat, as in real logs where the same
+      # header is compiled many times.
+      key = rng.randrange(n if rng.random() < 0.3 else n * 8 + 1)
+      directory = _DIRS[key % len(_DIRS)]
+      if key % 13 == 0:
+        text = 'warning: %s\n   --> %s/file%d.rs:%d:%d\n' % (
+            _RUST_MESSAGES[key % len(_RUST_MESSAGES)].format(n=key),
+            directory, key % 97, key % 1000 + 1, key % 80 + 1)
+      else:
+        ext, message = _MESSAGES[key % len(_MESSAGES)]
+        text = '%s/file%d%s:%d:%d: warning: %s\n' % (
+            directory, key % 97, ext, key % 1000 + 1, key % 80 + 1,
+            message.format(n=key))
+      text += _NOISE[key % len(_NOISE)] * (key % 3)
+      log.write(text)
+      written += len(text)
+
+
+def _make_flags(args, processes):
+  return argparse.Namespace(platform='android', url=args.url, separator='?l=',
+                            processes=processes, byproject=False,
+                            compact_html=False, cache_path='',
+                            cache_max_age_days=30)
+
+
+def count_lines(path):
+  """Return the number of lines of the file at path."""
+  lines = 0
+  with open(path, 'rb') as log:
+    for block in iter(lambda: log.read(1 << 20), b''):
+      lines += block.count(b'\n')
+  return lines
+
+
+class Report(object):
+  """Stage measurements and mode checks of a benchmark run."""
+
+  def __init__(self, log, measure_memory):
+    self.measure_memory = measure_memory
+    self.data = {
+        'log': log,
+        'size_mb': round(os.path.getsize(log) / (1 << 20), 1),
+        'stages': [],
+        'checks': {},
+    }
+
+  def measure(self, stage, lines, func, *args, **params):
+    """Run func(*args) as a stage with lines of input and return its result.
+
+    If lines is None, func returns the number of lines it read. params, like
+    the number of processes, are saved with the measurements.
+    """
+    start = time.time()
+    result = func(*args)
+    elapsed = time.time() - start
+    if lines is None:
+      lines = result
+    entry = {'stage': stage}
+    entry.update(params)
+    entry.update({
+        'seconds': round(elapsed, 3),
+        'lines': lines,
+        'lines_per_sec': round(lines / elapsed) if elapsed else None,
+    })
+    if self.measure_memory:
+      tracemalloc.start()
+      func(*args)
+      entry['peak_mb'] = round(tracemalloc.get_traced_memory()[1] / (1 << 20),
+                               1)
+      tracemalloc.stop()
+    self.data['stages'].append(entry)
+    print(' '.join('%s=%s' % item for item in entry.items()), file=sys.stderr)
+    return result
+
+  def check(self, name, same):
+    """Save whether the results of a mode are the same as the baseline."""
+    self.data['checks'][name] = same
+    if not same:
+      print('check failed: ' + name, file=sys.stderr)
+
+  def passed(self):
+    return all(self.data['checks'].values())
+
+
+def _find_android_root(path):
+  """Return the number of log lines read by find_android_root."""
+  read = [0]
+
+  def count(log):
+    for line in log:
+      read[0] += 1
+      yield line
+
+  with io.open(path, encoding='utf-8') as log:
+    common.find_android_root(count(log))
+  return read[0]
+
+
+def parse_log(path, flags):
+  """Parse path and return the unique warnings."""
+  if flags.processes > 1:
+    warning_data, _ = common.parse_input_file_android_parallel(
+        path, flags, flags.processes)
+  else:
+    with io.open(path, encoding='utf-8') as log:
+      warning_data, _ = common.parse_input_file(log, flags)
+  return warning_data
+
+
+def benchmark_parse(args, report):
+  """Parse args.log with each of args.processes and return the warnings."""
+  lines = count_lines(args.log)
+  report.data['lines'] = lines
+  report.measure('find_android_root', None, _find_android_root, args.log)
+  baseline_data = None
+  for processes in [1] + [n for n in args.processes if n > 1]:
+    stage = ('parse_input_file_android' if processes == 1 else
+             'parse_input_file_android_parallel')
+    warning_data = report.measure(stage, lines, parse_log, args.log,
+                                  _make_flags(args, processes),
+                                  processes=processes)
+    if baseline_data is None:
+      baseline_data = warning_data
+    else:
+      report.check('parse processes=%d' % processes,
+                   list(warning_data.items()) == list(baseline_data.items()))
+  report.data['unique_warnings'] = len(baseline_data)
+  return baseline_data
+
+
+def _load_patterns(platform):
+  warn_patterns = common.get_warn_patterns(platform)
+  project_list = common.get_project_list(platform)
+  project_names = common.get_project_names(project_list)
+  project_patterns = [re.compile(p[1]) for p in project_list]
+  return warn_patterns, project_names, project_patterns
+
+
+def classify(warning_data, flags):
+  """Classify warning_data and return the classified warnings."""
+  warn_patterns, project_names, project_patterns = _load_patterns(
+      flags.platform)
+  return warning_delta.results_of(*common.parallel_classify_warnings(
+      warning_data, flags, project_names, project_patterns, warn_patterns,
+      False, warn.create_and_launch_subprocesses, warn.classify_warnings))
+
+
+def stream(path, flags):
+  """Return the classified warnings of stream_classified_warnings."""
+  warn_patterns, _, project_patterns = _load_patterns(flags.platform)
+  with io.open(path, encoding='utf-8') as log:
+    return [tuple(result) for result in common.stream_classified_warnings(
+        log, flags, project_patterns, warn_patterns)]
+
+
+def classify_sample(sample, project_patterns, warn_patterns, warn_matcher,
+                    resolver):
+  """Classify sample with classify_one_warning and return the results."""
+  results = []
+  for warning, link in sample:
+    common.classify_one_warning(warning, link, results, project_patterns,
+                                warn_patterns, warn_matcher, resolver)
+  return results
+
+
+def benchmark_matcher(warning_data, flags, sample_size, report):
+  """Compare the linear scans with the pattern matcher and project resolver."""
+  warn_patterns, _, project_patterns = _load_patterns(flags.platform)
+  sample = list(warning_data.items())[:sample_size]
+  warn_matcher = pattern_matcher.WarnPatternMatcher(warn_patterns)
+  resolver = project_resolver.ProjectResolver(project_patterns)
+  baseline_results = None
+  for name, matcher, trie in (('linear', None, None),
+                              ('matcher', warn_matcher, None),
+                              ('resolver', warn_matcher, resolver)):
+    results = report.measure('classify_one_warning', len(sample),
+                             classify_sample, sample, project_patterns,
+                             warn_patterns, matcher, trie, mode=name)
+    if baseline_results is None:
+      baseline_results = results
+    else:
+      report.check('classify_one_warning ' + name,
+                   results == baseline_results)
+
+
+def benchmark_cache(warning_data, args, baseline, report):
+  """Check that classifying with a cold and a warm cache gives baseline."""
+  flags = _make_flags(args, args.processes[0])
+  with tempfile.TemporaryDirectory() as tmpdir:
+    flags.cache_path = os.path.join(tmpdir, 'cache.db')
+    for name in ('cold', 'warm'):
+      report.check('classify cache=' + name,
+                   classify(warning_data, flags) == baseline)
+
+
+def benchmark_classify(args, report):
+  """Run all the stages on args.log and check the results of all modes."""
+  warning_data = benchmark_parse(args, report)
+  benchmark_matcher(warning_data, _make_flags(args, 1), args.sample_size,
+                    report)
+  baseline = None
+  for processes in args.processes:
+    results = report.measure('parallel_classify_warnings', len(warning_data),
+                             classify, warning_data,
+                             _make_flags(args, processes),
+                             processes=processes)
+    if baseline is None:
+      baseline = results
+    else:
+      report.check('classify processes=%d' % processes, results == baseline)
+  benchmark_cache(warning_data, args, baseline, report)
+  results = report.measure('stream_classified_warnings',
+                           report.data['lines'], stream,
+                           args.log, _make_flags(args, 1))
+  report.check('stream_classified_warnings', results == baseline)
+  benchmark_html(warning_data, args, report)
+
+
+def write_html(flags, html_path, warn_patterns, project_names,
+               warning_messages, warning_links, warning_records):
+  html_writer.write_html(flags, project_names, warn_patterns, html_path,
+                         warning_messages, warning_links, warning_records,
+                         'benchmark')
+
+
+def benchmark_html(warning_data, args, report):
+  """Compare the time and size of the legacy and compact HTML reports."""
+  flags = _make_flags(args, 1)
+  warn_patterns, project_names, project_patterns = _load_patterns(
+      flags.platform)
+  warning_messages, warning_links, warning_records = (
+      common.parallel_classify_warnings(
+          warning_data, flags, project_names, project_patterns, warn_patterns,
+          False, warn.create_and_launch_subprocesses, warn.classify_warnings))
+  with tempfile.TemporaryDirectory() as tmpdir:
+    for name, compact, filename in (('legacy', False, 'warnings.html'),
+                                    ('compact', True, 'warnings.html'),
+                                    ('compact+gzip', True, 'warnings.html.gz')):
+      flags.compact_html = compact
+      html_path = os.path.join(tmpdir, filename)
+      report.measure('write_html', len(warning_records), write_html, flags,
+                     html_path, warn_patterns, project_names,
+                     warning_messages, warning_links, warning_records,
+                     format=name)
+      report.data['stages'][-1]['output_mb'] = round(
+          os.path.getsize(html_path) / (1 << 20), 1)
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--log', help='Build log to use instead of a synthetic '
+                      'one')
+  parser.add_argument('--size_mb', type=int, default=64,
+                      help='Size of the synthetic build log')
+  parser.add_argument('--processes', default='1,2,4',
+                      type=lambda s: [int(n) for n in s.split(',')],
+                      help='Comma separated process counts to compare')
+  parser.add_argument('--sample_size', type=int, default=20000,
+                      help='Number of warnings to classify with and without '
+                      'the pattern matcher and project resolver')
+  parser.add_argument('--url', default='',
+                      help='Root URL prefixed to the warning links')
+  parser.add_argument('--json', default='',
+                      help='Save the JSON report to the passed path instead '
+                      'of stdout')
+  parser.add_argument('--no_memory', action='store_true',
+                      help='Do not measure the peak memory of the stages')
+  args = parser.parse_args()
+
+  with tempfile.TemporaryDirectory() as tmpdir:
+    if not args.log:
+      args.log = os.path.join(tmpdir, 'build.log')
+      generate_log(args.log, args.size_mb << 20)
+    report = Report(args.log, not args.no_memory)
+    benchmark_classify(args, report)
+  if args.json:
+    with open(args.json, 'w') as output:
+      json.dump(report.data, output, indent=2)
+  else:
+    json.dump(report.data, sys.stdout, indent=2)
+    print()
+  if not report.passed():
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,126 @@
+# python3
+# Copyright (C) 2022 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Persistent cache of warning classifications across warn.py runs.
+
+Most warnings of a build are the same as those of the previous build. The
+cache is an SQLite database that maps the hash of a normalized warning line
+and the version of the warn and project patterns to the classified pattern
+and project indices, so only new warnings need to be classified. Entries that
+have not been used for max_age_days are removed.
+"""
+
+import hashlib
+import json
+import sqlite3
+import time
+
+# Pattern index of warnings that match no warn pattern.
+UNCLASSIFIED = -1
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS warnings (
+  version TEXT NOT NULL,
+  line_hash BLOB NOT NULL,
+  pattern_idx INTEGER NOT NULL,
+  project_idx INTEGER NOT NULL,
+  last_used INTEGER NOT NULL,
+  PRIMARY KEY (version, line_hash)
+) WITHOUT ROWID
+"""
+
+
+def pattern_set_version(warn_patterns, project_patterns):
+  """Return a hash of the patterns that the cached indices refer to."""
+  patterns = {
+      'warn': [pattern['patterns'] for pattern in warn_patterns],
+      'project': [(cpat.pattern, cpat.flags) for cpat in project_patterns],
+  }
+  return hashlib.sha256(
+      json.dumps(patterns, sort_keys=True).encode('utf-8')).hexdigest()[:32]
+
+
+def line_hash(line):
+  """Return the cache key of a normalized warning line."""
+  return hashlib.blake2b(line.encode('utf-8'), digest_size=16).digest()
+
+
+class ClassificationCache(object):
+  """An SQLite cache of (pattern index, project index) of warning lines."""
+
+  def __init__(self, path, version, max_age_days):
+    self.version = version
+    self.max_age = max_age_days * 24 * 3600
+    self.now = int(time.time())
+    self.hits = 0
+    self.misses = 0
+    self.connection = sqlite3.connect(path)
+    self.connection.execute(_SCHEMA)
+
+  def lookup(self, lines):
+    """Return {line: (pattern_idx, project_idx)} of the cached lines."""
+    cached = {}
+    for line_key, pattern_idx, project_idx in self.connection.execute(
+        'SELECT line_hash, pattern_idx, project_idx FROM warnings '
+        'WHERE version = ?', (self.version,)):
+      cached[line_key] = (pattern_idx, project_idx)
+    hits = {}
+    used = []
+    for line in lines:
+      key = line_hash(line)
+      if key in cached:
+        hits[line] = cached[key]
+        used.append((self.now, self.version, key))
+    with self.connection:
+      self.connection.executemany(
+          'UPDATE warnings SET last_used = ? '
+          'WHERE version = ? AND line_hash = ?', used)
+    self.hits += len(hits)
+    self.misses += len(lines) - len(hits)
+    return hits
+
+  def update(self, lines, classified):
+    """Save the classification of lines.
+
+    Args:
+      lines: the classified warning lines.
+      classified: {line: (pattern_idx, project_idx)} of the lines matching a
+          warn pattern.
+    """
+    rows = []
+    for line in lines:
+      pattern_idx, project_idx = classified.get(line, (UNCLASSIFIED, -1))
+      rows.append((self.version, line_hash(line), pattern_idx, project_idx,
+                   self.now))
+    with self.connection:
+      self.connection.executemany(
+          'INSERT OR REPLACE INTO warnings VALUES (?, ?, ?, ?, ?)', rows)
+
+  def evict(self):
+    """Remove the entries not used for max_age_days. Return their number."""
+    with self.connection:
+      cursor = self.connection.execute(
+          'DELETE FROM warnings WHERE last_used < ?',
+          (self.now - self.max_age,))
+    return cursor.rowcount
+
+  def close(self):
+    self.connection.close()
+
+  def stats(self):
+    """Return a line of cache statistics."""
+    total = self.hits + self.misses
+    return 'warning cache: %d hits, %d misses, hit rate %.1f%%' % (
+        self.hits, self.misses, 100.0 * self.hits / total if total else 0.0)
@@ -56,10 +56,15 @@
 
 from __future__ import print_function
 import csv
+import gzip
 import html
+import io
+import json
+import re
 import sys
 
 # pylint:disable=relative-beyond-top-level
+from . import warning_delta
 from .severity import Severity
 
 
@@ -67,6 +72,8 @@ from .severity import Severity
 LIMIT_WARNINGS_PER_FILE = 100
 # Report files/directories with this percentage of total warnings or more.
 LIMIT_PERCENT_WARNINGS = 1
+# Size of the write buffer of HTML files.
+HTML_BUFFER_SIZE = 1 << 20
 
 HTML_HEAD_SCRIPTS = """\
   <script type="text/javascript">
@@ -635,6 +642,135 @@ def emit_js_data(writer, flags, warning_messages, warning_links,
     emit_const_html_string_array('WarningLinks', warning_links, writer)
 
 
+COMPACT_DATA_JAVASCRIPT = """
+  const Prefixes = [];
+  function expandStrings(blocks) {
+    var result = [];
+    for (var b=0; b<blocks.length; b++) {
+      Array.prototype.push.apply(Prefixes, blocks[b][0]);
+      var items = blocks[b][1];
+      for (var i=0; i<items.length; i+=2) {
+        result.push(Prefixes[items[i]] + items[i+1]);
+      }
+    }
+    return result;
+  }
+  function flatten(blocks) {
+    return [].concat.apply([], blocks);
+  }
+  const ProjectNames = CompactData.projectNames;
+  const WarnPatternsSeverity = CompactData.warnPatternsSeverity;
+  const WarnPatternsDescription = CompactData.warnPatternsDescription;
+  const WarningMessages = expandStrings(CompactData.messages);
+  const Warnings = flatten(CompactData.warnings);
+"""
+
+# The number of messages, links or records written at once in the compact
+# payload.
+COMPACT_BLOCK_SIZE = 4096
+
+_COMPACT_ENCODER = json.JSONEncoder(separators=(',', ':'), check_circular=False)
+
+# The file path prefix up to the last '/' before the first ':' of a line.
+PATH_PREFIX_PATTERN = re.compile(r'^((?:[^:\n]*/)?)(.*)$', re.MULTILINE)
+
+
+def split_path_prefix(line):
+  """Split line after the last '/' of the file path at its start."""
+  end = line.find(':')
+  slash = line.rfind('/', 0, len(line) if end < 0 else end)
+  return line[:slash + 1], line[slash + 1:]
+
+
+def split_html_strings(block):
+  """Return the (path prefix, suffix) of the HTML escaped strings of block.
+
+  The strings are escaped like emit_const_html_string_array has them. They are
+  joined, escaped and split at once, unless some contain newlines.
+  """
+  text = html.escape('\n'.join(block))
+  if text.count('\n') == len(block) - 1:
+    return PATH_PREFIX_PATTERN.findall(text)
+  return [split_path_prefix(html.escape(item[:-1] if item.endswith('\n')
+                                        else item))
+          for item in block]
+
+
+class PrefixTable(dict):
+  """Map path prefixes to their index, and collect the ones not seen before."""
+
+  def __init__(self):
+    super().__init__()
+    self.new_prefixes = []
+
+  def __missing__(self, prefix):
+    index = self[prefix] = len(self)
+    self.new_prefixes.append(prefix)
+    return index
+
+
+def emit_compact_js_data(writer, flags, warning_messages, warning_links,
+                         warning_records, warn_patterns, project_names):
+  """Dump the data of emit_js_data as one compact JavaScript object.
+
+  The long arrays are written as JSON in blocks of COMPACT_BLOCK_SIZE items,
+  so that the payload is neither held in memory as a whole nor formatted item
+  by item. The path prefixes of warning messages and links are saved once in a
+  string table: each block of strings is [new prefixes, [index, suffix, ...]],
+  where the new prefixes extend the table of the earlier blocks.
+  """
+  prefixes = PrefixTable()
+
+  def encode(value):
+    # The payload is in a <script>; do not let any string end it.
+    return _COMPACT_ENCODER.encode(value).replace('</', '<\\/')
+
+  def compact_strings(block):
+    pairs = split_html_strings(block)
+    items = [None] * (2 * len(pairs))
+    items[0::2] = map(prefixes.__getitem__, [prefix for prefix, _ in pairs])
+    items[1::2] = [suffix for _, suffix in pairs]
+    new_prefixes = prefixes.new_prefixes
+    prefixes.new_prefixes = []
+    return [new_prefixes, items]
+
+  def emit_blocks(name, array, convert_block):
+    # The blocks hold numbers and HTML escaped strings, which have no '</'.
+    writer(name + ':[')
+    for start in range(0, len(array), COMPACT_BLOCK_SIZE):
+      writer(_COMPACT_ENCODER.encode(
+          convert_block(array[start:start + COMPACT_BLOCK_SIZE])) + ',')
+    writer('],')
+
+  emit_const_string('FlagPlatform', flags.platform, writer)
+  emit_const_string('FlagURL', flags.url, writer)
+  emit_const_string('FlagSeparator', flags.separator, writer)
+  emit_const_number('LimitWarningsPerFile', LIMIT_WARNINGS_PER_FILE, writer)
+  emit_const_number('LimitPercentWarnings', LIMIT_PERCENT_WARNINGS, writer)
+  emit_const_string_array('SeverityColors', [s.color for s in Severity.levels],
+                          writer)
+  emit_const_string_array('SeverityHeaders',
+                          [s.header for s in Severity.levels], writer)
+  emit_const_string_array('SeverityColumnHeaders',
+                          [s.column_header for s in Severity.levels], writer)
+  writer('const CompactData = {')
+  writer('projectNames:' + encode(project_names) + ',')
+  # pytype: disable=attribute-error
+  writer('warnPatternsSeverity:' +
+         encode([w['severity'].value for w in warn_patterns]) + ',')
+  # pytype: enable=attribute-error
+  writer('warnPatternsDescription:' +
+         encode([html.escape(w['description']) for w in warn_patterns]) + ',')
+  emit_blocks('messages', warning_messages, compact_strings)
+  emit_blocks('warnings', warning_records, list)
+  if flags.platform == 'chrome':
+    emit_blocks('links', warning_links, compact_strings)
+  writer('};')
+  writer(COMPACT_DATA_JAVASCRIPT)
+  if flags.platform == 'chrome':
+    writer('const WarningLinks = expandStrings(CompactData.links);')
+
+
 DRAW_TABLE_JAVASCRIPT = """
 google.charts.load('current', {'packages':['table']});
 google.charts.setOnLoadCallback(genTables);
@@ -837,8 +973,12 @@ def dump_html(flags, output_stream, warning_messages, warning_links,
         str(LIMIT_WARNINGS_PER_FILE) + ' warnings')
   def section4():
     writer('<script>')
-    emit_js_data(writer, flags, warning_messages, warning_links,
-                 warning_records, warn_patterns, project_names)
+    if flags.compact_html:
+      emit_compact_js_data(writer, flags, warning_messages, warning_links,
+                           warning_records, warn_patterns, project_names)
+    else:
+      emit_js_data(writer, flags, warning_messages, warning_links,
+                   warning_records, warn_patterns, project_names)
     writer(SCRIPTS_FOR_WARNING_GROUPS)
     writer('</script>')
     dump_section_header(writer, 'all_warnings_section',
@@ -860,11 +1000,21 @@ def dump_html(flags, output_stream, warning_messages, warning_links,
   dump_html_epilogue(writer)
 
 
+def open_html_file(path):
+  """Open an HTML file for buffered writing, gzip-compressed if path is .gz."""
+  if path.endswith('.gz'):
+    return io.TextIOWrapper(
+        io.BufferedWriter(gzip.GzipFile(path, 'wb', compresslevel=6),
+                          HTML_BUFFER_SIZE),
+        encoding='utf-8')
+  return open(path, 'w', buffering=HTML_BUFFER_SIZE, encoding='utf-8')
+
+
 def write_html(flags, project_names, warn_patterns, html_path, warning_messages,
                warning_links, warning_records, header_str):
   """Write warnings html file."""
   if html_path:
-    with open(html_path, 'w') as outf:
+    with open_html_file(html_path) as outf:
       dump_html(flags, outf, warning_messages, warning_links, warning_records,
                 header_str, warn_patterns, project_names)
 
@@ -884,6 +1034,135 @@ def write_out_csv(flags, warn_patterns, warning_messages, warning_links,
 
   if flags.gencsv:
     dump_csv(csv.writer(sys.stdout, lineterminator='\n'), warn_patterns)
+  elif flags.htmlpath:
+    with open_html_file(flags.htmlpath) as outf:
+      dump_html(flags, outf, warning_messages, warning_links,
+                warning_records, header_str, warn_patterns, project_names)
   else:
     dump_html(flags, sys.stdout, warning_messages, warning_links,
               warning_records, header_str, warn_patterns, project_names)
+
+
+def delta_rows(warn_patterns, project_names, added, removed):
+  """Return [added, removed, delta, project, warning] rows of changes.
+
+  Each warn pattern with changes has a row of its totals followed by rows of
+  its projects, ordered by severity. The last rows are the totals of each
+  project and of all warnings.
+  """
+  added_counts = warning_delta.count_by_pattern(added, project_names)
+  removed_counts = warning_delta.count_by_pattern(removed, project_names)
+  rows = []
+  by_project = {}
+  for severity in Severity.levels:
+    for idx, pattern in enumerate(warn_patterns):
+      if pattern['severity'] != severity:
+        continue
+      pattern_added = added_counts.get(idx, {})
+      pattern_removed = removed_counts.get(idx, {})
+      if not pattern_added and not pattern_removed:
+        continue
+      warning = severity.column_header + ': ' + (pattern['description'] or '?')
+      num_added = sum(pattern_added.values())
+      num_removed = sum(pattern_removed.values())
+      rows.append([num_added, num_removed, num_added - num_removed, '',
+                   warning])
+      for project in sorted(set(pattern_added) | set(pattern_removed)):
+        num_added = pattern_added.get(project, 0)
+        num_removed = pattern_removed.get(project, 0)
+        rows.append([num_added, num_removed, num_added - num_removed, project,
+                     warning])
+        totals = by_project.setdefault(project, [0, 0])
+        totals[0] += num_added
+        totals[1] += num_removed
+  for project in sorted(by_project):
+    num_added, num_removed = by_project[project]
+    rows.append([num_added, num_removed, num_added - num_removed, project,
+                 'All warnings'])
+  rows.append([len(added), len(removed), len(added) - len(removed), '',
+               'All warnings'])
+  return rows
+
+
+def dump_delta_with_description(csvwriter, warn_patterns, project_names,
+                                added, removed):
+  """Outputs the added and removed warning messages by project."""
+  csv_output = []
+  for change, warnings in (('added', added), ('removed', removed)):
+    for message, _, pattern_idx, project_idx in warnings:
+      pattern = warn_patterns[pattern_idx]
+      project_name = '???' if project_idx < 0 else project_names[project_idx]
+      csv_output.append([change, project_name, pattern['severity'].header,
+                         pattern['category'], pattern['description'],
+                         message])
+  for output in sorted(csv_output):
+    csvwriter.writerow(output)
+
+
+def dump_delta_html(flags, output_stream, header_str, warn_patterns,
+                    project_names, added, removed):
+  """Dump the added and removed warnings in an HTML page."""
+  writer = make_writer(output_stream)
+  title = html.escape('Warning changes: ' + header_str)
+  writer('<html>\n<head>')
+  writer('<title>' + title + '</title>')
+  writer('<style type="text/css">')
+  writer('  th,td{border-collapse:collapse; border:1px solid black;}')
+  writer('</style>')
+  writer('</head>\n<body>')
+  writer(html_big(title))
+  writer('<p>%d added, %d removed warnings</p>' % (len(added), len(removed)))
+  writer('<table>')
+  writer('<tr><th>Added</th><th>Removed</th><th>Delta</th><th>Project</th>'
+         '<th>Warning</th></tr>')
+  for row in delta_rows(warn_patterns, project_names, added, removed):
+    writer('<tr>' + ''.join('<td>%s</td>' % html.escape(str(cell))
+                            for cell in row) + '</tr>')
+  writer('</table>')
+  for section, warnings in (('Added warnings', added),
+                            ('Removed warnings', removed)):
+    if not warnings:
+      continue
+    writer('<h3>%s</h3>' % section)
+    writer('<table>')
+    writer('<tr><th>Severity</th><th>Warning</th><th>Project</th>'
+           '<th>Message</th></tr>')
+    for message, link, pattern_idx, project_idx in sorted(
+        warnings, key=lambda w: (warn_patterns[w[2]]['severity'].value, w[2],
+                                 w[0])):
+      pattern = warn_patterns[pattern_idx]
+      project_name = '???' if project_idx < 0 else project_names[project_idx]
+      message = html.escape(message)
+      if flags.url:
+        message = '<a href="%s">%s</a>' % (html.escape(link), message)
+      writer('<tr><td>%s</td><td>%s</td><td>%s</td><td>%s</td></tr>' % (
+          pattern['severity'].column_header,
+          html.escape(pattern['description'] or '?'),
+          html.escape(project_name), message))
+    writer('</table>')
+  writer('</body>\n</html>')
+
+
+def write_out_delta(flags, warn_patterns, project_names, added, removed,
+                    header_str):
+  """Write the added and removed warnings in place of write_out_csv output."""
+  if flags.csvpath:
+    with open(flags.csvpath, 'w') as outf:
+      csv.writer(outf, lineterminator='\n').writerows(
+          delta_rows(warn_patterns, project_names, added, removed))
+
+  if flags.csvwithdescription:
+    with open(flags.csvwithdescription, 'w') as outf:
+      dump_delta_with_description(csv.writer(outf, lineterminator='\n'),
+                                  warn_patterns, project_names, added, removed)
+
+  if flags.gencsv:
+    csv.writer(sys.stdout, lineterminator='\n').writerows(
+        delta_rows(warn_patterns, project_names, added, removed))
+  elif flags.htmlpath:
+    with open_html_file(flags.htmlpath) as outf:
+      dump_delta_html(flags, outf, header_str, warn_patterns, project_names,
+                      added, removed)
+  else:
+    dump_delta_html(flags, sys.stdout, header_str, warn_patterns,
+                    project_names, added, removed)
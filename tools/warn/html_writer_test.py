@@ -0,0 +1,158 @@
+# python3
+# Copyright (C) 2022 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unittests for html_writer.
+
+Run from the parent directory of the warn package:
+
+  python3 -m warn.html_writer_test
+"""
+
+import argparse
+import gzip
+import html
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+# pylint:disable=relative-beyond-top-level,no-name-in-module
+# suppress false positive of no-name-in-module warnings
+from . import html_writer
+from . import warn_common as common
+
+
+def _flags(**kwargs):
+  flags = argparse.Namespace(
+      platform='android', url='', separator='?l=', byproject=False,
+      compact_html=False, csvpath='', csvwithdescription='', gencsv=False,
+      htmlpath='')
+  for key, value in kwargs.items():
+    setattr(flags, key, value)
+  return flags
+
+
+class WriteOutDeltaTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.warn_patterns = common.get_warn_patterns('android')
+    self.project_names = ['art', 'bionic']
+    line = 'bionic/b.c:3:4: warning: unused variable \'y\' [-Wunused-variable]'
+    pattern_idx = next(
+        idx for idx, pattern in enumerate(self.warn_patterns)
+        if any(cpat.match(line) for cpat in pattern['compiled_patterns']))
+    self.added = [[line, 'bionic/b.c', pattern_idx, 1]]
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def _write_out_delta(self, flags):
+    html_writer.write_out_delta(flags, self.warn_patterns, self.project_names,
+                                self.added, [], 'header')
+
+  def test_htmlpath(self):
+    path = os.path.join(self.tmpdir, 'delta.html')
+    self._write_out_delta(_flags(htmlpath=path))
+    with open(path) as f:
+      html = f.read()
+    self.assertIn('1 added, 0 removed warnings', html)
+    self.assertIn('bionic/b.c:3:4', html)
+
+  def test_htmlpath_gz(self):
+    path = os.path.join(self.tmpdir, 'delta.html.gz')
+    self._write_out_delta(_flags(htmlpath=path))
+    with gzip.open(path, 'rt') as f:
+      self.assertIn('1 added, 0 removed warnings', f.read())
+
+
+class CompactJsDataTest(unittest.TestCase):
+
+  def setUp(self):
+    self.warn_patterns = common.get_warn_patterns('android')
+    self.messages = ['a/b.cc:1:2: warning: x </script> "q" \\ \u2019',
+                     'd.cc:3: warning: y\n', 'e/f/g.cc:1: warning: <b> a/b',
+                     'no path'] * 3
+    self.records = [[i % 2, i % 5, i] for i in range(len(self.messages))]
+
+  def _emit(self, **kwargs):
+    lines = []
+    with mock.patch.object(html_writer, 'COMPACT_BLOCK_SIZE', 3):
+      html_writer.emit_compact_js_data(
+          lines.append, _flags(**kwargs), self.messages, self.messages,
+          self.records, self.warn_patterns, ['art', 'bionic'])
+    return lines
+
+  @staticmethod
+  def _blocks(lines, name):
+    start = lines.index(name + ':[') + 1
+    end = lines.index('],', start)
+    return [json.loads(line.rstrip(',')) for line in lines[start:end]]
+
+  @staticmethod
+  def _expand(blocks, prefixes):
+    """Python version of expandStrings."""
+    strings = []
+    for new_prefixes, items in blocks:
+      prefixes.extend(new_prefixes)
+      for index, suffix in zip(items[0::2], items[1::2]):
+        strings.append(prefixes[index] + suffix)
+    return strings
+
+  def _expected_strings(self):
+    # JSON does the escaping of strip_escape_string.
+    return [html.escape(m.rstrip('\n')) for m in self.messages]
+
+  def test_split_html_strings(self):
+    # With and without the newline fallback.
+    for block in (self.messages, self.messages[:1], self.messages[2:]):
+      self.assertEqual(
+          [html_writer.split_path_prefix(html.escape(m.rstrip('\n')))
+           for m in block],
+          [tuple(pair) for pair in html_writer.split_html_strings(block)])
+    self.assertEqual([('e/f/', 'g.cc:1: warning: a/b')],
+                     html_writer.split_html_strings(
+                         ['e/f/g.cc:1: warning: a/b']))
+
+  def test_blocks(self):
+    lines = self._emit()
+    blocks = self._blocks(lines, 'messages')
+    self.assertEqual(4, len(blocks))
+    # Each prefix is only saved with the first block that has it.
+    self.assertEqual(['a/', '', 'e/f/'], blocks[0][0] + blocks[1][0])
+    self.assertEqual([], blocks[2][0] + blocks[3][0])
+    self.assertEqual(self._expected_strings(), self._expand(blocks, []))
+    self.assertEqual(self.records,
+                     [r for block in self._blocks(lines, 'warnings')
+                      for r in block])
+    self.assertNotIn('links:[', lines)
+    self.assertFalse([line for line in lines if '</' in line])
+
+  def test_chrome_links(self):
+    lines = self._emit(platform='chrome')
+    prefixes = []
+    self.assertEqual(self._expected_strings(),
+                     self._expand(self._blocks(lines, 'messages'), prefixes))
+    # The links share the prefix table of the messages.
+    links = self._blocks(lines, 'links')
+    self.assertEqual([], [p for new_prefixes, _ in links for p in new_prefixes])
+    self.assertEqual(self._expected_strings(), self._expand(links, prefixes))
+    self.assertIn('const WarningLinks = expandStrings(CompactData.links);',
+                  lines)
+
+if __name__ == '__main__':
+  unittest.main(verbosity=2)
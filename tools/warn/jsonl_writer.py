@@ -0,0 +1,79 @@
+# python3
+# Copyright (C) 2022 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Write classified warnings as JSON Lines, one JSON object per warning.
+
+Each line is an object with the keys path, line, column, severity, pattern,
+description, project, link and message. line and column are null if the
+warning has no such position. pattern is the index of the matched warn
+pattern, and description its description.
+"""
+
+import json
+import re
+import sys
+
+# Number of warnings written between two flushes of the output.
+FLUSH_WARNINGS = 1000
+
+_ENCODER = json.JSONEncoder(separators=(',', ':'), check_circular=False)
+
+# A file path, then an optional line number and column number.
+_POSITION = re.compile(r'([^:]*):(?:([0-9]+):)?(?:([0-9]+):)?')
+
+
+def warning_object(line, link, pattern_idx, project_idx, warn_patterns,
+                   project_names):
+  """Return the JSON object of a classified warning."""
+  position = _POSITION.match(line)
+  pattern = warn_patterns[pattern_idx]
+  return {
+      'path': position.group(1),
+      'line': int(position.group(2)) if position.group(2) else None,
+      'column': int(position.group(3)) if position.group(3) else None,
+      'severity': pattern['severity'].column_header,
+      'pattern': pattern_idx,
+      'description': pattern['description'],
+      'project': '???' if project_idx < 0 else project_names[project_idx],
+      'link': link,
+      'message': line,
+  }
+
+
+def write_jsonl(output, warnings, warn_patterns, project_names):
+  """Write each (line, link, pattern index, project index) of warnings.
+
+  The output is flushed every FLUSH_WARNINGS warnings, so that readers can
+  load it while warnings is still being generated. Return the number of
+  written warnings.
+  """
+  count = 0
+  for line, link, pattern_idx, project_idx in warnings:
+    output.write(_ENCODER.encode(
+        warning_object(line, link, pattern_idx, project_idx, warn_patterns,
+                       project_names)) + '\n')
+    count += 1
+    if count % FLUSH_WARNINGS == 0:
+      output.flush()
+  output.flush()
+  return count
+
+
+def write_out_jsonl(path, warnings, warn_patterns, project_names):
+  """Write warnings to path, or to stdout if path is '-'."""
+  if path == '-':
+    return write_jsonl(sys.stdout, warnings, warn_patterns, project_names)
+  with open(path, 'w', encoding='utf-8') as output:
+    return write_jsonl(output, warnings, warn_patterns, project_names)
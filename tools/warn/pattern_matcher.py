@@ -0,0 +1,115 @@
+# python3
+# Copyright (C) 2022 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Find the first matching warn pattern without trying every regex.
+
+Almost all warn patterns look like '.*: warning: <literal text>...'. A word
+that is surrounded by non-word characters inside such a literal text must also
+be a whole word of every line matched by the pattern. WarnPatternMatcher
+indexes each pattern by its rarest such keyword, splits a warning line into
+words once, and runs the full regexes only for the patterns whose keyword is
+in the line, plus the few patterns without any keyword.
+"""
+
+import re
+
+try:
+  from re import _parser as sre_parse  # Python 3.11+
+except ImportError:
+  import sre_parse  # pylint:disable=deprecated-module
+
+_WORD = re.compile(r'\w+')
+
+
+def _literal_runs(items, runs):
+  """Append the runs of literal text required by parsed regex items."""
+  current = []
+  for op, av in items:
+    if op is sre_parse.LITERAL:
+      current.append(chr(av))
+      continue
+    if current:
+      runs.append(''.join(current))
+      current = []
+    if op is sre_parse.SUBPATTERN:
+      add_flags = av[1]
+      if not add_flags & re.IGNORECASE:
+        _literal_runs(av[-1], runs)
+  if current:
+    runs.append(''.join(current))
+
+
+def _anchored_words(text):
+  """Return the words of text that have a non-word character on both sides."""
+  return [m.group() for m in _WORD.finditer(text)
+          if m.start() > 0 and m.end() < len(text)]
+
+
+def regex_keywords(cpat):
+  """Return the words that must be whole words of any match of cpat."""
+  if cpat.flags & re.IGNORECASE:
+    return []
+  runs = []
+  _literal_runs(sre_parse.parse(cpat.pattern, cpat.flags), runs)
+  words = []
+  for run in runs:
+    words.extend(_anchored_words(run))
+  return words
+
+
+class WarnPatternMatcher(object):
+  """Classify warning lines with a keyword index over warn_patterns."""
+
+  def __init__(self, warn_patterns):
+    self.compiled_patterns = [pattern['compiled_patterns']
+                              for pattern in warn_patterns]
+    keywords = [[regex_keywords(cpat) for cpat in cpats]
+                for cpats in self.compiled_patterns]
+    frequency = {}
+    for regex_words in keywords:
+      for words in regex_words:
+        for word in set(words):
+          frequency[word] = frequency.get(word, 0) + 1
+
+    # Patterns indexed by the rarest keyword of each of their regexes.
+    self.index = {}
+    # Patterns that have a regex without any keyword.
+    self.unindexed = []
+    for idx, regex_words in enumerate(keywords):
+      for words in regex_words:
+        if not words:
+          self.unindexed.append(idx)
+          break
+        word = min(words, key=lambda w: (frequency[w], -len(w)))
+        candidates = self.index.setdefault(word, [])
+        if not candidates or candidates[-1] != idx:
+          candidates.append(idx)
+
+  def candidates(self, warning):
+    """Return the indices of patterns that might match warning, in order."""
+    index = self.index
+    candidates = set(self.unindexed)
+    for word in set(_WORD.findall(warning)):
+      if word in index:
+        candidates.update(index[word])
+    return sorted(candidates)
+
+  def match(self, warning):
+    """Return the index of the first pattern matching warning, or -1."""
+    for idx in self.candidates(warning):
+      for cpat in self.compiled_patterns[idx]:
+        if cpat.match(warning):
+          return idx
+    return -1
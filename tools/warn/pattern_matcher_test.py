@@ -0,0 +1,124 @@
+# python3
+# Copyright (C) 2022 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unittests for pattern_matcher.
+
+Run from the parent directory of the warn package:
+
+  python3 -m warn.pattern_matcher_test
+"""
+
+import re
+import unittest
+
+# pylint:disable=relative-beyond-top-level,no-name-in-module
+# suppress false positive of no-name-in-module warnings
+from . import pattern_matcher
+from . import warn_common as common
+
+WARNING_LINES = [
+    'frameworks/base/core/jni/a.cpp:1:2: warning: unused variable \'x\' '
+    '[-Wunused-variable]',
+    'art/runtime/b.cc:10:3: warning: comparison of integers of different '
+    'signs: \'int\' and \'size_t\' [-Wsign-compare]',
+    'packages/apps/C.java:5: warning: [deprecation] foo() in Bar has been '
+    'deprecated',
+    'system/core/d.cpp:7:1: warning: use nullptr [modernize-use-nullptr]',
+    'build/make/core/main.mk: warning: FOO is obsolete',
+    'external/rust/e.rs:3:4: warning: unused import: `std::io`',
+    'unknown_source_file: warning: something nobody has seen before',
+]
+
+
+def _match_in_order(warn_patterns, line):
+  """Return the index of the first warn pattern matching line, or -1."""
+  for idx, pattern in enumerate(warn_patterns):
+    for cpat in pattern['compiled_patterns']:
+      if cpat.match(line):
+        return idx
+  return -1
+
+
+def _patterns(*regexes):
+  return [{'compiled_patterns': [re.compile(r) for r in regexes_of_pattern]}
+          for regexes_of_pattern in regexes]
+
+
+class RegexKeywordsTest(unittest.TestCase):
+
+  def test_literal_words(self):
+    self.assertEqual(
+        ['warning', 'unused', 'variable'],
+        pattern_matcher.regex_keywords(
+            re.compile(r'.*: warning: unused variable .+')))
+
+  def test_no_keyword_at_ends_of_literal_text(self):
+    # 'warning' is followed by ':', but 'foo' ends the literal text.
+    self.assertEqual(
+        ['warning'],
+        pattern_matcher.regex_keywords(re.compile(r'.*: warning: foo')))
+
+  def test_ignorecase(self):
+    self.assertEqual([], pattern_matcher.regex_keywords(
+        re.compile(r'.*: warning: unused variable .+', re.IGNORECASE)))
+
+  def test_inline_ignorecase_group(self):
+    # The words of the (?i:...) group may be in any case in a match.
+    self.assertEqual(
+        ['warning'],
+        pattern_matcher.regex_keywords(
+            re.compile(r'.*: warning: (?i:Unused Variable) .+')))
+
+
+class WarnPatternMatcherTest(unittest.TestCase):
+
+  def test_first_match_in_order(self):
+    warn_patterns = _patterns(
+        [r'.*: warning: unused variable .+'],
+        [r'.*: warning: unused .+'],
+        [r'.*: warning: .+'])
+    matcher = pattern_matcher.WarnPatternMatcher(warn_patterns)
+    self.assertEqual(
+        0, matcher.match('a/b.c:1:2: warning: unused variable \'x\''))
+    self.assertEqual(1, matcher.match('a/b.c:1:2: warning: unused import'))
+    self.assertEqual(2, matcher.match('a/b.c:1:2: warning: other'))
+    self.assertEqual(-1, matcher.match('a/b.c:1:2: error: unused variable'))
+
+  def test_inline_ignorecase_group(self):
+    warn_patterns = _patterns(
+        [r'.*: warning: (?i:unused variable) .+'],
+        [r'.*: warning: .+'])
+    matcher = pattern_matcher.WarnPatternMatcher(warn_patterns)
+    line = 'a/b.c:1:2: warning: Unused Variable \'x\''
+    self.assertEqual(_match_in_order(warn_patterns, line), matcher.match(line))
+    self.assertEqual(0, matcher.match(line))
+
+  def test_ignorecase_pattern(self):
+    warn_patterns = _patterns(
+        [r'.*: warning: foo'],
+        [r'(?i).*: WARNING: UNUSED VARIABLE .+'])
+    matcher = pattern_matcher.WarnPatternMatcher(warn_patterns)
+    self.assertEqual(1, matcher.match('a/b.c:1:2: warning: unused variable x'))
+
+  def test_same_as_regexes_in_order(self):
+    warn_patterns = common.get_warn_patterns('android')
+    matcher = pattern_matcher.WarnPatternMatcher(warn_patterns)
+    for line in WARNING_LINES:
+      self.assertEqual(_match_in_order(warn_patterns, line),
+                       matcher.match(line), line)
+
+
+if __name__ == '__main__':
+  unittest.main(verbosity=2)
@@ -0,0 +1,110 @@
+# python3
+# Copyright (C) 2022 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Find the project of a warning line with a directory trie.
+
+Most project patterns are created by create_pattern of the project lists as
+'(^|.*/)<dir>/.*: warning:'. Such a pattern matches a line if <dir>/ starts
+the line or follows a '/', and ends before the last ': warning:' of the line.
+ProjectResolver puts these directories in a trie of path components and walks
+it from every component of the line, keeping the smallest pattern index, so
+the result is the same as trying the patterns in order. Directories ending with
+'.*', like 'vendor/google.*', are kept in the trie as a prefix of a component.
+Other patterns, like the final '.*', are still matched as regexes.
+"""
+
+import re
+
+_SIMPLE_PROJECT_PATTERN = re.compile(
+    r'\(\^\|\.\*/\)([^.^$*+?{}\[\]\\|()]+)(\.\*)?/\.\*: warning:$')
+_WARNING = ': warning:'
+
+
+class _TrieNode(object):
+  """A path component of the directories in a ProjectResolver."""
+
+  __slots__ = ('children', 'index', 'prefixes')
+
+  def __init__(self):
+    self.children = {}
+    # Index of the first project pattern of the directory ending here.
+    self.index = None
+    # (prefix, index) of the patterns matching a child component by prefix.
+    self.prefixes = []
+
+
+class ProjectResolver(object):
+  """Find the first matching project pattern with a path component trie."""
+
+  def __init__(self, project_patterns):
+    self.project_patterns = project_patterns
+    self.trie = _TrieNode()
+    # (index, compiled regex) of the patterns not in the trie, in order.
+    self.fallback = []
+    for idx, cpat in enumerate(project_patterns):
+      simple = _SIMPLE_PROJECT_PATTERN.match(cpat.pattern)
+      if simple is None or cpat.flags & (re.IGNORECASE | re.VERBOSE):
+        self.fallback.append((idx, cpat))
+        continue
+      components = simple.group(1).split('/')
+      if simple.group(2):
+        prefix = components.pop()
+      node = self.trie
+      for component in components:
+        node = node.children.setdefault(component, _TrieNode())
+      if simple.group(2):
+        node.prefixes.append((prefix, idx))
+      elif node.index is None:
+        node.index = idx
+
+  def _find_in_trie(self, line):
+    end = line.rfind(_WARNING)
+    if end < 0:
+      return -1
+    # Only components followed by a '/' before ': warning:' can be matched.
+    components = line[:end].split('/')
+    components.pop()
+    best = -1
+    trie = self.trie
+    num_components = len(components)
+    for start in range(num_components):
+      node = trie
+      for i in range(start, num_components):
+        component = components[i]
+        for prefix, idx in node.prefixes:
+          if (best < 0 or idx < best) and component.startswith(prefix):
+            best = idx
+        node = node.children.get(component)
+        if node is None:
+          break
+        if node.index is not None and (best < 0 or node.index < best):
+          best = node.index
+    return best
+
+  def find_project_index(self, line):
+    """Return the index of the first project pattern matching line, or -1."""
+    if '\n' in line:
+      # '.' of the regexes does not match a newline; keep their semantics.
+      for idx, cpat in enumerate(self.project_patterns):
+        if cpat.match(line):
+          return idx
+      return -1
+    best = self._find_in_trie(line)
+    for idx, cpat in self.fallback:
+      if 0 <= best < idx:
+        break
+      if cpat.match(line):
+        return idx
+    return best
@@ -0,0 +1,126 @@
+# python3
+# Copyright (C) 2022 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unittests for project_resolver.
+
+Run from the parent directory of the warn package:
+
+  python3 -m warn.project_resolver_test
+"""
+
+import re
+import unittest
+
+# pylint:disable=relative-beyond-top-level,no-name-in-module
+# suppress false positive of no-name-in-module warnings
+from . import android_project_list
+from . import project_resolver
+
+WARNING_LINES = [
+    'frameworks/av/media/libstagefright/a.cpp:1:2: warning: foo',
+    'frameworks/av/media/libfoo/a.cpp:1:2: warning: foo',
+    'out/soong/.intermediates/frameworks/base/b.cpp:1:2: warning: foo',
+    'vendor/google/c.cpp:1:2: warning: foo',
+    'vendor/google_devices/d.cpp:1:2: warning: foo',
+    'vendor/other/e.cpp:1:2: warning: foo',
+    'external/googletest/f.cc:1:2: warning: foo',
+    'external/zlib/g.c:1:2: warning: foo',
+    'art/runtime/h.cc:1:2: warning: vendor/google/x.cpp: warning: bar',
+    'unknown_source_file: warning: foo',
+    'art: warning: foo',
+]
+
+
+def _find_in_order(project_patterns, line):
+  """Return the index of the first project pattern matching line, or -1."""
+  for idx, cpat in enumerate(project_patterns):
+    if cpat.match(line):
+      return idx
+  return -1
+
+
+def _compile(project_list):
+  return [re.compile(p[1]) for p in project_list]
+
+
+class ProjectResolverTest(unittest.TestCase):
+
+  def test_same_as_regexes_in_order(self):
+    project_patterns = _compile(android_project_list.project_list)
+    resolver = project_resolver.ProjectResolver(project_patterns)
+    for line in WARNING_LINES:
+      self.assertEqual(_find_in_order(project_patterns, line),
+                       resolver.find_project_index(line), line)
+
+  def test_prefix_component(self):
+    project_list = [
+        android_project_list.create_pattern('vendor/google',
+                                            'vendor/google.*'),
+        android_project_list.create_pattern('vendor/non-google', 'vendor'),
+    ]
+    resolver = project_resolver.ProjectResolver(_compile(project_list))
+    # Only the prefix is kept in the trie, not a regex.
+    self.assertEqual([], resolver.fallback)
+    self.assertEqual(0, resolver.find_project_index(
+        'vendor/google_devices/a.cpp:1:2: warning: foo'))
+    self.assertEqual(0, resolver.find_project_index(
+        'out/vendor/google/a.cpp:1:2: warning: foo'))
+    self.assertEqual(1, resolver.find_project_index(
+        'vendor/googl/a.cpp:1:2: warning: foo'))
+    # The prefix must match a directory, not the file name.
+    self.assertEqual(1, resolver.find_project_index(
+        'vendor/google.cpp:1:2: warning: foo'))
+
+  def test_earlier_pattern_wins(self):
+    project_list = [
+        android_project_list.create_pattern('frameworks/av/media/libmedia'),
+        android_project_list.create_pattern('frameworks/av/media/Other',
+                                            'frameworks/av/media'),
+        android_project_list.create_pattern('frameworks'),
+    ]
+    resolver = project_resolver.ProjectResolver(_compile(project_list))
+    self.assertEqual(0, resolver.find_project_index(
+        'frameworks/av/media/libmedia/a.cpp:1:2: warning: foo'))
+    self.assertEqual(1, resolver.find_project_index(
+        'frameworks/av/media/libmediafoo/a.cpp:1:2: warning: foo'))
+    self.assertEqual(2, resolver.find_project_index(
+        'frameworks/base/a.cpp:1:2: warning: foo'))
+
+  def test_fallback_regex(self):
+    project_patterns = [
+        re.compile('(^|.*/)art/.*: warning:'),
+        re.compile('.*/[0-9]+/.*: warning:'),
+        re.compile('(^|.*/)bionic/.*: warning:'),
+        re.compile('.*'),
+    ]
+    resolver = project_resolver.ProjectResolver(project_patterns)
+    self.assertEqual([1, 3], [idx for idx, _ in resolver.fallback])
+    self.assertEqual(1, resolver.find_project_index(
+        'out/123/bionic/a.c:1:2: warning: foo'))
+    self.assertEqual(2, resolver.find_project_index(
+        'bionic/a.c:1:2: warning: foo'))
+    self.assertEqual(3, resolver.find_project_index(
+        'unknown_source_file: warning: foo'))
+
+  def test_multiline(self):
+    project_patterns = _compile(android_project_list.project_list)
+    resolver = project_resolver.ProjectResolver(project_patterns)
+    line = 'art/a.cc:1:2: warning: foo\nbionic/b.c:1:2: warning: bar'
+    self.assertEqual(_find_in_order(project_patterns, line),
+                     resolver.find_project_index(line))
+
+
+if __name__ == '__main__':
+  unittest.main(verbosity=2)
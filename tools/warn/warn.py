@@ -22,6 +22,8 @@ import sys
 
 # pylint:disable=relative-beyond-top-level,no-name-in-module
 # suppress false positive of no-name-in-module warnings
+from . import pattern_matcher
+from . import project_resolver
 from . import warn_common as common
 
 
@@ -33,6 +35,8 @@ def classify_warnings(args):
         'group': list of (warning, link),
         'project_patterns': re.compile(project_list[p][1]),
         'warn_patterns': list of warn_pattern,
+        'warn_matcher': optional WarnPatternMatcher of warn_patterns,
+        'resolver': optional ProjectResolver of project_patterns,
         'num_processes': number of processes being used for multiprocessing }
   Returns:
     results: a list of the classified warnings.
@@ -40,7 +44,8 @@ def classify_warnings(args):
   results = []
   for line, link in args['group']:
     common.classify_one_warning(line, link, results, args['project_patterns'],
-                                args['warn_patterns'])
+                                args['warn_patterns'],
+                                args.get('warn_matcher'), args.get('resolver'))
 
   # After the main work, ignore all other signals to a child process,
   # to avoid bad warning/error messages from the exit clean-up process.
@@ -49,14 +54,62 @@ def classify_warnings(args):
   return results
 
 
+# Classification state of a worker process, set up once by _init_worker.
+_worker_state = {}
+
+
+def _init_worker(classify_warnings_fn, project_patterns, warn_patterns):
+  """Save the patterns in a new worker process for all of its chunks."""
+  _worker_state['classify_warnings_fn'] = classify_warnings_fn
+  _worker_state['project_patterns'] = project_patterns
+  _worker_state['warn_patterns'] = warn_patterns
+  _worker_state['warn_matcher'] = pattern_matcher.WarnPatternMatcher(
+      warn_patterns)
+  _worker_state['resolver'] = project_resolver.ProjectResolver(
+      project_patterns)
+
+
+def _classify_chunk(indexed_args):
+  """Classify one chunk of warnings with the patterns of this worker."""
+  index, args = indexed_args
+  args = dict(args, project_patterns=_worker_state['project_patterns'],
+              warn_patterns=_worker_state['warn_patterns'],
+              warn_matcher=_worker_state['warn_matcher'],
+              resolver=_worker_state['resolver'])
+  return index, _worker_state['classify_warnings_fn'](args)
+
+
 def create_and_launch_subprocesses(num_cpu, classify_warnings_fn, arg_groups,
                                    group_results):
-  """Fork num_cpu processes to classify warnings."""
-  pool = multiprocessing.Pool(num_cpu)
-  for cpu in range(num_cpu):
-    proc_result = pool.map(classify_warnings_fn, arg_groups[cpu])
-    if proc_result is not None:
-      group_results.append(proc_result)
+  """Fork num_cpu processes to classify warnings.
+
+  The patterns are sent to each worker only once, through the pool initializer,
+  which also builds the pattern matcher and project resolver of the worker. The
+  warning chunks in arg_groups are streamed to the workers as they become idle.
+  Results arrive in completion order and are put back in the order of
+  arg_groups, so the output does not depend on scheduling.
+  """
+  tasks = [args for cpu_args in arg_groups for args in cpu_args]
+  if not tasks:
+    return group_results
+  # Only compiled_patterns is used for classification; leave out the
+  # descriptions and the members/projects fields of warn_patterns.
+  warn_patterns = [{'compiled_patterns': pattern['compiled_patterns']}
+                   for pattern in tasks[0]['warn_patterns']]
+  init_args = (classify_warnings_fn, tasks[0]['project_patterns'],
+               warn_patterns)
+  chunks = [{key: value for key, value in args.items()
+             if key not in ('project_patterns', 'warn_patterns',
+                           'warn_matcher', 'resolver')}
+            for args in tasks]
+  results = [None] * len(chunks)
+  with multiprocessing.Pool(num_cpu, _init_worker, init_args) as pool:
+    for index, result in pool.imap_unordered(_classify_chunk,
+                                             enumerate(chunks)):
+      results[index] = result
+    pool.close()
+    pool.join()
+  group_results.append(results)
   return group_results
 
 
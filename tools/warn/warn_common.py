@@ -47,6 +47,8 @@ Default input file is build.log, which can be changed with the --log flag.
 #
 import argparse
 import io
+import itertools
+import mmap
 import multiprocessing
 import os
 import re
@@ -56,12 +58,27 @@ import sys
 # suppress false positive of no-name-in-module warnings
 from . import android_project_list
 from . import chrome_project_list
+from . import classification_cache
 from . import cpp_warn_patterns as cpp_patterns
 from . import html_writer
 from . import java_warn_patterns as java_patterns
+from . import jsonl_writer
 from . import make_warn_patterns as make_patterns
 from . import other_warn_patterns as other_patterns
+from . import pattern_matcher
+from . import project_resolver
 from . import tidy_warn_patterns as tidy_patterns
+from . import warning_delta
+
+# Number of warning chunks classified by each process of
+# parallel_classify_warnings. More chunks balance the load better.
+CHUNKS_PER_PROCESS = 8
+
+# Android logs of at least this size are parsed by multiple processes.
+PARALLEL_PARSE_MIN_SIZE = 64 << 20
+
+# Number of log lines read at a time by iter_android_warnings.
+STREAM_BATCH_LINES = 10000
 
 
 def parse_args(use_google3):
@@ -80,6 +97,16 @@ def parse_args(use_google3):
   parser.add_argument('--csvwithdescription', default='',
                       help="""Save CSV warning file to the passed path this csv
                             will contain all the warning descriptions""")
+  parser.add_argument('--htmlpath', default='',
+                      help='Save HTML warning report to the passed path '
+                      'instead of stdout, gzip-compressed if it ends '
+                      'with .gz')
+  parser.add_argument('--compact_html', action='store_true',
+                      help='Emit HTML report data as a compact JSON payload')
+  parser.add_argument('--jsonlpath', default='',
+                      help='Stream classified warnings as JSON Lines to the '
+                      'passed path, or to stdout if it is -, instead of '
+                      'writing HTML or CSV output')
   parser.add_argument('--byproject', action='store_true',
                       help='Separate warnings in HTML output by project names')
   parser.add_argument('--url', default='',
@@ -88,6 +115,12 @@ def parse_args(use_google3):
   parser.add_argument('--separator', default='?l=',
                       help='Separator between the end of a URL and the line '
                       'number argument. e.g. #')
+  parser.add_argument('--cache_path', default='',
+                      help='Path of an SQLite cache of warning '
+                      'classifications, reused by later runs')
+  parser.add_argument('--cache_max_age_days', default=30, type=int,
+                      help='Remove cache entries not used for this number '
+                      'of days')
   parser.add_argument('--processes', default=multiprocessing.cpu_count(),
                       type=int,
                       help='Number of parallel processes to process warnings')
@@ -96,6 +129,15 @@ def parse_args(use_google3):
   parser.add_argument('--platform', default='android',
                       choices=['chrome', 'android'],
                       help='Platform of the build log')
+  parser.add_argument('--baseline_log', default='',
+                      help='Output only the warnings added or removed since '
+                      'this build log')
+  parser.add_argument('--baseline_results', default='',
+                      help='Output only the warnings added or removed since '
+                      'the results saved by --save_results')
+  parser.add_argument('--save_results', default='',
+                      help='Save the classified warnings to the passed path, '
+                      'to be used as --baseline_results')
   # Old Android build scripts call warn.py with only a build.log file path.
   parser.add_argument('--log', help='Path to build log file')
   parser.add_argument(dest='buildlog', metavar='build.log',
@@ -106,6 +148,12 @@ def parse_args(use_google3):
     flags.log = flags.buildlog
   if not use_google3 and not os.path.exists(flags.log):
     sys.exit('Cannot find log file: ' + flags.log)
+  if flags.baseline_log and not os.path.exists(flags.baseline_log):
+    sys.exit('Cannot find baseline log file: ' + flags.baseline_log)
+  if flags.jsonlpath and (flags.baseline_log or flags.baseline_results or
+                          flags.save_results):
+    sys.exit('--jsonlpath cannot be used with --baseline_log, '
+             '--baseline_results or --save_results')
   return flags
 
 
@@ -114,8 +162,13 @@ def get_project_names(project_list):
   return [p[0] for p in project_list]
 
 
-def find_project_index(line, project_patterns):
-  """Return the index to the project pattern array."""
+def find_project_index(line, project_patterns, resolver=None):
+  """Return the index to the project pattern array.
+
+  resolver is an optional project_resolver.ProjectResolver of project_patterns.
+  """
+  if resolver is not None:
+    return resolver.find_project_index(line)
   for idx, pattern in enumerate(project_patterns):
     if pattern.match(line):
       return idx
@@ -123,12 +176,23 @@ def find_project_index(line, project_patterns):
 
 
 def classify_one_warning(warning, link, results, project_patterns,
-                         warn_patterns):
-  """Classify one warning line."""
+                         warn_patterns, warn_matcher=None, resolver=None):
+  """Classify one warning line.
+
+  If warn_matcher, a pattern_matcher.WarnPatternMatcher of warn_patterns, is
+  given, only the patterns that might match are tried. resolver is passed to
+  find_project_index.
+  """
+  if warn_matcher is not None:
+    idx = warn_matcher.match(warning)
+    if idx >= 0:
+      project_idx = find_project_index(warning, project_patterns, resolver)
+      results.append([warning, link, idx, project_idx])
+    return
   for idx, pattern in enumerate(warn_patterns):
     for cpat in pattern['compiled_patterns']:
       if cpat.match(warning):
-        project_idx = find_project_index(warning, project_patterns)
+        project_idx = find_project_index(warning, project_patterns, resolver)
         results.append([warning, link, idx, project_idx])
         return
   # If we end up here, there was a problem parsing the log
@@ -297,24 +361,24 @@ def normalize_warning_line(line, flags, android_root=None):
                         android_root) + line[first_column:]
 
 
+# only handle warning lines of format 'file_path:line_no:col_no: warning: ...'
+# Bug: http://198657613, This might need change to handle RBE output.
+CHROME_WARNING_PATTERN = re.compile(
+    r'^[^ ]*/[^ ]*:[0-9]+:[0-9]+: warning: .*')
+
+
 def parse_input_file_chrome(infile, flags):
   """Parse Chrome input file, collect parameters and warning lines."""
   platform_version = 'unknown'
   board_name = 'unknown'
   architecture = 'unknown'
 
-  # only handle warning lines of format 'file_path:line_no:col_no: warning: ...'
-  # Bug: http://198657613, This might need change to handle RBE output.
-  chrome_warning_pattern = r'^[^ ]*/[^ ]*:[0-9]+:[0-9]+: warning: .*'
-
-  warning_pattern = re.compile(chrome_warning_pattern)
-
   # Collect all unique warning lines
   # Remove the duplicated warnings save ~8% of time when parsing
   # one typical build log than before
   unique_warnings = dict()
   for line in infile:
-    if warning_pattern.match(line):
+    if CHROME_WARNING_PATTERN.match(line):
       normalized_line = normalize_warning_line(line, flags)
       if normalized_line not in unique_warnings:
         unique_warnings[normalized_line] = generate_cs_link(line, flags)
@@ -346,38 +410,87 @@ def add_normalized_line_to_warnings(line, flags, android_root, unique_warnings):
   return unique_warnings
 
 
+# rustc warning messages have two lines that should be combined:
+#     warning: description
+#        --> file_path:line_number:column_number
+# Some warning messages have no file name:
+#     warning: macro replacement list ... [bugprone-macro-parentheses]
+# Some makefile warning messages have no line number:
+#     some/path/file.mk: warning: description
+# C/C++ compiler warning messages have line and column numbers:
+#     some/path/file.c:line_number:column_number: warning: description
+ANDROID_WARNING_PATTERN = re.compile(
+    '(^[^ ]*/[^ ]*: warning: .*)|(^warning: .*)')
+WARNING_WITHOUT_FILE = re.compile('^warning: .*')
+RUSTC_FILE_POSITION = re.compile('^[ ]+--> [^ ]*/[^ ]*:[0-9]+:[0-9]+')
+
+# If RBE was used, try to reclaim some warning lines mixed with some
+# leading chars from other concurrent job's stderr output .
+# The leading characters can be any character, including digits and spaces.
+# It's impossible to correctly identify the starting point of the source
+# file path without the file directory name knowledge.
+# Here we can only be sure to recover lines containing "/b/f/w/".
+RBE_WARNING_PATTERN = re.compile('.*/b/f/w/[^ ]*: warning: .*')
+
+# Only the first header lines of an Android log are parsed.
+ANDROID_HEADER_LINES = 100
+
+# Warning lines used by find_android_root, and their maximum number.
+ANDROID_ROOT_CANDIDATE = re.compile('^/[^ ]*/[^ ]*: warning: .*')
+ANDROID_ROOT_LINES = 10000
+
+
+def parse_android_header_line(line, header):
+  """Save a PLATFORM_VERSION=... like header line in the header dictionary."""
+  result = re.search('(?<=^PLATFORM_VERSION=).*', line)
+  if result is not None:
+    header['platform_version'] = result.group(0)
+    return
+  result = re.search('(?<=^TARGET_PRODUCT=).*', line)
+  if result is not None:
+    header['target_product'] = result.group(0)
+    return
+  result = re.search('(?<=^TARGET_BUILD_VARIANT=).*', line)
+  if result is not None:
+    header['target_variant'] = result.group(0)
+    return
+  result = re.search('(?<=^BUILD_ID=).*', line)
+  if result is not None:
+    header['build_id'] = result.group(0)
+    return
+  result = re.search('(?<=^TOP=).*', line)
+  if result is not None:
+    header['android_root'] = result.group(0)
+    return
+  if re.search('USE_RBE=', line) is not None:
+    header['use_rbe'] = True
+
+
+def android_header_str(header):
+  """Return the report header of a header dictionary."""
+  return '%s - %s - %s (%s)' % (
+      header['platform_version'], header['target_product'],
+      header['target_variant'], header['build_id'])
+
+
+def new_android_header():
+  """Return the header dictionary of a log without header lines."""
+  return {
+      'platform_version': 'unknown',
+      'target_product': 'unknown',
+      'target_variant': 'unknown',
+      'build_id': 'unknown',
+      'android_root': None,
+      'use_rbe': False,
+  }
+
+
 def parse_input_file_android(infile, flags):
   """Parse Android input file, collect parameters and warning lines."""
-  # pylint:disable=too-many-locals,too-many-branches
-  platform_version = 'unknown'
-  target_product = 'unknown'
-  target_variant = 'unknown'
-  build_id = 'unknown'
-  use_rbe = False
+  header = new_android_header()
   android_root = find_android_root(infile)
   infile.seek(0)
 
-  # rustc warning messages have two lines that should be combined:
-  #     warning: description
-  #        --> file_path:line_number:column_number
-  # Some warning messages have no file name:
-  #     warning: macro replacement list ... [bugprone-macro-parentheses]
-  # Some makefile warning messages have no line number:
-  #     some/path/file.mk: warning: description
-  # C/C++ compiler warning messages have line and column numbers:
-  #     some/path/file.c:line_number:column_number: warning: description
-  warning_pattern = re.compile('(^[^ ]*/[^ ]*: warning: .*)|(^warning: .*)')
-  warning_without_file = re.compile('^warning: .*')
-  rustc_file_position = re.compile('^[ ]+--> [^ ]*/[^ ]*:[0-9]+:[0-9]+')
-
-  # If RBE was used, try to reclaim some warning lines mixed with some
-  # leading chars from other concurrent job's stderr output .
-  # The leading characters can be any character, including digits and spaces.
-  # It's impossible to correctly identify the starting point of the source
-  # file path without the file directory name knowledge.
-  # Here we can only be sure to recover lines containing "/b/f/w/".
-  rbe_warning_pattern = re.compile('.*/b/f/w/[^ ]*: warning: .*')
-
    # Collect all unique warning lines
   # Remove the duplicated warnings save ~8% of time when parsing
   # one typical build log than before
@@ -386,7 +499,7 @@ def parse_input_file_android(infile, flags):
   prev_warning = ''
   for line in infile:
     if prev_warning:
-      if rustc_file_position.match(line):
+      if RUSTC_FILE_POSITION.match(line):
         # must be a rustc warning, combine 2 lines into one warning
         line = line.strip().replace('--> ', '') + ': ' + prev_warning
         unique_warnings = add_normalized_line_to_warnings(
@@ -399,14 +512,14 @@ def parse_input_file_android(infile, flags):
           prev_warning, flags, android_root, unique_warnings)
       prev_warning = ''
 
-    if use_rbe and rbe_warning_pattern.match(line):
+    if header['use_rbe'] and RBE_WARNING_PATTERN.match(line):
       cleaned_up_line = re.sub('.*/b/f/w/', '', line)
       unique_warnings = add_normalized_line_to_warnings(
           cleaned_up_line, flags, android_root, unique_warnings)
       continue
 
-    if warning_pattern.match(line):
-      if warning_without_file.match(line):
+    if ANDROID_WARNING_PATTERN.match(line):
+      if WARNING_WITHOUT_FILE.match(line):
         # save this line and combine it with the next line
         prev_warning = line
       else:
@@ -414,32 +527,12 @@ def parse_input_file_android(infile, flags):
             line, flags, android_root, unique_warnings)
       continue
 
-    if line_counter < 100:
+    if line_counter < ANDROID_HEADER_LINES:
       # save a little bit of time by only doing this for the first few lines
       line_counter += 1
-      result = re.search('(?<=^PLATFORM_VERSION=).*', line)
-      if result is not None:
-        platform_version = result.group(0)
-        continue
-      result = re.search('(?<=^TARGET_PRODUCT=).*', line)
-      if result is not None:
-        target_product = result.group(0)
-        continue
-      result = re.search('(?<=^TARGET_BUILD_VARIANT=).*', line)
-      if result is not None:
-        target_variant = result.group(0)
-        continue
-      result = re.search('(?<=^BUILD_ID=).*', line)
-      if result is not None:
-        build_id = result.group(0)
-        continue
-      result = re.search('(?<=^TOP=).*', line)
-      if result is not None:
-        android_root = result.group(1)
-        continue
-      if re.search('USE_RBE=', line) is not None:
-        use_rbe = True
-        continue
+      parse_android_header_line(line, header)
+      if header['android_root'] is not None:
+        android_root = header['android_root']
 
   if android_root:
     new_unique_warnings = dict()
@@ -450,9 +543,193 @@ def parse_input_file_android(infile, flags):
           warning_line, flags, android_root)
     unique_warnings = new_unique_warnings
 
-  header_str = '%s - %s - %s (%s)' % (
-      platform_version, target_product, target_variant, build_id)
-  return unique_warnings, header_str
+  return unique_warnings, android_header_str(header)
+
+
+def split_log_lines(data):
+  """Split bytes of a log into lines like a text mode file iterator."""
+  text = data.decode('utf-8').replace('\r\n', '\n').replace('\r', '\n')
+  lines = text.split('\n')
+  last_line = lines.pop()
+  lines = [line + '\n' for line in lines]
+  if last_line:
+    lines.append(last_line)
+  return lines
+
+
+def is_android_root_candidate(line):
+  """Return True if find_android_root uses line."""
+  return (line.startswith('/') and ANDROID_ROOT_CANDIDATE.match(line) and
+          '/b/f/w' not in line and not line.startswith('/tmp/'))
+
+
+def collect_android_warnings(lines, flags, state):
+  """Collect the warning lines of an Android log, for parallel parsing.
+
+  This does the work of the parse_input_file_android loop for a part of a log,
+  but without android_root, which is not known until all parts are parsed.
+
+  Args:
+    lines: lines of the log part.
+    flags: the parsed flags.
+    state: parsing state of the log part, a dictionary {
+        'header': new_android_header() updated with the header lines,
+        'line_counter': number of header lines parsed,
+        'prev_warning': a warning line waiting for a rustc file position,
+        'first_line': first line of the log part,
+        'warnings': {normalized line without android_root: raw line},
+        'seen': set of raw warning lines,
+        'root_lines': first lines for find_android_root }
+  """
+  header = state['header']
+  warnings = state['warnings']
+  seen = state['seen']
+  root_lines = state['root_lines']
+
+  def add(line):
+    if line not in seen:
+      seen.add(line)
+      normalized_line = normalize_warning_line(line, flags)
+      if normalized_line not in warnings:
+        warnings[normalized_line] = line
+
+  if lines and state['first_line'] is None:
+    state['first_line'] = lines[0]
+  for line in lines:
+    if len(root_lines) < ANDROID_ROOT_LINES and is_android_root_candidate(line):
+      root_lines.append(line)
+    if state['prev_warning']:
+      prev_warning = state['prev_warning']
+      state['prev_warning'] = ''
+      if RUSTC_FILE_POSITION.match(line):
+        add(line.strip().replace('--> ', '') + ': ' + prev_warning)
+        continue
+      add('unknown_source_file: ' + prev_warning)
+
+    if header['use_rbe'] and RBE_WARNING_PATTERN.match(line):
+      add(re.sub('.*/b/f/w/', '', line))
+      continue
+
+    if ANDROID_WARNING_PATTERN.match(line):
+      if WARNING_WITHOUT_FILE.match(line):
+        state['prev_warning'] = line
+      else:
+        add(line)
+      continue
+
+    if state['line_counter'] < ANDROID_HEADER_LINES:
+      state['line_counter'] += 1
+      parse_android_header_line(line, header)
+
+
+def new_android_parse_state(header, line_counter):
+  """Return the initial state of collect_android_warnings."""
+  return {
+      'header': header,
+      'line_counter': line_counter,
+      'prev_warning': '',
+      'first_line': None,
+      'warnings': {},
+      'seen': set(),
+      'root_lines': [],
+  }
+
+
+def parse_android_log_chunk(args):
+  """Collect the warnings in bytes [start, end) of a log file.
+
+  Args:
+    args: tuple (log file path, start, end, flags, header).
+  Returns:
+    the state of collect_android_warnings, without the 'seen' set.
+  """
+  path, start, end, flags, header = args
+  state = new_android_parse_state(header, ANDROID_HEADER_LINES)
+  with open(path, 'rb') as log:
+    with mmap.mmap(log.fileno(), 0, access=mmap.ACCESS_READ) as data:
+      collect_android_warnings(split_log_lines(data[start:end]), flags, state)
+  del state['seen']
+  return state
+
+
+def split_log_chunks(data, start, num_chunks):
+  """Split data[start:] into num_chunks (start, end) at line boundaries."""
+  size = len(data)
+  bounds = [start]
+  for i in range(1, num_chunks):
+    pos = max(bounds[-1], start + (size - start) * i // num_chunks)
+    pos = data.find(b'\n', pos) + 1 or size
+    if pos < size:
+      bounds.append(pos)
+  bounds.append(size)
+  return [(bounds[i], bounds[i + 1]) for i in range(len(bounds) - 1)
+          if bounds[i] < bounds[i + 1]]
+
+
+def remove_android_root_from_line(line, android_root):
+  """Remove android_root from the path of a line from normalize_warning_line."""
+  first_column = line.find(':')
+  return (remove_android_root_prefix(line[:first_column], android_root) +
+          line[first_column:])
+
+
+def parse_input_file_android_parallel(path, flags, num_processes):
+  """Parse an Android log file with num_processes processes.
+
+  The header lines at the start of the log are parsed first. The rest of the
+  log is mapped in memory and split at line boundaries into chunks, which are
+  parsed in parallel by parse_android_log_chunk. A rustc warning split across
+  two chunks is combined when the chunks are merged. The chunk results are
+  then merged in order, so the warnings and links are the same as those of
+  parse_input_file_android.
+  """
+  header = new_android_header()
+  head = new_android_parse_state(header, 0)
+  with open(path, 'rb') as log:
+    if not os.fstat(log.fileno()).st_size:
+      return {}, android_header_str(header)
+    with mmap.mmap(log.fileno(), 0, access=mmap.ACCESS_READ) as data:
+      while head['line_counter'] < ANDROID_HEADER_LINES:
+        line = data.readline()
+        if not line:
+          break
+        collect_android_warnings(split_log_lines(line), flags, head)
+      chunks = split_log_chunks(data, data.tell(),
+                                num_processes * CHUNKS_PER_PROCESS)
+
+  tasks = [(path, start, end, flags, header) for start, end in chunks]
+  with multiprocessing.Pool(num_processes) as pool:
+    chunk_states = pool.map(parse_android_log_chunk, tasks)
+    pool.close()
+    pool.join()
+
+  warnings = head['warnings']
+  root_lines = head['root_lines']
+  prev_warning = head['prev_warning']
+  for state in chunk_states:
+    if prev_warning:
+      first_line = state['first_line']
+      if RUSTC_FILE_POSITION.match(first_line):
+        line = first_line.strip().replace('--> ', '') + ': ' + prev_warning
+      else:
+        line = 'unknown_source_file: ' + prev_warning
+      warnings.setdefault(normalize_warning_line(line, flags), line)
+    for normalized_line, line in state['warnings'].items():
+      warnings.setdefault(normalized_line, line)
+    root_lines.extend(state['root_lines'][:ANDROID_ROOT_LINES -
+                                          len(root_lines)])
+    prev_warning = state['prev_warning']
+
+  android_root = header['android_root'] or find_android_root(root_lines)
+  unique_warnings = dict()
+  for normalized_line, line in warnings.items():
+    if android_root:
+      normalized_line = remove_android_root_from_line(normalized_line,
+                                                      android_root)
+    if normalized_line not in unique_warnings:
+      unique_warnings[normalized_line] = generate_cs_link(line, flags,
+                                                          android_root)
+  return unique_warnings, android_header_str(header)
 
 
 def parse_input_file(infile, flags):
@@ -465,6 +742,95 @@ def parse_input_file(infile, flags):
                      flags.platform)
 
 
+def iter_chrome_warnings(infile, flags):
+  """Yield each unique (warning line, link) of a Chrome log as it is read."""
+  seen = set()
+  for line in infile:
+    if CHROME_WARNING_PATTERN.match(line):
+      normalized_line = normalize_warning_line(line, flags)
+      key = classification_cache.line_hash(normalized_line)
+      if key not in seen:
+        seen.add(key)
+        yield normalized_line, generate_cs_link(line, flags)
+
+
+def read_android_header(infile, flags):
+  """Return the header of an Android log, read in batches from infile.
+
+  Reading stops once ANDROID_HEADER_LINES header lines are parsed, which is
+  at the end of the log if it has fewer lines other than warnings.
+  """
+  header = new_android_header()
+  state = new_android_parse_state(header, 0)
+  while state['line_counter'] < ANDROID_HEADER_LINES:
+    lines = list(itertools.islice(infile, STREAM_BATCH_LINES))
+    if not lines:
+      break
+    collect_android_warnings(lines, flags, state)
+    state['warnings'] = {}
+    state['seen'] = set()
+  return header
+
+
+def iter_android_warnings(infile, flags):
+  """Yield each unique (warning line, link) of an Android log as it is read.
+
+  The log is read in batches of STREAM_BATCH_LINES lines, which are collected
+  by collect_android_warnings like the chunks of
+  parse_input_file_android_parallel. The header is read first, so that a TOP=
+  line applies to all the warnings, as in parse_input_file_android. Only the
+  hashes of the yielded lines are kept.
+  """
+  root = read_android_header(infile, flags)['android_root']
+  infile.seek(0)
+  if root is None:
+    root = find_android_root(infile)
+    infile.seek(0)
+  state = new_android_parse_state(new_android_header(), 0)
+  seen = set()
+  while True:
+    lines = list(itertools.islice(infile, STREAM_BATCH_LINES))
+    collect_android_warnings(lines, flags, state)
+    for normalized_line, line in state['warnings'].items():
+      if root:
+        normalized_line = remove_android_root_from_line(normalized_line, root)
+      key = classification_cache.line_hash(normalized_line)
+      if key not in seen:
+        seen.add(key)
+        yield normalized_line, generate_cs_link(line, flags, root)
+    if not lines:
+      return
+    state['warnings'] = {}
+    state['seen'] = set()
+
+
+def iter_warnings(infile, flags):
+  """Yield the unique warnings of a chrome or android log as it is read."""
+  if flags.platform == 'chrome':
+    return iter_chrome_warnings(infile, flags)
+  if flags.platform == 'android':
+    return iter_android_warnings(infile, flags)
+  raise RuntimeError('iter_warnings not defined for platform %s' %
+                     flags.platform)
+
+
+def stream_classified_warnings(infile, flags, project_patterns, warn_patterns):
+  """Yield [line, link, pattern index, project index] of each warning.
+
+  Unlike parallel_classify_warnings, a warning is yielded as soon as it is
+  classified. Nothing but a 16-byte hash of each yielded line is kept, so
+  memory grows with the number of unique warnings, not with the size of the
+  log.
+  """
+  warn_matcher = pattern_matcher.WarnPatternMatcher(warn_patterns)
+  resolver = project_resolver.ProjectResolver(project_patterns)
+  for warning, link in iter_warnings(infile, flags):
+    results = []
+    classify_one_warning(warning, link, results, project_patterns,
+                         warn_patterns, warn_matcher, resolver)
+    yield from results
+
+
 def parse_compiler_output(compiler_output):
   """Parse compiler output for relevant info."""
   split_output = compiler_output.split(':', 3)  # 3 = max splits
@@ -503,30 +869,80 @@ def get_project_list(platform):
   raise Exception('platform name %s is not valid' % platform)
 
 
+def merge_cached_results(cache, warning_data, new_warning_data, cached,
+                         group_results):
+  """Save new results in the cache and return the results of all warnings.
+
+  Args:
+    cache: a ClassificationCache.
+    warning_data: {warning line: link} of all warnings.
+    new_warning_data: the part of warning_data that was classified.
+    cached: {warning line: (pattern index, project index)} from the cache.
+    group_results: classification results of new_warning_data.
+  Returns:
+    the classification results of warning_data, in the same order.
+  """
+  classified = {}
+  for group_result in group_results:
+    for result in group_result:
+      for line, _, pattern_idx, project_idx in result:
+        classified[line] = (pattern_idx, project_idx)
+  cache.update(new_warning_data, classified)
+  classified.update(cached)
+  results = []
+  for line, link in warning_data.items():
+    pattern_idx, project_idx = classified.get(
+        line, (classification_cache.UNCLASSIFIED, -1))
+    if pattern_idx != classification_cache.UNCLASSIFIED:
+      results.append([line, link, pattern_idx, project_idx])
+  return results
+
+
 def parallel_classify_warnings(warning_data, args, project_names,
                                project_patterns, warn_patterns,
                                use_google3, create_launch_subprocs_fn,
                                classify_warnings_fn):
-  """Classify all warning lines with num_cpu parallel processes."""
+  """Classify all warning lines with num_cpu parallel processes.
+
+  With --cache_path, only the warnings missing from the cache are classified.
+  """
   # pylint:disable=too-many-arguments,too-many-locals
   num_cpu = args.processes
   group_results = []
+  cache = None
+  if getattr(args, 'cache_path', ''):
+    cache = classification_cache.ClassificationCache(
+        args.cache_path,
+        classification_cache.pattern_set_version(warn_patterns,
+                                                 project_patterns),
+        args.cache_max_age_days)
+    all_warning_data = warning_data
+    cached = cache.lookup(warning_data)
+    warning_data = {line: link for line, link in warning_data.items()
+                    if line not in cached}
+  warn_matcher = pattern_matcher.WarnPatternMatcher(warn_patterns)
+  resolver = project_resolver.ProjectResolver(project_patterns)
 
   if num_cpu > 1:
-    # set up parallel processing for this...
-    warning_groups = [[] for _ in range(num_cpu)]
-    i = 0
-    for warning, link in warning_data.items():
-      warning_groups[i].append((warning, link))
-      i = (i + 1) % num_cpu
+    # Split the warnings into contiguous chunks, several per process so that
+    # idle processes can pick up the remaining work. Each process gets a
+    # contiguous run of chunks, so the results keep the input order.
+    warnings = list(warning_data.items())
+    num_chunks = min(len(warnings), num_cpu * CHUNKS_PER_PROCESS) or 1
+    chunk_size = max(1, -(-len(warnings) // num_chunks))
+    chunks = [warnings[i:i + chunk_size]
+              for i in range(0, len(warnings), chunk_size)]
+    chunks_per_cpu = -(-len(chunks) // num_cpu)
     arg_groups = [[] for _ in range(num_cpu)]
-    for i, group in enumerate(warning_groups):
-      arg_groups[i] = [{
+    for i, group in enumerate(chunks):
+      arg_groups[i // chunks_per_cpu].append({
           'group': group,
           'project_patterns': project_patterns,
           'warn_patterns': warn_patterns,
+          'warn_matcher': warn_matcher,
+          'resolver': resolver,
           'num_processes': num_cpu
-      }]
+      })
 
     group_results = create_launch_subprocs_fn(num_cpu,
                                               classify_warnings_fn,
@@ -536,14 +952,22 @@ def parallel_classify_warnings(warning_data, args, project_names,
     group_results = []
     for warning, link in warning_data.items():
       classify_one_warning(warning, link, group_results,
-                           project_patterns, warn_patterns)
-    group_results = [group_results]
+                           project_patterns, warn_patterns, warn_matcher,
+                           resolver)
+    group_results = [[group_results]]
 
   warning_messages = []
   warning_links = []
   warning_records = []
-  if use_google3:
+  if use_google3 and num_cpu > 1:
     group_results = [group_results]
+  if cache is not None:
+    group_results = [[merge_cached_results(cache, all_warning_data,
+                                           warning_data, cached,
+                                           group_results)]]
+    cache.evict()
+    cache.close()
+    print(cache.stats(), file=sys.stderr)
   for group_result in group_results:
     for result in group_result:
       for line, link, pattern_idx, project_idx in result:
@@ -564,6 +988,43 @@ def parallel_classify_warnings(warning_data, args, project_names,
   return warning_messages, warning_links, warning_records
 
 
+def parse_log_file(logfile, flags, use_google3, logfile_object=None):
+  """Parse logfile, or logfile_object if it is given."""
+  if logfile_object is not None:
+    return parse_input_file(logfile_object, flags)
+  if (not use_google3 and flags.platform == 'android' and
+      flags.processes > 1 and
+      os.path.getsize(logfile) >= PARALLEL_PARSE_MIN_SIZE):
+    return parse_input_file_android_parallel(logfile, flags, flags.processes)
+  with io.open(logfile, encoding='utf-8') as log:
+    return parse_input_file(log, flags)
+
+
+def classify_baseline(flags, project_names, project_patterns, warn_patterns,
+                      use_google3, create_launch_subprocs_fn,
+                      classify_warnings_fn):
+  """Return the classified warnings of --baseline_results or --baseline_log.
+
+  Saved results are classified again if the patterns have changed since.
+  warn_patterns are reset by get_warn_patterns before the caller uses them.
+  """
+  # pylint:disable=too-many-arguments
+  warning_data = None
+  if flags.baseline_results:
+    version, results = warning_delta.load_results(flags.baseline_results)
+    if version == classification_cache.pattern_set_version(warn_patterns,
+                                                           project_patterns):
+      return results
+    warning_data = {message: link for message, link, _, _ in results}
+  else:
+    warning_data, _ = parse_log_file(flags.baseline_log, flags, use_google3)
+  warning_messages, warning_links, warning_records = parallel_classify_warnings(
+      warning_data, flags, project_names, project_patterns, warn_patterns,
+      use_google3, create_launch_subprocs_fn, classify_warnings_fn)
+  return warning_delta.results_of(warning_messages, warning_links,
+                                  warning_records)
+
+
 def process_log(logfile, flags, project_names, project_patterns, warn_patterns,
                 html_path, use_google3, create_launch_subprocs_fn,
                 classify_warnings_fn, logfile_object):
@@ -579,12 +1040,8 @@ def process_log(logfile, flags, project_names, project_patterns, warn_patterns,
   Note that if the arguments to this function change, process_gs_logs.py must
   be updated accordingly.
   """
-  if logfile_object is None:
-    with io.open(logfile, encoding='utf-8') as log:
-      warning_lines_and_links, header_str = parse_input_file(log, flags)
-  else:
-    warning_lines_and_links, header_str = parse_input_file(
-        logfile_object, flags)
+  warning_lines_and_links, header_str = parse_log_file(
+      logfile, flags, use_google3, logfile_object)
   warning_messages, warning_links, warning_records = parallel_classify_warnings(
       warning_lines_and_links, flags, project_names, project_patterns,
       warn_patterns, use_google3, create_launch_subprocs_fn,
@@ -597,6 +1054,22 @@ def process_log(logfile, flags, project_names, project_patterns, warn_patterns,
   return warning_messages, warning_links, warning_records, header_str
 
 
+def write_out_jsonl_log(flags, project_names, project_patterns, warn_patterns,
+                        logfile_object=None):
+  """Stream the classified warnings of flags.log to flags.jsonlpath."""
+  if logfile_object is not None:
+    warnings = stream_classified_warnings(logfile_object, flags,
+                                          project_patterns, warn_patterns)
+    jsonl_writer.write_out_jsonl(flags.jsonlpath, warnings, warn_patterns,
+                                 project_names)
+    return
+  with io.open(flags.log, encoding='utf-8') as log:
+    warnings = stream_classified_warnings(log, flags, project_patterns,
+                                          warn_patterns)
+    jsonl_writer.write_out_jsonl(flags.jsonlpath, warnings, warn_patterns,
+                                 project_names)
+
+
 def common_main(use_google3, create_launch_subprocs_fn, classify_warnings_fn,
                 logfile_object=None):
   """Shared main function for Google3 and non-Google3 versions of warn.py."""
@@ -607,6 +1080,19 @@ def common_main(use_google3, create_launch_subprocs_fn, classify_warnings_fn,
   project_names = get_project_names(project_list)
   project_patterns = [re.compile(p[1]) for p in project_list]
 
+  if flags.jsonlpath:
+    write_out_jsonl_log(flags, project_names, project_patterns, warn_patterns,
+                        logfile_object)
+    return flags, [], [], warn_patterns
+
+  baseline = None
+  if flags.baseline_log or flags.baseline_results:
+    baseline = classify_baseline(flags, project_names, project_patterns,
+                                 warn_patterns, use_google3,
+                                 create_launch_subprocs_fn,
+                                 classify_warnings_fn)
+    warn_patterns = get_warn_patterns(flags.platform)
+
   # html_path=None because we output html below if not outputting CSV
   warning_messages, warning_links, warning_records, header_str = process_log(
       logfile=flags.log, flags=flags, project_names=project_names,
@@ -616,9 +1102,24 @@ def common_main(use_google3, create_launch_subprocs_fn, classify_warnings_fn,
       classify_warnings_fn=classify_warnings_fn,
       logfile_object=logfile_object)
 
-  html_writer.write_out_csv(flags, warn_patterns, warning_messages,
-                            warning_links, warning_records, header_str,
-                            project_names)
+  if flags.save_results or baseline is not None:
+    results = warning_delta.results_of(warning_messages, warning_links,
+                                       warning_records)
+  if flags.save_results:
+    warning_delta.save_results(
+        flags.save_results,
+        classification_cache.pattern_set_version(warn_patterns,
+                                                 project_patterns),
+        results)
+
+  if baseline is not None:
+    added, removed = warning_delta.compare(baseline, results)
+    html_writer.write_out_delta(flags, warn_patterns, project_names, added,
+                                removed, header_str)
+  else:
+    html_writer.write_out_csv(flags, warn_patterns, warning_messages,
+                              warning_links, warning_records, header_str,
+                              project_names)
 
   # Return these values, so that caller can use them, if desired.
   return flags, warning_messages, warning_records, warn_patterns
@@ -0,0 +1,175 @@
+# python3
+# Copyright (C) 2022 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unittests for the parallel parsing of Android logs in warn_common.
+
+Run from the parent directory of the warn package:
+
+  python3 -m warn.warn_common_test
+"""
+
+import argparse
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+# pylint:disable=relative-beyond-top-level,no-name-in-module
+# suppress false positive of no-name-in-module warnings
+from . import warn_common as common
+
+ANDROID_ROOT = '/home/user/aosp'
+
+# parse_input_file_android_parallel parses the first ANDROID_HEADER_LINES lines
+# that aren't warnings before it splits the rest of the log into chunks.
+HEADER = ('PLATFORM_VERSION=13\nTARGET_PRODUCT=aosp_arm64\n'
+          'TARGET_BUILD_VARIANT=userdebug\nBUILD_ID=TP1A\n' +
+          'ninja: building\n' * (common.ANDROID_HEADER_LINES - 4))
+
+
+def _flags():
+  return argparse.Namespace(platform='android', url='https://cs/android',
+                            separator='?l=')
+
+
+class ParseAndroidLogTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def _write_log(self, text, newline='\n'):
+    path = os.path.join(self.tmpdir, 'build.log')
+    with open(path, 'w', newline=newline) as f:
+      f.write(text)
+    return path
+
+  def _parse(self, path, num_processes):
+    """Return the results of the sequential and the parallel parsers."""
+    with io.open(path, encoding='utf-8') as log:
+      expected = common.parse_input_file_android(log, _flags())
+    actual = common.parse_input_file_android_parallel(path, _flags(),
+                                                      num_processes)
+    return expected, actual
+
+  def assertSameAsSequential(self, path, num_processes=2):
+    expected, actual = self._parse(path, num_processes)
+    self.assertEqual(expected[1], actual[1])
+    self.assertEqual(list(expected[0].items()), list(actual[0].items()))
+    return actual[0]
+
+  def test_rustc_warning_ending_a_chunk(self):
+    lines = [HEADER]
+    for i in range(200):
+      lines.append('warning: unused variable: `x%d`\n' % i)
+      lines.append('   --> external/rust/src/lib%d.rs:%d:9\n' % (i, i + 1))
+      lines.append('external/foo/a%d.c:1:2: warning: foo\n' % i)
+    text = ''.join(lines)
+    path = self._write_log(text)
+
+    # At least one chunk must end right after a 'warning:' line for the test
+    # to cover the merge.
+    with open(path, 'rb') as f:
+      data = f.read()
+    chunks = common.split_log_chunks(data, len(HEADER),
+                                     2 * common.CHUNKS_PER_PROCESS)
+    last_lines = [data[data.rfind(b'\n', 0, end - 1) + 1:end]
+                  for _, end in chunks[:-1]]
+    self.assertTrue(
+        [line for line in last_lines if line.startswith(b'warning: ')])
+
+    warnings = self.assertSameAsSequential(path)
+    self.assertIn('external/rust/src/lib7.rs:8:9: warning: unused variable: '
+                  '`x7`', warnings)
+    self.assertFalse([w for w in warnings if 'unknown_source_file' in w])
+
+  def test_rustc_warning_without_file(self):
+    text = HEADER + ''.join(
+        'warning: macro replacement list %d\nother line\n' % i
+        for i in range(100))
+    warnings = self.assertSameAsSequential(self._write_log(text))
+    self.assertIn('unknown_source_file: warning: macro replacement list 3',
+                  warnings)
+
+  def test_crlf(self):
+    text = HEADER + ''.join(
+        'frameworks/base/a%d.cpp:%d:2: warning: foo\n'
+        'warning: bar %d\n   --> external/rust/b.rs:%d:1\n' % (i, i, i, i)
+        for i in range(100))
+    path = self._write_log(text, newline='\r\n')
+    with open(path, 'rb') as f:
+      self.assertIn(b'\r\n', f.read())
+    warnings = self.assertSameAsSequential(path)
+    self.assertFalse(
+        [w for w, link in warnings.items() if '\r' in w or '\r' in link])
+    self.assertIn('external/rust/b.rs:5:1: warning: bar 5', warnings)
+
+  def test_android_root(self):
+    text = HEADER + ''.join(
+        '%s/%s/a%d.cpp:%d:2: warning: foo\n' %
+        (ANDROID_ROOT, ('frameworks', 'system', 'art')[i % 3], i, i)
+        for i in range(100))
+    warnings = self.assertSameAsSequential(self._write_log(text))
+    self.assertIn('frameworks/a0.cpp:0:2: warning: foo', warnings)
+    self.assertEqual('https://cs/android/system/a1.cpp?l=1',
+                     warnings['system/a1.cpp:1:2: warning: foo'])
+    self.assertFalse([w for w in warnings if ANDROID_ROOT in w])
+
+  def test_one_chunk(self):
+    text = HEADER + 'art/a.cc:1:2: warning: foo\n'
+    warnings = self.assertSameAsSequential(self._write_log(text), 1)
+    self.assertEqual(['art/a.cc:1:2: warning: foo'], list(warnings))
+
+  def test_stream_top_after_warnings(self):
+    # The TOP= header line comes after the first batches of warnings.
+    text = ('PLATFORM_VERSION=13\n' +
+            ''.join('%s/art/a%d.cc:%d:2: warning: foo\n' % (ANDROID_ROOT, i, i)
+                    for i in range(10)) +
+            'TOP=%s\n' % ANDROID_ROOT +
+            ''.join('%s/bionic/b%d.c:%d:2: warning: bar\n' % (ANDROID_ROOT, i, i)
+                    for i in range(10)))
+    path = self._write_log(text)
+    with io.open(path, encoding='utf-8') as log:
+      expected = common.parse_input_file_android(log, _flags())[0]
+    with mock.patch.object(common, 'STREAM_BATCH_LINES', 3), \
+        io.open(path, encoding='utf-8') as log:
+      actual = list(common.iter_android_warnings(log, _flags()))
+    self.assertEqual(list(expected.items()), actual)
+    self.assertIn(('art/a1.cc:1:2: warning: foo',
+                   'https://cs/android/art/a1.cc?l=1'), actual)
+
+  def test_split_log_lines(self):
+    self.assertEqual(['a\n', 'b\n', 'c\n', 'd'],
+                     common.split_log_lines(b'a\r\nb\rc\nd'))
+    self.assertEqual(['a\n'], common.split_log_lines(b'a\n'))
+
+  def test_remove_android_root_from_line(self):
+    self.assertEqual(
+        'art/a.cc:1:2: warning: /home/user/aosp/b',
+        common.remove_android_root_from_line(
+            '/home/user/aosp/art/a.cc:1:2: warning: /home/user/aosp/b',
+            ANDROID_ROOT))
+    self.assertEqual(
+        'art/a.cc:1:2: warning: foo',
+        common.remove_android_root_from_line('art/a.cc:1:2: warning: foo',
+                                             ANDROID_ROOT))
+
+
+if __name__ == '__main__':
+  unittest.main(verbosity=2)
@@ -0,0 +1,74 @@
+# python3
+# Copyright (C) 2022 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compare the classified warnings of a build with those of a baseline build.
+
+A classified warning is a tuple (message, link, pattern index, project index).
+Results of a build can be saved with save_results and used as the baseline
+of a later build, instead of parsing and classifying the baseline log again.
+"""
+
+import gzip
+import json
+
+# pylint:disable=relative-beyond-top-level
+from .classification_cache import line_hash
+
+
+def results_of(warning_messages, warning_links, warning_records):
+  """Return the classified warnings of parallel_classify_warnings results."""
+  return [(warning_messages[message_idx], warning_links[link_idx],
+           pattern_idx, project_idx)
+          for pattern_idx, project_idx, message_idx, link_idx
+          in warning_records]
+
+
+def save_results(path, version, results):
+  """Save classified warnings with the pattern_set_version of their indices."""
+  with gzip.open(path, 'wt', encoding='utf-8') as output:
+    json.dump({'version': version, 'warnings': results}, output)
+
+
+def load_results(path):
+  """Return the pattern set version and warnings saved by save_results."""
+  with gzip.open(path, 'rt', encoding='utf-8') as saved:
+    data = json.load(saved)
+  return data['version'], [tuple(warning) for warning in data['warnings']]
+
+
+def compare(baseline, current):
+  """Return the (added, removed) warnings of current compared to baseline.
+
+  Warnings are compared by the hash of their messages.
+  """
+  baseline_hashes = [line_hash(warning[0]) for warning in baseline]
+  current_hashes = [line_hash(warning[0]) for warning in current]
+  baseline_set = set(baseline_hashes)
+  current_set = set(current_hashes)
+  added = [warning for warning, key in zip(current, current_hashes)
+           if key not in baseline_set]
+  removed = [warning for warning, key in zip(baseline, baseline_hashes)
+             if key not in current_set]
+  return added, removed
+
+
+def count_by_pattern(warnings, project_names):
+  """Return {pattern index: {project name: number of warnings}}."""
+  counts = {}
+  for _, _, pattern_idx, project_idx in warnings:
+    pname = '???' if project_idx < 0 else project_names[project_idx]
+    projects = counts.setdefault(pattern_idx, {})
+    projects[pname] = projects.get(pname, 0) + 1
+  return counts